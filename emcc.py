@@ -20,7 +20,7 @@ emcc can be influenced by a few environment variables:
                slows down compilation).
 """
 
-from tools.toolchain_profiler import ToolchainProfiler
+from tools.toolchain_profiler import ToolchainProfiler, enable_timing_report
 
 import base64
 import json
@@ -47,6 +47,7 @@ from tools.response_file import substitute_response_files
 from tools.minimal_runtime_shell import generate_minimal_runtime_html
 import tools.line_endings
 from tools import js_manipulation
+from tools import stage_cache
 from tools import wasm2c
 from tools import webassembly
 from tools import config
@@ -2857,6 +2858,11 @@ def phase_post_link(options, state, in_wasm, wasm_target, target):
   if options.oformat != OFormat.WASM:
     phase_final_emitting(options, state, target, wasm_target, memfile)
 
+  if stage_cache.stage_results:
+    hits = [name for name, hit in stage_cache.stage_results if hit]
+    misses = [name for name, hit in stage_cache.stage_results if not hit]
+    logger.debug(f'post-link stage cache: hits: {hits} misses: {misses}')
+
 
 @ToolchainProfiler.profile_block('emscript')
 def phase_emscript(options, in_wasm, wasm_target, memfile):
@@ -3291,6 +3297,8 @@ def parse_args(newargs):
         options.output_eol = '\n'
       else:
         exit_with_error(f'Invalid value "{style}" to --output_eol!')
+    elif check_arg('--timing-report'):
+      enable_timing_report(consume_arg())
     # Record USE_PTHREADS setting because it controls whether --shared-memory is passed to lld
     elif arg == '-pthread':
       settings_changes.append('USE_PTHREADS=1')
@@ -3452,13 +3460,38 @@ def phase_binaryen(target, options, wasm_target):
   def preprocess_wasm2js_script():
     return read_and_preprocess(utils.path_from_root('src/wasm2js.js'), expand_macros=True)
 
+  # The remaining stages are run as a small task graph, so that independent
+  # stages (for example closure and wasm2js, which can both be slow) run
+  # concurrently.  A stage that reads the wasm waits for the last stage that
+  # rewrote it, and a stage that rewrites the wasm in place also waits for all
+  # the stages that read it since.
+  tasks = []
+  wasm_writers = []
+  wasm_readers = []
+
+  def add_task(name, func, deps=(), reads_wasm=False, writes_wasm=False):
+    deps = list(deps)
+    if reads_wasm or writes_wasm:
+      deps += wasm_writers
+    if writes_wasm:
+      deps += wasm_readers
+      wasm_writers[:] = [name]
+      wasm_readers.clear()
+    elif reads_wasm:
+      wasm_readers.append(name)
+    tasks.append((name, func, deps))
+
   if final_js and (options.use_closure_compiler or settings.TRANSPILE_TO_ES5):
-    if options.use_closure_compiler:
-      final_js = building.closure_compiler(final_js, pretty=not minify_whitespace(),
-                                           extra_closure_args=options.closure_args)
-    else:
-      final_js = building.closure_transpile(final_js, pretty=not minify_whitespace())
-    save_intermediate_with_wasm('closure', wasm_target)
+    def closure():
+      global final_js
+      if options.use_closure_compiler:
+        final_js = building.closure_compiler(final_js, pretty=not minify_whitespace(),
+                                             extra_closure_args=options.closure_args)
+      else:
+        final_js = building.closure_transpile(final_js, pretty=not minify_whitespace())
+      save_intermediate_with_wasm('closure', wasm_target)
+
+    add_task('closure', closure)
 
   symbols_file = None
   if options.emit_symbol_map:
@@ -3472,31 +3505,46 @@ def phase_binaryen(target, options, wasm_target):
       # generate secondary file for JS symbols
       if options.emit_symbol_map:
         symbols_file_js = shared.replace_or_append_suffix(wasm2js_template, '.symbols')
+      # wasm2js runs on its own copy of the wasm, so that it does not have to
+      # wait for the stages below that rewrite the wasm in place.  For the same
+      # reason the wasm symbol map that it writes goes to a temporary file,
+      # since that is overwritten by the one for the final wasm anyhow.
+      wasm2js_input = in_temp('wasm2js_input.wasm')
+      shutil.copyfile(wasm_target, wasm2js_input)
+      wasm2js_symbols_file = in_temp('wasm2js_input.symbols') if symbols_file else None
     else:
-      wasm2js_template = final_js
+      wasm2js_input = wasm_target
+      wasm2js_symbols_file = symbols_file
       if options.emit_symbol_map:
         symbols_file_js = shared.replace_or_append_suffix(target, '.symbols')
 
-    wasm2js = building.wasm2js(wasm2js_template,
-                               wasm_target,
-                               opt_level=settings.OPT_LEVEL,
-                               minify_whitespace=minify_whitespace(),
-                               use_closure_compiler=options.use_closure_compiler,
-                               debug_info=debug_info,
-                               symbols_file=symbols_file,
-                               symbols_file_js=symbols_file_js)
+    def run_wasm2js():
+      global final_js
+      wasm2js = building.wasm2js(wasm2js_template if settings.WASM == 2 else final_js,
+                                 wasm2js_input,
+                                 opt_level=settings.OPT_LEVEL,
+                                 minify_whitespace=minify_whitespace(),
+                                 use_closure_compiler=options.use_closure_compiler,
+                                 debug_info=debug_info,
+                                 symbols_file=wasm2js_symbols_file,
+                                 symbols_file_js=symbols_file_js)
 
-    shared.get_temp_files().note(wasm2js)
+      shared.get_temp_files().note(wasm2js)
 
-    if settings.WASM == 2:
-      safe_copy(wasm2js, wasm2js_template)
+      if settings.WASM == 2:
+        safe_copy(wasm2js, wasm2js_template)
 
-    if settings.WASM != 2:
-      final_js = wasm2js
-      # if we only target JS, we don't need the wasm any more
-      shared.try_delete(wasm_target)
+      if settings.WASM != 2:
+        final_js = wasm2js
+        # if we only target JS, we don't need the wasm any more
+        shared.try_delete(wasm_target)
 
-    save_intermediate('wasm2js')
+      save_intermediate('wasm2js')
+
+    if settings.WASM == 2:
+      add_task('wasm2js', run_wasm2js)
+    else:
+      add_task('wasm2js', run_wasm2js, deps=[t[0] for t in tasks], writes_wasm=True)
 
   # emit the final symbols, either in the binary or in a symbol map.
   # this will also remove debug info if we only kept it around in the intermediate invocations.
@@ -3504,25 +3552,44 @@ def phase_binaryen(target, options, wasm_target):
   # have anything to do here.
   if options.emit_symbol_map:
     intermediate_debug_info -= 1
-    if os.path.exists(wasm_target):
-      building.handle_final_wasm_symbols(wasm_file=wasm_target, symbols_file=symbols_file, debug_info=intermediate_debug_info)
-      save_intermediate_with_wasm('symbolmap', wasm_target)
+    symbols_debug_info = intermediate_debug_info
+
+    def symbolmap():
+      if os.path.exists(wasm_target):
+        building.handle_final_wasm_symbols(wasm_file=wasm_target, symbols_file=symbols_file, debug_info=symbols_debug_info)
+        save_intermediate_with_wasm('symbolmap', wasm_target)
+
+    # without debug info the symbol map stage also strips the names from the
+    # wasm, otherwise it only reads it.
+    add_task('symbolmap', symbolmap, reads_wasm=True, writes_wasm=not symbols_debug_info)
+
+  if settings.DEBUG_LEVEL >= 3 and settings.SEPARATE_DWARF:
+    def debug_on_side():
+      if os.path.exists(wasm_target):
+        building.emit_debug_on_side(wasm_target)
 
-  if settings.DEBUG_LEVEL >= 3 and settings.SEPARATE_DWARF and os.path.exists(wasm_target):
-    building.emit_debug_on_side(wasm_target)
+    add_task('debug_on_side', debug_on_side, writes_wasm=True)
 
   if settings.WASM2C:
-    wasm2c.do_wasm2c(wasm_target)
+    add_task('wasm2c', lambda: wasm2c.do_wasm2c(wasm_target), reads_wasm=True)
 
   # we have finished emitting the wasm, and so intermediate debug info will
   # definitely no longer be used tracking it.
   if debug_info:
     intermediate_debug_info -= 1
   assert intermediate_debug_info == 0
-  # strip debug info if it was not already stripped by the last command
-  if not debug_info and building.binaryen_kept_debug_info and \
-     building.os.path.exists(wasm_target):
-    building.run_wasm_opt(wasm_target, wasm_target)
+
+  def strip_debug_info():
+    # strip debug info if it was not already stripped by the last command
+    if not debug_info and building.binaryen_kept_debug_info and \
+       building.os.path.exists(wasm_target):
+      building.run_wasm_opt(wasm_target, wasm_target)
+
+  add_task('strip', strip_debug_info, writes_wasm=True)
+
+  # In debug mode run the stages in order, so that the intermediate files are
+  # saved in a predictable order.
+  shared.run_task_graph(tasks, parallel=not DEBUG)
 
   # replace placeholder strings with correct subresource locations
   if final_js and settings.SINGLE_FILE and not settings.WASM2JS:
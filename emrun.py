@@ -15,8 +15,13 @@ See emrun --help for more information
 # N.B. Do not introduce external dependencies to this file. It is often used
 # standalone outside Emscripten directory tree.
 import argparse
+import asyncio
 import atexit
 import cgi
+import gzip
+import heapq
+import io
+import itertools
 import json
 import os
 import platform
@@ -31,24 +36,14 @@ import sys
 import tempfile
 import threading
 import time
-from operator import itemgetter
+import traceback
+from http.server import SimpleHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlsplit
 
-if sys.version_info.major == 2:
-  import SocketServer as socketserver
-  from BaseHTTPServer import HTTPServer
-  from SimpleHTTPServer import SimpleHTTPRequestHandler
-  from urllib import unquote
-  from urlparse import urlsplit
 
-  def print_to_handle(handle, line):
-    print >> handle, line # noqa: F633
-else:
-  import socketserver
-  from http.server import HTTPServer, SimpleHTTPRequestHandler
-  from urllib.parse import unquote, urlsplit
+def print_to_handle(handle, line):
+  handle.write(line + '\n')
 
-  def print_to_handle(handle, line):
-    handle.write(line + '\n')
 
 # Populated from cmdline params
 emrun_options = None
@@ -228,6 +223,80 @@ def unquote_u(source):
   return result
 
 
+# Encodings of precompressed files that are served in place of the requested
+# file, in order of preference, along with their file name suffixes.
+PRECOMPRESSED_SUFFIXES = [('br', '.br'), ('gzip', '.gz')]
+
+# If the OS can't send static files straight to the socket, they are sent in
+# chunks of at most this size.
+SENDFILE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files dumped by the page are written to disk in chunks of at most this size
+# as they arrive.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_accept_encoding(header):
+  """Returns the set of encodings that the browser accepts according to the
+  given Accept-Encoding header.
+  """
+  encodings = set()
+  for item in header.split(','):
+    params = item.split(';')
+    encoding = params[0].strip().lower()
+    quality = 1.0
+    for param in params[1:]:
+      param = param.strip()
+      if param.startswith('q='):
+        try:
+          quality = float(param[2:])
+        except ValueError:
+          pass
+    if encoding and quality > 0:
+      encodings.add(encoding)
+  return encodings
+
+
+def etag_matches(header, etag):
+  """Checks if the given If-None-Match or If-Range header matches the ETag of
+  a file.
+  """
+  if not header:
+    return False
+  for tag in header.split(','):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag == '*' or tag == etag:
+      return True
+  return False
+
+
+def parse_range(header, size):
+  """Parses a Range header for a file of the given size. Returns the
+  [start, end) byte range to send, None if the whole file should be sent, or
+  False if the range cannot be satisfied.
+  """
+  unit, _, ranges = header.partition('=')
+  # Multiple ranges are rarely used by browsers, just send the whole file then.
+  if unit.strip() != 'bytes' or ',' in ranges:
+    return None
+  start, _, end = ranges.strip().partition('-')
+  try:
+    if start:
+      start = int(start)
+      end = int(end) + 1 if end else size
+    else:
+      # Suffix range, the last N bytes of the file.
+      start = max(size - int(end), 0)
+      end = size
+  except ValueError:
+    return None
+  if start >= size or start >= end:
+    return False
+  return (start, min(end, size))
+
+
 temp_firefox_profile_dir = None
 
 
@@ -450,6 +519,19 @@ def detect_browser_processes():
 
   current_browser_processes = [p for p in running_browser_processes if not pid_existed(p['pid'])]
 
+  # If the browser we launched is still running, i.e. it was not just a stub
+  # that handed the page over to another process, only its own child processes
+  # can be ours. This matters when several browsers are being launched at the
+  # same time, e.g. with --pages and --jobs.
+  if browser_process and browser_process.poll() is None:
+    try:
+      import psutil
+      launched = psutil.Process(browser_process.pid)
+      tree = set([launched.pid] + [child.pid for child in launched.children(recursive=True)])
+      current_browser_processes = [p for p in current_browser_processes if p['pid'] in tree]
+    except Exception:
+      pass
+
   if len(current_browser_processes) == 0:
     logv('Was unable to detect the browser process that was spawned by emrun. This may occur if the target page was opened in a tab on a browser process that already existed before emrun started up.')
 
@@ -459,14 +541,34 @@ def detect_browser_processes():
 # file:// URL, since those wouldn't work too well unless user allowed XHR
 # without CORS rules.  Also, the target page will route its stdout and stderr
 # back to here via HTTP requests.
-class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
+# The server runs on an asyncio event loop, so that connections from the page
+# are served concurrently, and the --timeout and --silence_timeout checks are
+# timers on the loop instead of being polled between requests.
+class HTTPWebServer(object):
   """Log messaging arriving via HTTP can come in out of sequence. Implement a
   sequencing mechanism to enforce ordered transmission."""
-  expected_http_seq_num = 1
-  # Stores messages that have arrived out of order, pending for a send as soon
-  # as the missing message arrives.  Kept in sorted order, first element is the
-  # oldest message received.
-  http_message_queue = []
+  # How often to check in seconds whether the browser is still alive, and
+  # whether messages have been queued for too long.
+  housekeeping_interval = 0.5
+
+  def __init__(self, server_address, RequestHandlerClass):
+    self.server_address = server_address
+    self.RequestHandlerClass = RequestHandlerClass
+    self.is_running = False
+    self.expected_http_seq_num = 1
+    # Stores messages that have arrived out of order, pending for a send as
+    # soon as the missing message arrives.  Kept as a heap, first element is
+    # the oldest message received. The counter breaks ties between equal
+    # sequence numbers, e.g. if the page was reloaded.
+    self.http_message_queue = []
+    self.http_message_counter = itertools.count()
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.stopped = self.loop.create_future()
+    # Start listening right away, so that e.g. a port that is already in use is
+    # reported before we launch the browser.
+    host, port = server_address
+    self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_connection, host, port))
 
   def handle_incoming_message(self, seq_num, log, data):
     global have_received_messages
@@ -483,8 +585,7 @@ class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
       elif seq_num < self.expected_http_seq_num:
         log(data)
       else:
-        self.http_message_queue += [(seq_num, data, log)]
-        self.http_message_queue.sort(key=itemgetter(0))
+        heapq.heappush(self.http_message_queue, (seq_num, next(self.http_message_counter), data, log))
         if len(self.http_message_queue) > 16:
           self.print_next_message()
 
@@ -517,80 +618,212 @@ class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
   # messages.
   def print_messages_due(self):
     with http_mutex:
-      while len(self.http_message_queue):
-        msg = self.http_message_queue[0]
-        if msg[0] == self.expected_http_seq_num:
-          msg[2](msg[1])
-          self.expected_http_seq_num += 1
-          self.http_message_queue.pop(0)
-        else:
-          return
+      queue = self.http_message_queue
+      while len(queue) and queue[0][0] <= self.expected_http_seq_num:
+        seq_num, _, data, log = heapq.heappop(queue)
+        log(data)
+        self.expected_http_seq_num = max(self.expected_http_seq_num, seq_num + 1)
 
-  def serve_forever(self, timeout=0.5):
-    global last_message_time, page_exit_code, emrun_not_enabled_nag_printed
+  def serve_forever(self):
     self.is_running = True
-    self.timeout = timeout
     logv("Entering web server loop.")
+    if emrun_options.timeout != 0:
+      self.loop.call_later(max(page_start_time + emrun_options.timeout - tick(), 0), self.page_timed_out)
+    if emrun_options.silence_timeout != 0:
+      self.loop.call_later(emrun_options.silence_timeout, self.check_silence_timeout)
+    self.loop.create_task(self.housekeeping())
+    try:
+      self.loop.run_until_complete(self.stopped)
+    finally:
+      # Clean up at quit, print any leftover messages in queue.
+      self.print_all_messages()
+      logv("Web server loop done.")
+
+  async def housekeeping(self):
+    global emrun_not_enabled_nag_printed
     while self.is_running:
-      now = tick()
-      # Did user close browser?
-      if not emrun_options.no_browser and not is_browser_process_alive():
+      # Did user close browser? Finding that out may need listing all
+      # processes, so don't block serving the page on it.
+      if not emrun_options.no_browser and not await self.loop.run_in_executor(None, is_browser_process_alive):
         logv("Shutting down because browser is no longer alive")
         delete_emrun_safe_firefox_profile()
         if not emrun_options.serve_after_close:
           logv("Browser process has shut down, quitting web server.")
-          self.is_running = False
+          self.shutdown()
+          return
 
-      # Serve HTTP
-      self.handle_request()
       # Process message log queue
       self.print_timed_out_messages()
 
-      # If web page was silent for too long without printing anything, kill process.
-      time_since_message = now - last_message_time
-      if emrun_options.silence_timeout != 0 and time_since_message > emrun_options.silence_timeout:
-        self.shutdown()
-        logi('No activity in ' + str(emrun_options.silence_timeout) + ' seconds. Quitting web server with return code ' + str(emrun_options.timeout_returncode) + '. (--silence_timeout option)')
-        page_exit_code = emrun_options.timeout_returncode
-        emrun_options.kill_exit = True
-
-      # If the page has been running too long as a whole, kill process.
-      time_since_start = now - page_start_time
-      if emrun_options.timeout != 0 and time_since_start > emrun_options.timeout:
-        self.shutdown()
-        logi('Page has not finished in ' + str(emrun_options.timeout) + ' seconds. Quitting web server with return code ' + str(emrun_options.timeout_returncode) + '. (--timeout option)')
-        emrun_options.kill_exit = True
-        page_exit_code = emrun_options.timeout_returncode
-
       # If we detect that the page is not running with emrun enabled, print a warning message.
       if not emrun_not_enabled_nag_printed and page_last_served_time is not None:
-        time_since_page_serve = now - page_last_served_time
+        time_since_page_serve = tick() - page_last_served_time
         if not have_received_messages and time_since_page_serve > 10:
           logv('The html page you are running is not emrun-capable. Stdout, stderr and exit(returncode) capture will not work. Recompile the application with the --emrun linker flag to enable this, or pass --no_emrun_detect to emrun to hide this check.')
           emrun_not_enabled_nag_printed = True
 
-    # Clean up at quit, print any leftover messages in queue.
-    self.print_all_messages()
-    logv("Web server loop done.")
+      await asyncio.sleep(self.housekeeping_interval)
 
-  def handle_error(self, request, client_address):
-    err = sys.exc_info()[1].args[0]
-    # Filter out the useless '[Errno 10054] An existing connection was forcibly
-    # closed by the remote host' errors that occur when we forcibly kill the
-    # client.
-    if err != 10054:
-      socketserver.BaseServer.handle_error(self, request, client_address)
+  # If the page has been running too long as a whole, kill process.
+  def page_timed_out(self):
+    global page_exit_code
+    if not self.is_running:
+      return
+    self.shutdown()
+    logi('Page has not finished in ' + str(emrun_options.timeout) + ' seconds. Quitting web server with return code ' + str(emrun_options.timeout_returncode) + '. (--timeout option)')
+    emrun_options.kill_exit = True
+    page_exit_code = emrun_options.timeout_returncode
+
+  # If web page was silent for too long without printing anything, kill
+  # process. Otherwise check again once it could have been silent for long
+  # enough.
+  def check_silence_timeout(self):
+    global page_exit_code
+    if not self.is_running:
+      return
+    time_since_message = tick() - last_message_time
+    if time_since_message < emrun_options.silence_timeout:
+      self.loop.call_later(emrun_options.silence_timeout - time_since_message, self.check_silence_timeout)
+      return
+    self.shutdown()
+    logi('No activity in ' + str(emrun_options.silence_timeout) + ' seconds. Quitting web server with return code ' + str(emrun_options.timeout_returncode) + '. (--silence_timeout option)')
+    page_exit_code = emrun_options.timeout_returncode
+    emrun_options.kill_exit = True
+
+  # Serves the requests that arrive on a single connection. Each request,
+  # along with its body, is read in full before it is passed to a request
+  # handler, which then produces the response in memory. Static files and file
+  # dumps from the page are the exception, those are streamed from and to
+  # disk.
+  async def handle_connection(self, reader, writer):
+    client_address = writer.get_extra_info('peername')
+    responding = False
+    try:
+      while self.is_running:
+        responding = False
+        request = await reader.readuntil(b'\r\n\r\n')
+        content_length = re.search(br'^content-length:[ \t]*(\d+)', request, re.IGNORECASE | re.MULTILINE)
+        content_length = int(content_length.group(1)) if content_length else 0
+        is_file_dump = request.startswith(b'POST ') and b'?file=' in request[:request.index(b'\r\n')]
+        if content_length and not is_file_dump:
+          request += await reader.readexactly(content_length)
+        if request.startswith(b'POST /system_info'):
+          # Gathering system info runs external tools, do that on a thread.
+          handler = await self.loop.run_in_executor(None, self.RequestHandlerClass, request, client_address, self)
+        else:
+          handler = self.RequestHandlerClass(request, client_address, self)
+        if handler.file_to_receive:
+          await self.receive_file(reader, content_length, *handler.file_to_receive)
+        responding = True
+        writer.write(handler.wfile.getvalue())
+        if handler.file_to_send:
+          await self.send_file(writer, *handler.file_to_send)
+        await writer.drain()
+        # If a file dump was refused, its body is still waiting to be read.
+        if handler.close_connection or (is_file_dump and not handler.file_to_receive):
+          break
+    except (asyncio.IncompleteReadError, ConnectionError):
+      # The browser closed the connection.
+      pass
+    except asyncio.LimitOverrunError:
+      # The request header is larger than we are willing to buffer.
+      await self.send_error_response(writer, 431)
+    except asyncio.CancelledError:
+      # The server is quitting.
+      pass
+    except Exception:
+      loge('Error while handling a request from ' + str(client_address) + ':\n' + traceback.format_exc())
+      # A response that is already partly sent cannot be replaced.
+      if not responding:
+        await self.send_error_response(writer, 500)
+    finally:
+      writer.close()
+
+  # Sends a response with no body and closes the connection, for requests that
+  # cannot be handed to a request handler.
+  async def send_error_response(self, writer, code):
+    message = self.RequestHandlerClass.responses[code][0]
+    writer.write(('HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % (code, message)).encode('utf-8'))
+    try:
+      await writer.drain()
+    except ConnectionError:
+      pass
+
+  async def receive_file(self, reader, count, f, filename):
+    try:
+      remaining = count
+      while remaining > 0:
+        data = await reader.read(min(remaining, UPLOAD_CHUNK_SIZE))
+        if not data:
+          raise asyncio.IncompleteReadError(b'', remaining)
+        # Writing may mean compressing the data, so don't hold up the loop.
+        await self.loop.run_in_executor(None, f.write, data)
+        remaining -= len(data)
+    finally:
+      f.close()
+    logi('Wrote ' + str(count) + ' bytes to file "' + filename + '".')
+
+  async def send_file(self, writer, f, offset, count):
+    try:
+      if count <= 0:
+        return
+      if hasattr(self.loop, 'sendfile'):
+        # Lets the OS copy the file straight to the socket where possible.
+        await self.loop.sendfile(writer.transport, f, offset, count)
+        return
+      f.seek(offset)
+      while count > 0:
+        data = f.read(min(count, SENDFILE_CHUNK_SIZE))
+        if not data:
+          break
+        writer.write(data)
+        await writer.drain()
+        count -= len(data)
+    finally:
+      f.close()
 
   def shutdown(self):
     self.is_running = False
     self.print_all_messages()
+    if not self.stopped.done():
+      self.stopped.set_result(None)
     return 1
 
+  def server_close(self):
+    self.server.close()
+    # Drop the connections that browsers are still keeping alive, and anything
+    # else that is still in progress.
+    all_tasks = asyncio.all_tasks if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks
+    tasks = [task for task in all_tasks(self.loop) if not task.done()]
+    for task in tasks:
+      task.cancel()
+    self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    self.loop.run_until_complete(self.server.wait_closed())
+    self.loop.close()
+
 
 # Processes HTTP request back to the browser.
 class HTTPHandler(SimpleHTTPRequestHandler):
+  # Use HTTP/1.1 so that the page can keep its connection alive while posting
+  # stdout/stderr messages.
+  protocol_version = 'HTTP/1.1'
+
+  # The server hands us a single request that it has already read in full, and
+  # sends the response that we write once we are done.
+  def setup(self):
+    self.rfile = io.BytesIO(self.request)
+    self.wfile = io.BytesIO()
+    self.file_to_send = None
+    self.file_to_receive = None
+
+  def handle(self):
+    self.close_connection = True
+    self.handle_one_request()
+
+  def finish(self):
+    pass
+
   def send_head(self):
-    self.protocol_version = 'HTTP/1.1'
     global page_last_served_time
     path = self.translate_path(self.path)
     f = None
@@ -607,6 +840,7 @@ class HTTPHandler(SimpleHTTPRequestHandler):
       if not self.path.endswith('/'):
         self.send_response(301)
         self.send_header("Location", self.path + "/")
+        self.send_header("Content-Length", "0")
         self.end_headers()
         return None
       for index in "index.html", "index.htm":
@@ -618,13 +852,8 @@ class HTTPHandler(SimpleHTTPRequestHandler):
         # Manually implement directory listing support.
         return self.list_directory(path)
 
-    try:
-      f = open(path, 'rb')
-    except IOError:
-      self.send_error(404, "File not found: " + path)
-      return None
-
-    self.send_response(200)
+    encoding = None
+    accepted_encodings = parse_accept_encoding(self.headers.get('Accept-Encoding', ''))
     guess_file_type = path
     # All files of type x.gz are served as gzip-compressed, which means the
     # browser will transparently decode the file before passing the
@@ -636,12 +865,62 @@ class HTTPHandler(SimpleHTTPRequestHandler):
     # gzipped file, instead of having the browser decompress it immediately,
     # then it can't use the suffix .gz when using emrun.
     # To work around, one can use the suffix .gzip instead.
-    if 'Accept-Encoding' in self.headers and 'gzip' in self.headers['Accept-Encoding'] and path.lower().endswith('gz'):
-      self.send_header('Content-Encoding', 'gzip')
-      logv('Serving ' + path + ' as gzip-compressed.')
-      guess_file_type = guess_file_type[:-2]
-      if guess_file_type.endswith('.'):
-        guess_file_type = guess_file_type[:-1]
+    if path.lower().endswith('gz'):
+      if 'gzip' in accepted_encodings:
+        encoding = 'gzip'
+        guess_file_type = guess_file_type[:-2]
+        if guess_file_type.endswith('.'):
+          guess_file_type = guess_file_type[:-1]
+    else:
+      # If there is a precompressed x.br or x.gz next to the requested file x
+      # (and it is not older than x), serve that instead.
+      for enc, suffix in PRECOMPRESSED_SUFFIXES:
+        if enc in accepted_encodings and os.path.isfile(path + suffix):
+          if not os.path.isfile(path) or os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+            encoding = enc
+            path += suffix
+            break
+    if encoding:
+      logv('Serving ' + path + ' as ' + encoding + '-compressed.')
+
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      self.send_error(404, "File not found: " + path)
+      return None
+
+    fs = os.fstat(f.fileno())
+    size = fs.st_size
+    etag = '"%x-%x%s"' % (int(fs.st_mtime * 1000000), size, '-' + encoding if encoding else '')
+    page_last_served_time = tick()
+
+    if etag_matches(self.headers.get('If-None-Match'), etag):
+      f.close()
+      self.send_response(304)
+      self.send_file_headers(etag)
+      self.end_headers()
+      return None
+
+    content_range = None
+    range_header = self.headers.get('Range')
+    if range_header and etag_matches(self.headers.get('If-Range', etag), etag):
+      content_range = parse_range(range_header, size)
+      if content_range is False:
+        f.close()
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % size)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return None
+
+    if content_range:
+      start, end = content_range
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+    else:
+      start, end = 0, size
+      self.send_response(200)
+    self.send_range = (start, end - start)
 
     ctype = self.guess_type(guess_file_type)
     if guess_file_type.lower().endswith('.wasm'):
@@ -649,23 +928,43 @@ class HTTPHandler(SimpleHTTPRequestHandler):
     if guess_file_type.lower().endswith('.js'):
       ctype = 'application/javascript'
     self.send_header('Content-type', ctype)
-    fs = os.fstat(f.fileno())
-    self.send_header("Content-Length", str(fs[6]))
+    if encoding:
+      self.send_header('Content-Encoding', encoding)
+    self.send_header("Content-Length", str(end - start))
     self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-    self.send_header('Cache-Control', 'no-cache, must-revalidate')
-    self.send_header('Connection', 'close')
-    self.send_header('Expires', '-1')
+    self.send_file_headers(etag)
+    self.end_headers()
+    return f
+
+  def send_file_headers(self, etag):
+    self.send_header('ETag', etag)
+    self.send_header('Accept-Ranges', 'bytes')
+    self.send_header('Vary', 'Accept-Encoding')
+    # Browsers may cache the files, but need to check with us each time
+    # whether they changed. Unchanged files get a 304 response.
+    self.send_header('Cache-Control', 'no-cache')
     self.send_header('Access-Control-Allow-Origin', '*')
     self.send_header('Cross-Origin-Opener-Policy', 'same-origin')
     self.send_header('Cross-Origin-Embedder-Policy', 'require-corp')
     self.send_header('Cross-Origin-Resource-Policy', 'cross-origin')
-    self.end_headers()
-    page_last_served_time = tick()
-    return f
+
+  def do_GET(self):
+    self.send_range = None
+    f = self.send_head()
+    if f:
+      if self.send_range:
+        # Leave sending the file to the server, which closes it when done.
+        self.file_to_send = (f,) + self.send_range
+      else:
+        try:
+          self.copyfile(f, self.wfile)
+        finally:
+          f.close()
 
   def log_request(self, code):
-    # Filter out 200 OK messages to remove noise.
-    if code != 200:
+    # Filter out successful requests to remove noise. Partial content and not
+    # modified responses are a normal part of loading a page as well.
+    if code not in (200, 206, 304):
       SimpleHTTPRequestHandler.log_request(self, code)
 
   def log_message(self, format, *args):
@@ -675,7 +974,6 @@ class HTTPHandler(SimpleHTTPRequestHandler):
       sys.stderr.write(msg)
 
   def do_POST(self):
-    self.protocol_version = 'HTTP/1.1'
     global page_exit_code, have_received_messages
 
     (_, _, path, query, _) = urlsplit(self.path)
@@ -683,16 +981,21 @@ class HTTPHandler(SimpleHTTPRequestHandler):
     if query.startswith('file='):
       # Binary file dump/upload handling. Requests to
       # "stdio.html?file=filename" will write binary data to the given file.
-      data = self.rfile.read(int(self.headers['Content-Length']))
-      filename = unquote_u(query[len('file='):])
-      filename = os.path.join(emrun_options.dump_out_directory, os.path.normpath(filename))
+      # Adding "&append=1" appends to the file instead, and "&compress=gzip"
+      # gzips the data. The server streams the data into the file that we open
+      # here.
+      params = parse_qs(query, keep_blank_values=True)
+      filename = os.path.join(emrun_options.dump_out_directory, os.path.normpath(params['file'][0]))
       try:
         os.makedirs(os.path.dirname(filename))
       except OSError:
         pass
-      with open(filename, 'wb') as fh:
-        fh.write(data)
-      logi('Wrote ' + str(len(data)) + ' bytes to file "' + filename + '".')
+      mode = 'ab' if params.get('append', ['0'])[0] not in ('', '0') else 'wb'
+      if params.get('compress') == ['gzip']:
+        f = gzip.open(filename, mode, compresslevel=6)
+      else:
+        f = open(filename, mode)
+      self.file_to_receive = (f, filename)
       have_received_messages = True
     elif path == '/system_info':
       system_info = json.loads(get_system_info(format_json=True))
@@ -707,48 +1010,64 @@ class HTTPHandler(SimpleHTTPRequestHandler):
       self.send_header('Connection', 'close')
       self.send_header('Expires', '-1')
       self.end_headers()
-      self.wfile.write(json.dumps(data))
+      self.wfile.write(json.dumps(data).encode('utf-8'))
       return
     else:
       data = self.rfile.read(int(self.headers['Content-Length']))
       if str is not bytes and isinstance(data, bytes):
         data = data.decode('utf-8')
-      data = data.replace("+", " ")
-      data = unquote_u(data)
-
-      if data == '^pageload^': # Browser is just notifying that it has successfully launched the page.
-        have_received_messages = True
-      elif data.startswith('^exit^'):
-        if not emrun_options.serve_after_exit:
-          page_exit_code = int(data[6:])
-          logv('Web page has quit with a call to exit() with return code ' + str(page_exit_code) + '. Shutting down web server. Pass --serve_after_exit to keep serving even after the page terminates with exit().')
-          self.server.shutdown()
-          return
-      else:
-        # The user page sent a message with POST. Parse the message and log it to stdout/stderr.
-        is_stdout = False
-        is_stderr = False
-        seq_num = -1
-        # The html shell is expected to send messages of form ^out^(number)^(message) or ^err^(number)^(message).
-        if data.startswith('^err^'):
-          is_stderr = True
-        elif data.startswith('^out^'):
-          is_stdout = True
-        if is_stderr or is_stdout:
-          try:
-            i = data.index('^', 5)
-            seq_num = int(data[5:i])
-            data = data[i + 1:]
-          except ValueError:
-            pass
+      # The page batches up its output, so a single POST can carry several
+      # messages, one per line. The message texts themselves are URI-encoded,
+      # so they never contain a newline.
+      exited = False
+      for message in data.split('\n'):
+        message = unquote_u(message.replace('+', ' '))
+        if message == '^pageload^': # Browser is just notifying that it has successfully launched the page.
+          have_received_messages = True
+        elif message.startswith('^exit^'):
+          if not emrun_options.serve_after_exit:
+            page_exit_code = int(message[6:])
+            logv('Web page has quit with a call to exit() with return code ' + str(page_exit_code) + '. Shutting down web server. Pass --serve_after_exit to keep serving even after the page terminates with exit().')
+            exited = True
+        else:
+          self.handle_message(message)
+
+      if exited:
+        self.server.shutdown()
+        self.send_ok(close=True)
+        return
+
+    self.send_ok()
+
+  # The user page sent a message with POST. Parse the message and log it to
+  # stdout/stderr.
+  def handle_message(self, data):
+    is_stdout = False
+    is_stderr = False
+    seq_num = -1
+    # The html shell is expected to send messages of form ^out^(number)^(message) or ^err^(number)^(message).
+    if data.startswith('^err^'):
+      is_stderr = True
+    elif data.startswith('^out^'):
+      is_stdout = True
+    if is_stderr or is_stdout:
+      try:
+        i = data.index('^', 5)
+        seq_num = int(data[5:i])
+        data = data[i + 1:]
+      except ValueError:
+        pass
 
-        log = browser_loge if is_stderr else browser_logi
-        self.server.handle_incoming_message(seq_num, log, data)
+    log = browser_loge if is_stderr else browser_logi
+    self.server.handle_incoming_message(seq_num, log, data)
 
+  def send_ok(self, close=False):
     self.send_response(200)
     self.send_header('Content-type', 'text/plain')
+    self.send_header('Content-Length', '2')
     self.send_header('Cache-Control', 'no-cache, must-revalidate')
-    self.send_header('Connection', 'close')
+    if close:
+      self.send_header('Connection', 'close')
     self.send_header('Expires', '-1')
     self.end_headers()
     self.wfile.write(b'OK')
@@ -795,7 +1114,6 @@ def get_cpu_info():
       physical_cores = sockets * int(re.search(r'Core\(s\) per socket: (.*)', lscpu).group(1).strip())
       logical_cores = physical_cores * int(re.search(r'Thread\(s\) per core: (.*)', lscpu).group(1).strip())
   except Exception as e:
-    import traceback
     loge(traceback.format_exc())
     return {'model': 'Unknown ("' + str(e) + '")',
             'physicalCores': 1,
@@ -1450,6 +1768,179 @@ def list_processes_by_name(exe_full_path):
   return pids
 
 
+# Options that are handled by the parent emrun process when running pages with
+# --pages, and are not passed on to the emrun processes of the pages as is.
+PAGE_FARM_OPTIONS = ['--pages', '--jobs', '--summary', '--port', '--log_stdout', '--log_stderr', '--dump_out_directory', '--browser_args']
+
+
+def read_page_list(filename):
+  """Reads the list of pages to run with --pages. Each line holds a page,
+  optionally followed by arguments to it. Empty lines and lines starting with #
+  are skipped.
+  """
+  pages = []
+  with open(filename) as f:
+    for line in f:
+      line = line.strip()
+      if line and not line.startswith('#'):
+        args = shlex.split(line)
+        pages.append((args[0], args[1:]))
+  return pages
+
+
+def strip_options(args, names):
+  """Removes the given options, which all take a value, from a list of command
+  line arguments.
+  """
+  result = []
+  skip_value = False
+  for arg in args:
+    if skip_value:
+      skip_value = False
+    elif arg.split('=', 1)[0] in names:
+      skip_value = '=' not in arg
+    else:
+      result.append(arg)
+  return result
+
+
+class PageFarm(object):
+  """Runs a list of pages, a number of them at a time. Each page is run by its
+  own emrun process, with its own web server port, browser profile and dump
+  directory. The output of each page is printed with the name of the page as a
+  prefix.
+  """
+  def __init__(self, options, pages, emrun_args):
+    self.options = options
+    self.pages = pages
+    self.jobs = max(min(options.jobs, len(pages)), 1)
+    self.emrun_args = emrun_args
+    browser = (options.browser or '').lower()
+    self.is_chrome = 'chrome' in browser
+    # Firefox refuses to run several instances on the same profile, so give
+    # each page its own.
+    if 'firefox' in browser and self.jobs > 1 and not options.safe_firefox_profile:
+      self.emrun_args = self.emrun_args + ['--safe_firefox_profile']
+
+  def run(self):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    start_time = tick()
+    try:
+      results = loop.run_until_complete(self.run_all(start_time))
+    finally:
+      loop.close()
+    failed = [r for r in results if r['returncode'] != 0]
+    summary = {
+      'jobs': self.jobs,
+      'duration': tick() - start_time,
+      'passed': len(results) - len(failed),
+      'failed': len(failed),
+      'pages': results,
+    }
+    logi('Ran ' + str(len(results)) + ' pages in ' + '%.2f' % summary['duration'] + ' seconds, ' + str(len(failed)) + ' failed.')
+    return summary
+
+  async def run_all(self, start_time):
+    # Pages that run at the same time each need their own port.
+    free_ports = asyncio.Queue()
+    for i in range(self.jobs):
+      free_ports.put_nowait(self.options.port + i)
+
+    async def run_when_free(index, page, args):
+      port = await free_ports.get()
+      try:
+        return await self.run_page(index, page, args, port, start_time)
+      finally:
+        free_ports.put_nowait(port)
+
+    return await asyncio.gather(*[run_when_free(i, page, args) for i, (page, args) in enumerate(self.pages)])
+
+  async def run_page(self, index, page, args, port, start_time):
+    name = ' '.join([page] + args)
+    cmd = [sys.executable, os.path.abspath(__file__)] + self.emrun_args
+    cmd += ['--port=' + str(port), '--dump_out_directory=' + os.path.join(self.options.dump_out_directory, str(index))]
+    browser_args = self.options.browser_args
+    profile_dir = None
+    if self.is_chrome:
+      profile_dir = tempfile.mkdtemp(prefix='emrun_chrome_profile_')
+      browser_args += ' --user-data-dir=' + profile_dir
+    if browser_args:
+      cmd += ['--browser_args=' + browser_args]
+    cmd += [page, '--'] + args
+    logv('Running page "' + name + '": ' + ' '.join(cmd))
+
+    started = tick()
+    try:
+      proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, limit=1024 * 1024)
+      output = asyncio.gather(self.forward_output(proc.stdout, name, browser_logi),
+                              self.forward_output(proc.stderr, name, browser_loge))
+      returncode = await proc.wait()
+      # A browser that emrun left running may still hold on to the output
+      # pipes, so don't wait for them to be closed for long.
+      try:
+        await asyncio.wait_for(output, 1)
+      except asyncio.TimeoutError:
+        pass
+    finally:
+      if profile_dir:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+    duration = tick() - started
+
+    # Exit codes get truncated to 8 bits on POSIX systems.
+    timed_out = returncode in (self.options.timeout_returncode, self.options.timeout_returncode & 0xff)
+    msg = '[' + name + '] quit with exit code ' + str(returncode) + ' in ' + '%.2f' % duration + ' seconds.'
+    if returncode == 0:
+      logi(msg)
+    else:
+      loge(msg)
+    return {
+      'page': page,
+      'args': args,
+      'port': port,
+      'returncode': returncode,
+      'timed_out': timed_out,
+      'start': started - start_time,
+      'duration': duration,
+    }
+
+  async def forward_output(self, stream, name, log):
+    prefix = '[' + name + '] '
+    while True:
+      line = await stream.readline()
+      if not line:
+        return
+      log(prefix + line.decode('utf-8', 'replace').rstrip('\r\n'))
+
+
+def run_page_farm(options):
+  global browser_stdout_handle, browser_stderr_handle
+  if options.serve:
+    loge('A page to run cannot be given along with --pages.')
+    return 1
+  pages = read_page_list(options.pages)
+  if not pages:
+    loge('No pages to run in "' + options.pages + '".')
+    return 1
+
+  if options.log_stdout:
+    browser_stdout_handle = open(options.log_stdout, 'a')
+  if options.log_stderr:
+    if options.log_stderr == options.log_stdout:
+      browser_stderr_handle = browser_stdout_handle
+    else:
+      browser_stderr_handle = open(options.log_stderr, 'a')
+
+  emrun_args = strip_options(sys.argv[1:], PAGE_FARM_OPTIONS)
+  summary = PageFarm(options, pages, emrun_args).run()
+  if options.summary == '-':
+    print_to_handle(sys.stdout, json.dumps(summary, indent=2))
+  elif options.summary:
+    with open(options.summary, 'w') as f:
+      json.dump(summary, f, indent=2)
+  return 1 if summary['failed'] else 0
+
+
 def run():
   global browser_process, browser_exe, processname_killed_atexit, emrun_options, emrun_not_enabled_nag_printed
   usage_str = """\
@@ -1462,7 +1953,9 @@ If you are seeing "unrecognized arguments" when trying to pass
 arguments to your page, remember to add `--` between arguments
 to emrun itself and arguments to your page.
 """
-  parser = argparse.ArgumentParser(usage=usage_str)
+  # Abbreviated options are not accepted, since --pages forwards all options
+  # other than its own to the emrun processes it starts, by their full names.
+  parser = argparse.ArgumentParser(usage=usage_str, allow_abbrev=False)
 
   parser.add_argument('--kill_start', action='store_true',
                       help='If true, any previously running instances of '
@@ -1573,6 +2066,22 @@ to emrun itself and arguments to your page.
   parser.add_argument('--dump_out_directory', default='dump_out', type=str,
                       help='If specified, overrides the directory for dump files using emrun_file_dump method.')
 
+  parser.add_argument('--pages',
+                      help='Runs all the pages listed in the given file, '
+                           'instead of a single page. Each line of the file '
+                           'holds a page to run, optionally followed by '
+                           'arguments to the page.')
+
+  parser.add_argument('--jobs', type=int, default=1,
+                      help='With --pages, specifies how many pages are run at '
+                           'the same time. Each page gets its own browser, '
+                           'served from its own port starting from --port.')
+
+  parser.add_argument('--summary',
+                      help='With --pages, writes a JSON summary of the exit '
+                           'codes and timings of the pages to the given file '
+                           '("-" for stdout).')
+
   parser.add_argument('serve', nargs='?', default='')
 
   parser.add_argument('cmdlineparams', nargs='*')
@@ -1603,6 +2112,9 @@ to emrun itself and arguments to your page.
       list_pc_browsers()
     return
 
+  if options.pages:
+    return run_page_farm(options)
+
   if not options.serve and (options.system_info or options.browser_info):
     # Don't run if only --system_info or --browser_info was passed.
     options.no_server = options.no_browser = True
@@ -11,6 +11,7 @@ headers, for the libc implementation in JS).
 
 from tools.toolchain_profiler import ToolchainProfiler
 
+import hashlib
 import os
 import json
 import subprocess
@@ -21,6 +22,7 @@ import shutil
 from collections import OrderedDict
 
 from tools import building
+from tools import config
 from tools import diagnostics
 from tools import js_manipulation
 from tools import shared
@@ -57,9 +59,10 @@ def compute_minimal_runtime_initializer_and_exports(post, exports, receiving):
 
 
 def write_output_file(outfile, module):
-  for i in range(len(module)): # do this loop carefully to save memory
-    module[i] = normalize_line_endings(module[i])
-    outfile.write(module[i])
+  # `module` can be any iterable of string chunks (including a generator), so
+  # that large sections never need to be joined in memory before being written.
+  for chunk in module:
+    outfile.write(normalize_line_endings(chunk))
 
 
 def optimize_syscalls(declares):
@@ -169,6 +172,35 @@ def apply_static_code_hooks(forwarded_json, code):
   return code
 
 
+def get_settings_defaults_file():
+  """Returns a `(defaults, version, path)` tuple describing the snapshot of the
+  default settings, as seen by the JS compiler.
+
+  The snapshot is written to the cache once (keyed on a hash of its contents)
+  so that each invocation of the JS compiler only needs to be sent the settings
+  that differ from it.  `path` is None if the snapshot file is not available
+  (i.e. with FROZEN_CACHE).
+  """
+  if not hasattr(get_settings_defaults_file, 'result'):
+    defaults = settings.defaults.copy()
+    defaults['LEGACY_SETTINGS'] = [l[0] for l in defaults['LEGACY_SETTINGS']]
+    serialized = json.dumps({'settings': defaults}, separators=(',', ':'))
+    version = hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:16]
+
+    def create_defaults_file(path):
+      with open(path, 'w') as f:
+        json.dump({'version': version, 'settings': defaults}, f, separators=(',', ':'))
+
+    output_name = shared.Cache.get_lib_name(f'settings_defaults_{version}.json', varies=False)
+    if config.FROZEN_CACHE and not shared.Cache.get_path(output_name).exists():
+      defaults_file = None
+    else:
+      defaults_file = shared.Cache.get(output_name, create_defaults_file, what='settings defaults')
+    get_settings_defaults_file.result = (defaults, version, defaults_file)
+
+  return get_settings_defaults_file.result
+
+
 def compile_settings():
   stderr_file = os.environ.get('EMCC_STDERR_FILE')
   if stderr_file:
@@ -181,19 +213,35 @@ def compile_settings():
   # otherwise complex value.
   settings['LEGACY_SETTINGS'] = [l[0] for l in settings['LEGACY_SETTINGS']]
 
+  # Only send the settings that differ from the defaults snapshot, which the JS
+  # compiler loads separately.
+  defaults, version, defaults_file = get_settings_defaults_file()
+  if defaults_file:
+    changed, removed = settings.changed_settings(defaults)
+  else:
+    changed, removed = settings.dict(), []
+    version = None
+
+  temp_files = shared.get_temp_files()
   # Save settings to a file to work around v8 issue 1579
-  with shared.get_temp_files().get_file('.json') as settings_file:
+  with temp_files.get_file('.json') as settings_file, temp_files.get_file('.json') as forwarded_file:
     with open(settings_file, 'w') as s:
-      json.dump(settings.dict(), s, sort_keys=True, indent=2)
+      json.dump({'version': version, 'removed': removed, 'settings': changed}, s, separators=(',', ':'))
 
     # Call js compiler
     env = os.environ.copy()
     env['EMCC_BUILD_DIR'] = os.getcwd()
-    out = shared.run_js_tool(path_from_root('src/compiler.js'),
-                             [settings_file], stdout=subprocess.PIPE, stderr=stderr_file,
-                             cwd=path_from_root('src'), env=env, encoding='utf-8')
-  assert '//FORWARDED_DATA:' in out, 'Did not receive forwarded data in pre output - process failed?'
-  glue, forwarded_data = out.split('//FORWARDED_DATA:')
+    args = [settings_file, forwarded_file]
+    if defaults_file:
+      args.append(defaults_file)
+    glue = shared.run_js_tool(path_from_root('src/compiler.js'),
+                              args, stdout=subprocess.PIPE, stderr=stderr_file,
+                              cwd=path_from_root('src'), env=env, encoding='utf-8')
+    # The JS compiler writes the data that it forwards back to us (e.g. the list
+    # of library functions) to a separate file rather than appending it to the
+    # glue code on stdout.
+    forwarded_data = utils.read_file(forwarded_file)
+  assert forwarded_data, 'Did not receive forwarded data from JS compiler - process failed?'
   return glue, forwarded_data
 
 
@@ -353,15 +401,10 @@ def emscript(in_wasm, out_wasm, outfile_js, memfile):
     t = time.time()
 
   forwarded_json = json.loads(forwarded_data)
+  forwarded_data = None
 
   pre, post = glue.split('// EMSCRIPTEN_END_FUNCS')
-
-  if settings.ASSERTIONS:
-    pre += "function checkIncomingModuleAPI() {\n"
-    for sym in settings.ALL_INCOMING_MODULE_JS_API:
-      if sym not in settings.INCOMING_MODULE_JS_API:
-        pre += f"  ignoredModuleProp('{sym}');\n"
-    pre += "}\n"
+  glue = None
 
   exports = metadata['exports']
 
@@ -381,34 +424,27 @@ def emscript(in_wasm, out_wasm, outfile_js, memfile):
     # In regular runtime, atinits etc. exist in the preamble part
     pre = apply_static_code_hooks(forwarded_json, pre)
 
-  asm_consts = create_asm_consts(metadata)
-  em_js_funcs = create_em_js(metadata)
-  asm_const_pairs = ['%s: %s' % (key, value) for key, value in asm_consts]
-  asm_const_map = 'var ASM_CONSTS = {\n  ' + ',  \n '.join(asm_const_pairs) + '\n};\n'
-  pre = pre.replace(
-    '// === Body ===',
-    ('// === Body ===\n\n' + asm_const_map +
-     '\n'.join(em_js_funcs) + '\n'))
-
   with open(outfile_js, 'w', encoding='utf-8') as out:
-    out.write(normalize_line_endings(pre))
+    # Rather than building up a modified copy of the (potentially very large)
+    # preamble in memory we write it out in sections, inserting the EM_ASM/EM_JS
+    # code directly after the body marker.
+    write_output_file(out, iter_pre_sections(pre, metadata))
     pre = None
 
     invoke_funcs = metadata['invokeFuncs']
     sending = create_sending(invoke_funcs, metadata)
-    receiving = create_receiving(exports)
 
     if settings.MINIMAL_RUNTIME:
       if settings.DECLARE_ASM_MODULE_EXPORTS:
+        receiving = create_receiving(exports)
         post = compute_minimal_runtime_initializer_and_exports(post, exports, receiving)
-      receiving = ''
-
-    module = create_module(sending, receiving, invoke_funcs, metadata)
+      receiving = []
+    else:
+      receiving = iter_receiving(exports)
 
-    write_output_file(out, module)
+    write_output_file(out, iter_module(sending, receiving, invoke_funcs, metadata))
 
     out.write(normalize_line_endings(post))
-    module = None
 
 
 def remove_trailing_zeros(memfile):
@@ -579,6 +615,35 @@ def finalize_wasm(infile, outfile, memfile):
   return metadata
 
 
+def iter_pre_sections(pre, metadata):
+  """Yield the preamble in chunks, with the EM_ASM constants and EM_JS functions
+  inserted after the `// === Body ===` marker."""
+  marker = '// === Body ==='
+  body_start = pre.find(marker)
+  if body_start == -1:
+    yield pre
+  else:
+    body_start += len(marker)
+    yield pre[:body_start]
+    yield '\n\n'
+    asm_consts = create_asm_consts(metadata)
+    asm_const_pairs = ['%s: %s' % (key, value) for key, value in asm_consts]
+    yield 'var ASM_CONSTS = {\n  ' + ',  \n '.join(asm_const_pairs) + '\n};\n'
+    for i, func in enumerate(create_em_js(metadata)):
+      if i:
+        yield '\n'
+      yield func
+    yield '\n'
+    yield pre[body_start:]
+
+  if settings.ASSERTIONS:
+    yield "function checkIncomingModuleAPI() {\n"
+    for sym in settings.ALL_INCOMING_MODULE_JS_API:
+      if sym not in settings.INCOMING_MODULE_JS_API:
+        yield f"  ignoredModuleProp('{sym}');\n"
+    yield "}\n"
+
+
 def create_asm_consts(metadata):
   asm_consts = {}
   for addr, const in metadata['asmConsts'].items():
@@ -773,7 +838,7 @@ def create_sending(invoke_funcs, metadata):
 
 
 def make_export_wrappers(exports, delay_assignment):
-  wrappers = []
+  """Generate the JS wrapper for each wasm export, one at a time."""
   for name in exports:
     # Tags cannot be wrapped in createExportWrapper
     if name == '__cpp_exception':
@@ -786,89 +851,90 @@ def make_export_wrappers(exports, delay_assignment):
       # With assertions enabled we create a wrapper that are calls get routed through, for
       # the lifetime of the program.
       if delay_assignment:
-        wrappers.append('''\
+        yield '''\
 /** @type {function(...*):?} */
 var %(mangled)s = Module["%(mangled)s"] = createExportWrapper("%(name)s");
-''' % {'mangled': mangled, 'name': name})
+''' % {'mangled': mangled, 'name': name}
       else:
-        wrappers.append('''\
+        yield '''\
 /** @type {function(...*):?} */
 var %(mangled)s = Module["%(mangled)s"] = createExportWrapper("%(name)s", asm);
-''' % {'mangled': mangled, 'name': name})
+''' % {'mangled': mangled, 'name': name}
     elif delay_assignment:
       # With assertions disabled the wrapper will replace the global var and Module var on
       # first use.
-      wrappers.append('''\
+      yield '''\
 /** @type {function(...*):?} */
 var %(mangled)s = Module["%(mangled)s"] = function() {
   return (%(mangled)s = Module["%(mangled)s"] = Module["asm"]["%(name)s"]).apply(null, arguments);
 };
-''' % {'mangled': mangled, 'name': name})
+''' % {'mangled': mangled, 'name': name}
     else:
-      wrappers.append('''\
+      yield '''\
 /** @type {function(...*):?} */
 var %(mangled)s = Module["%(mangled)s"] = asm["%(name)s"]
-''' % {'mangled': mangled, 'name': name})
-  return wrappers
+''' % {'mangled': mangled, 'name': name}
 
 
 def create_receiving(exports):
-  # When not declaring asm exports this section is empty and we instead programatically export
-  # symbols on the global object by calling exportAsmFunctions after initialization
-  if not settings.DECLARE_ASM_MODULE_EXPORTS:
-    return ''
-
+  """Assignments of the wasm exports for MINIMAL_RUNTIME (see `iter_receiving`
+  for the regular runtime)."""
+  # In Wasm exports are assigned inside a function to variables
+  # existing in top level JS scope, i.e.
+  # var _main;
+  # WebAssembly.instantiate(Module["wasm"], imports).then((function(output) {
+  # var asm = output.instance.exports;
+  # _main = asm["_main"];
+  assert settings.MINIMAL_RUNTIME
   receiving = []
+  generate_dyncall_assignment = settings.DYNCALLS and '$dynCall' in settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE
+  exports_that_are_not_initializers = [x for x in exports if x != building.WASM_CALL_CTORS]
 
-  # with WASM_ASYNC_COMPILATION that asm object may not exist at this point in time
-  # so we need to support delayed assignment.
-  delay_assignment = settings.WASM_ASYNC_COMPILATION and not settings.MINIMAL_RUNTIME
-  if not delay_assignment:
-    if settings.MINIMAL_RUNTIME:
-      # In Wasm exports are assigned inside a function to variables
-      # existing in top level JS scope, i.e.
-      # var _main;
-      # WebAssembly.instantiate(Module["wasm"], imports).then((function(output) {
-      # var asm = output.instance.exports;
-      # _main = asm["_main"];
-      generate_dyncall_assignment = settings.DYNCALLS and '$dynCall' in settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE
-      exports_that_are_not_initializers = [x for x in exports if x != building.WASM_CALL_CTORS]
-
-      for s in exports_that_are_not_initializers:
-        mangled = asmjs_mangle(s)
-        dynCallAssignment = ('dynCalls["' + s.replace('dynCall_', '') + '"] = ') if generate_dyncall_assignment and mangled.startswith('dynCall_') else ''
-        receiving += [dynCallAssignment + mangled + ' = asm["' + s + '"];']
-    else:
-      receiving += make_export_wrappers(exports, delay_assignment)
-  else:
-    receiving += make_export_wrappers(exports, delay_assignment)
+  for s in exports_that_are_not_initializers:
+    mangled = asmjs_mangle(s)
+    dynCallAssignment = ('dynCalls["' + s.replace('dynCall_', '') + '"] = ') if generate_dyncall_assignment and mangled.startswith('dynCall_') else ''
+    receiving += [dynCallAssignment + mangled + ' = asm["' + s + '"];']
+
+  return '\n  '.join(receiving) + '\n'
 
-  if settings.MINIMAL_RUNTIME:
-    return '\n  '.join(receiving) + '\n'
-  else:
-    return '\n'.join(receiving) + '\n'
 
+def iter_receiving(exports):
+  """Yields the export wrappers for the regular runtime.  When not declaring asm
+  exports this section is empty and we instead programatically export symbols
+  on the global object by calling exportAsmFunctions after initialization."""
+  if not settings.DECLARE_ASM_MODULE_EXPORTS:
+    return
+  # with WASM_ASYNC_COMPILATION that asm object may not exist at this point in
+  # time so we need to support delayed assignment.
+  delay_assignment = settings.WASM_ASYNC_COMPILATION
+  for i, wrapper in enumerate(make_export_wrappers(exports, delay_assignment)):
+    if i:
+      yield '\n'
+    yield wrapper
+  yield '\n'
 
-def create_module(sending, receiving, invoke_funcs, metadata):
-  invoke_wrappers = create_invoke_wrappers(invoke_funcs)
-  receiving += create_named_globals(metadata)
-  module = []
 
-  module.append('var asmLibraryArg = %s;\n' % sending)
+def iter_module(sending, receiving, invoke_funcs, metadata):
+  """Yield the sections of the JS module glue that connect it to the wasm.
+
+  `receiving` is an iterable of chunks (see `iter_receiving`) so that the
+  export wrappers for very large modules are never joined in memory.
+  """
+  yield 'var asmLibraryArg = %s;\n' % sending
   if settings.ASYNCIFY and (settings.ASSERTIONS or settings.ASYNCIFY == 2):
     # instrumenting imports is used in asyncify in two ways: to add assertions
     # that check for proper import use, and for ASYNCIFY=2 we use them to set up
     # the Promise API on the import side.
-    module.append('Asyncify.instrumentWasmImports(asmLibraryArg);\n')
+    yield 'Asyncify.instrumentWasmImports(asmLibraryArg);\n'
 
   if not settings.MINIMAL_RUNTIME:
-    module.append("var asm = createWasm();\n")
+    yield "var asm = createWasm();\n"
 
-  module.append(receiving)
-  module.append(invoke_wrappers)
+  yield from receiving
+  yield create_named_globals(metadata)
+  yield from create_invoke_wrappers(invoke_funcs)
   if settings.MEMORY64:
-    module.append(create_wasm64_wrappers(metadata))
-  return module
+    yield create_wasm64_wrappers(metadata)
 
 
 def load_metadata_json(metadata_raw):
@@ -915,11 +981,9 @@ def load_metadata_json(metadata_raw):
 
 def create_invoke_wrappers(invoke_funcs):
   """Asm.js-style exception handling: invoke wrapper generation."""
-  invoke_wrappers = ''
   for invoke in invoke_funcs:
     sig = strip_prefix(invoke, 'invoke_')
-    invoke_wrappers += '\n' + js_manipulation.make_invoke(sig) + '\n'
-  return invoke_wrappers
+    yield '\n' + js_manipulation.make_invoke(sig) + '\n'
 
 
 def create_wasm64_wrappers(metadata):
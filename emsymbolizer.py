@@ -12,17 +12,26 @@
 # If there is a name section or symbol table, llvm-nm can show the symbol name.
 
 import argparse
+from array import array
+import bisect
 from collections import namedtuple
+from itertools import islice
 import json
+import operator
 import os
+import struct
 import sys
+from subprocess import Popen, PIPE
+from tools import dwarf
 from tools import shared
 from tools import webassembly
-from tools.shared import check_call
 
 LLVM_SYMBOLIZER = os.path.expanduser(
     shared.build_llvm_tool_path(shared.exe_suffix('llvm-symbolizer')))
 
+# Number of addresses that are looked up at a time.
+SYMBOLIZER_BATCH_SIZE = 256
+
 
 class Error(BaseException):
   pass
@@ -42,13 +51,6 @@ def has_debug_line_section(module):
   return False
 
 
-def symbolize_address_dwarf(module, address):
-  vma_adjust = get_codesec_offset(module)
-  cmd = [LLVM_SYMBOLIZER, '-e', module.filename, f'--adjust-vma={vma_adjust}',
-         str(address)]
-  check_call(cmd)
-
-
 def get_sourceMappingURL_section(module):
   for sec in module.sections():
     if sec.name == "sourceMappingURL":
@@ -61,12 +63,30 @@ class WasmSourceMap(object):
   Location = namedtuple('Location',
                         ['source', 'line', 'column', 'name'])
 
+  # The parsed mappings can be saved to an index file next to the source map,
+  # which is much faster to load than parsing the JSON again.  It holds
+  # INDEX_MAGIC, a header with the size and modification time of the source
+  # map it was created from and the lengths of the two parts that follow,
+  # the version, sources and names as JSON, and then the columns below as
+  # little-endian arrays.
+  INDEX_MAGIC = b'EMSMIDX1'
+  INDEX_HEADER = struct.Struct('<QQQQ')
+  INDEX_SUFFIX = '.idx'
+
   def __init__(self):
     self.version = None
     self.sources = []
     self.names = []
-    self.mapping = {}
-    self.offsets = []
+    # The mappings are stored column-wise, sorted by offset.  A value of -1
+    # means the segment didn't have that field.
+    self.offsets = array('I')
+    self.source_ids = array('i')
+    self.lines = array('i')
+    self.columns = array('i')
+    self.name_ids = array('i')
+
+  def columns_list(self):
+    return [self.offsets, self.source_ids, self.lines, self.columns, self.name_ids]
 
   def parse(self, filename):
     with open(filename) as f:
@@ -90,7 +110,7 @@ class WasmSourceMap(object):
       for i, c in enumerate(string):
         try:
           integer = vlq_map[c]
-        except ValueError:
+        except KeyError:
           raise Error(f'Invalid character ({c}) in VLQ')
         value += (integer & 31) << shift
         if integer & 32:
@@ -102,109 +122,377 @@ class WasmSourceMap(object):
           value = shift = 0
       return result
 
+    offsets = self.offsets
+    source_ids = self.source_ids
+    lines = self.lines
+    columns = self.columns
+    name_ids = self.name_ids
+    # The same segments occur over and over again in a source map, so each
+    # distinct one is only decoded once.
+    decoded = {}
     offset = 0
     src = 0
     line = 1
     col = 1
     name = 0
-    for i, segment in enumerate(source_map_json['mappings'].split(',')):
-      data = decodeVLQ(segment)
-      info = []
+    for segment in source_map_json['mappings'].split(','):
+      data = decoded.get(segment)
+      if data is None:
+        data = decoded[segment] = decodeVLQ(segment)
+      length = len(data)
 
       offset += data[0]
-      if len(data) >= 2:
+      offsets.append(offset)
+      if length >= 2:
         src += data[1]
-        info.append(src)
-      if len(data) >= 3:
+      source_ids.append(src if length >= 2 else -1)
+      if length >= 3:
         line += data[2]
-        info.append(line)
-      if len(data) >= 4:
+      lines.append(line if length >= 3 else -1)
+      if length >= 4:
         col += data[3]
-        info.append(col)
-      if len(data) >= 5:
+      columns.append(col if length >= 4 else -1)
+      if length >= 5:
         name += data[4]
-        info.append(name)
-
-      self.mapping[offset] = WasmSourceMap.Location(*info)
-      self.offsets.append(offset)
-    self.offsets.sort()
+      name_ids.append(name if length >= 5 else -1)
+
+    # Mappings are normally sorted already.  If not, a stable sort keeps the
+    # last of several segments with the same offset as the one that is found.
+    if any(map(operator.gt, offsets, islice(offsets, 1, None))):
+      order = sorted(range(len(offsets)), key=offsets.__getitem__)
+      for column in self.columns_list():
+        column[:] = array(column.typecode, map(column.__getitem__, order))
+
+  def read_index(self, filename, stat):
+    with open(filename, 'rb') as f:
+      if f.read(len(self.INDEX_MAGIC)) != self.INDEX_MAGIC:
+        return False
+      size, mtime, json_size, count = self.INDEX_HEADER.unpack(f.read(self.INDEX_HEADER.size))
+      if size != stat.st_size or mtime != stat.st_mtime_ns:
+        return False
+      self.version, self.sources, self.names = json.loads(f.read(json_size).decode('utf-8'))
+      for column in self.columns_list():
+        column.fromfile(f, count)
+        if sys.byteorder == 'big':
+          column.byteswap()
+    return True
+
+  def write_index(self, filename, stat):
+    info = json.dumps([self.version, self.sources, self.names]).encode('utf-8')
+    with open(filename, 'wb') as f:
+      f.write(self.INDEX_MAGIC)
+      f.write(self.INDEX_HEADER.pack(stat.st_size, stat.st_mtime_ns, len(info), len(self.offsets)))
+      f.write(info)
+      for column in self.columns_list():
+        if sys.byteorder == 'big':
+          column = array(column.typecode, column)
+          column.byteswap()
+        column.tofile(f)
+
+  def load(self, filename, use_index=True):
+    """Like parse(), but uses the index file for the source map if it is up to
+    date, and otherwise tries to create it."""
+    if not use_index:
+      self.parse(filename)
+      return
+    index = filename + self.INDEX_SUFFIX
+    stat = os.stat(filename)
+    try:
+      if self.read_index(index, stat):
+        if shared.DEBUG:
+          print(f'Read source map index: {index}')
+        return
+    except (OSError, ValueError, EOFError, struct.error):
+      pass
+    # Start from scratch in case the index was only partially read.
+    self.__init__()
+    self.parse(filename)
+    try:
+      self.write_index(index, stat)
+    except OSError as e:
+      if shared.DEBUG:
+        print(f'Unable to write source map index {index}: {e}')
 
   def find_offset(self, offset):
-    # Find the largest mapped offset <= the search offset
-    lo = 0
-    hi = len(self.offsets)
-
-    while lo < hi:
-      mid = (lo + hi) // 2
-      if self.offsets[mid] > offset:
-        hi = mid
-      else:
-        lo = mid + 1
-    return self.offsets[lo - 1]
+    """Returns the index of the mapping with the largest offset <= the search
+    offset, or -1 if there is none."""
+    return bisect.bisect_right(self.offsets, offset) - 1
 
   def lookup(self, offset):
-    nearest = self.find_offset(offset)
-    assert nearest in self.mapping, 'Sourcemap has an offset with no mapping'
-    info = self.mapping[nearest]
+    i = self.find_offset(offset)
+    if i < 0:
+      return WasmSourceMap.Location(None, None, None, None)
+
+    def get(column, i):
+      value = column[i]
+      return None if value < 0 else value
 
+    source = get(self.source_ids, i)
+    name = get(self.name_ids, i)
     # TODO: it's kind of icky to use Location for both the internal indexed
     # location and external string version. Once we have more uniform output
     # format and API for the various backends (e.g SM vs DWARF vs others), this
     # could be improved.
     return WasmSourceMap.Location(
-        self.sources[info.source] if info.source is not None else None,
-        info.line,
-        info.column,
-        self.names[info.name] if info.name is not None else None)
-
-
-def symbolize_address_sourcemap(module, address, force_file):
-  URL = force_file
-  if not URL:
-    # If a sourcemap file is not forced, read it from the wasm module
-    section = get_sourceMappingURL_section(module)
-    assert section
-    module.seek(section.offset)
-    assert module.read_string() == 'sourceMappingURL'
-    # TODO: support stripping/replacing a prefix from the URL
-    URL = module.read_string()
-
-  if shared.DEBUG:
-    print(f'Source Mapping URL: {URL}')
-  sm = WasmSourceMap()
-  sm.parse(URL)
-  if shared.DEBUG:
-    csoff = get_codesec_offset(module)
-    print(sm.mapping)
-    # Print with section offsets to easily compare against dwarf
-    for k, v in sm.mapping.items():
-      print(f'{k-csoff:x}: {v}')
-  print(sm.lookup(address))
+        self.sources[source] if source is not None else None,
+        get(self.lines, i),
+        get(self.columns, i),
+        self.names[name] if name is not None else None)
+
+
+Location = WasmSourceMap.Location
+
+
+class DwarfSymbolizer(object):
+  """Looks up addresses in the DWARF info with llvm-symbolizer, which is kept
+  running in interactive mode so that any number of lookups only cost a single
+  process."""
+  name = 'dwarf'
+
+  def __init__(self, module):
+    self.filename = module.filename
+    self.vma_adjust = get_codesec_offset(module)
+    self.process = None
+
+  def symbolize(self, addresses):
+    if not self.process:
+      cmd = [LLVM_SYMBOLIZER, '-e', self.filename,
+             f'--adjust-vma={self.vma_adjust}', '--output-style=JSON']
+      self.process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+    results = []
+    # Addresses are sent in small batches, which always fit in the pipe
+    # buffer, and the results are read back before sending more.
+    for i in range(0, len(addresses), SYMBOLIZER_BATCH_SIZE):
+      batch = addresses[i:i + SYMBOLIZER_BATCH_SIZE]
+      self.process.stdin.write(''.join(f'{address}\n' for address in batch))
+      self.process.stdin.flush()
+      for address in batch:
+        line = self.process.stdout.readline()
+        if not line:
+          raise Error(f'llvm-symbolizer exited unexpectedly (looking up {address})')
+        result = json.loads(line)
+        if 'Error' in result:
+          raise Error(result['Error']['Message'])
+        results.append([Location(s['FileName'] or None, s['Line'], s['Column'],
+                                 s['FunctionName'] or None)
+                        for s in result['Symbol']])
+    return results
+
+  @staticmethod
+  def format(frames):
+    # Same as the default output style of llvm-symbolizer
+    lines = []
+    for frame in frames:
+      lines.append(frame.name or '??')
+      lines.append(f'{frame.source or "??"}:{frame.line}:{frame.column}')
+    return '\n'.join(lines) + '\n'
+
+  def close(self):
+    if self.process:
+      self.process.stdin.close()
+      self.process.wait()
+      self.process = None
+
+
+class DwarfLineSymbolizer(DwarfSymbolizer):
+  """Looks up addresses in the DWARF line table, which is read directly from
+  the wasm file.  This is used when llvm-symbolizer isn't available, and only
+  gives the file, line and column of each address, without the function name
+  or inlined frames."""
+  def __init__(self, module):
+    self.codesec_offset = get_codesec_offset(module)
+    try:
+      table = dwarf.read_line_table(module.filename)
+    except dwarf.DwarfError as e:
+      raise Error(f'Unable to read DWARF line table: {e}')
+    # Sort the rows by address, with the end of a sequence coming before a
+    # sequence that starts at the same address.
+    address = table.address
+    self.table = table.select(sorted(range(len(address)),
+                                     key=lambda i: (address[i], not table.end_sequence[i])))
+
+  def symbolize(self, addresses):
+    table = self.table
+    results = []
+    for address in addresses:
+      i = bisect.bisect_right(table.address, address - self.codesec_offset) - 1
+      if i < 0 or table.end_sequence[i]:
+        results.append([Location(None, 0, 0, None)])
+      else:
+        results.append([Location(table.files[table.file[i]], table.line[i], table.column[i], None)])
+    return results
+
+  def close(self):
+    pass
+
+
+class SourceMapSymbolizer(object):
+  """Looks up addresses in the source map of a wasm file."""
+  name = 'sourcemap'
+
+  def __init__(self, module, force_file, use_index=True):
+    URL = force_file
+    if not URL:
+      # If a sourcemap file is not forced, read it from the wasm module
+      section = get_sourceMappingURL_section(module)
+      assert section
+      module.seek(section.offset)
+      assert module.read_string() == 'sourceMappingURL'
+      # TODO: support stripping/replacing a prefix from the URL
+      URL = module.read_string()
+
+    if shared.DEBUG:
+      print(f'Source Mapping URL: {URL}')
+    self.sm = WasmSourceMap()
+    self.sm.load(URL, use_index)
+    if shared.DEBUG:
+      csoff = get_codesec_offset(module)
+      # Print with section offsets to easily compare against dwarf
+      for offset in self.sm.offsets:
+        print(f'{offset-csoff:x}: {self.sm.lookup(offset)}')
+
+  def symbolize(self, addresses):
+    return [[self.sm.lookup(address)] for address in addresses]
+
+  @staticmethod
+  def format(frames):
+    return '\n'.join(str(frame) for frame in frames)
+
+  def close(self):
+    pass
+
+
+FORMATTERS = {
+  DwarfSymbolizer.name: DwarfSymbolizer.format,
+  SourceMapSymbolizer.name: SourceMapSymbolizer.format,
+}
+
+# The symbolizers created for each wasm file so far.  They are reused for
+# later lookups in the same file, as long as it hasn't changed.
+symbolizers_cache = {}
+
+
+def get_symbolizers(wasm_file, source=(), force_file=None, use_index=True):
+  """Returns the symbolizers to use for the given wasm file, and the offset of
+  its code section."""
+  key = (os.path.abspath(wasm_file), source, force_file, use_index)
+  mtime = os.stat(wasm_file).st_mtime_ns
+  cached = symbolizers_cache.get(key)
+  if cached and cached[0] == mtime:
+    return cached[1:]
+  if cached:
+    for symbolizer in cached[1]:
+      symbolizer.close()
+
+  module = webassembly.Module(wasm_file)
+  symbolizers = []
+  if ((has_debug_line_section(module) and not source) or
+     'dwarf' in source):
+    if os.path.exists(LLVM_SYMBOLIZER):
+      symbolizers.append(DwarfSymbolizer(module))
+    else:
+      symbolizers.append(DwarfLineSymbolizer(module))
+
+  if ((get_sourceMappingURL_section(module) and not source) or
+     'sourcemap' in source):
+    symbolizers.append(SourceMapSymbolizer(module, force_file, use_index))
+
+  if not symbolizers:
+    raise Error('No .debug_line or sourceMappingURL section found in '
+                f'{module.filename}.'
+                " I don't know how to symbolize this file yet")
+  symbolizers_cache[key] = (mtime, symbolizers, get_codesec_offset(module))
+  return symbolizers, get_codesec_offset(module)
 
 
-def main(args):
-  module = webassembly.Module(args.wasm_file)
-  base = 16 if args.address.lower().startswith('0x') else 10
-  address = int(args.address, base)
-  symbolized = 0
+def close_symbolizers():
+  for _, symbolizers, _ in symbolizers_cache.values():
+    for symbolizer in symbolizers:
+      symbolizer.close()
+  symbolizers_cache.clear()
 
-  if args.addrtype == 'code':
-    address += get_codesec_offset(module)
 
-  if ((has_debug_line_section(module) and not args.source) or
-     'dwarf' in args.source):
-    symbolize_address_dwarf(module, address)
-    symbolized += 1
+def symbolize(wasm_file, addresses, addrtype='file', **kwargs):
+  """Looks up the given addresses in a wasm file.  Returns a list with one dict
+  per address, mapping the name of each kind of debug info that was used to
+  the list of frames (innermost first) found for the address."""
+  symbolizers, codesec_offset = get_symbolizers(wasm_file, **kwargs)
+  if addrtype == 'code':
+    addresses = [address + codesec_offset for address in addresses]
+  results = [{} for _ in addresses]
+  for symbolizer in symbolizers:
+    for result, frames in zip(results, symbolizer.symbolize(addresses)):
+      result[symbolizer.name] = frames
+  return results
 
-  if ((get_sourceMappingURL_section(module) and not args.source) or
-     'sourcemap' in args.source):
-    symbolize_address_sourcemap(module, address, args.file)
-    symbolized += 1
 
-  if not symbolized:
-    raise Error('No .debug_line or sourceMappingURL section found in '
-                f'{module.filename}.'
-                " I don't know how to symbolize this file yet")
+def parse_address(address):
+  base = 16 if address.lower().startswith('0x') else 10
+  try:
+    return int(address, base)
+  except ValueError:
+    raise Error(f'Invalid address: {address}')
+
+
+def read_requests(args):
+  """Yields (wasm_file, address) for each address to look up: first those on
+  the command line, and then those in the --batch file.  Each line of that
+  holds an address, optionally preceded by the wasm file to look it up in."""
+  for address in args.address:
+    yield args.wasm_file, address
+  if not args.batch:
+    return
+  f = sys.stdin if args.batch == '-' else open(args.batch)
+  with f:
+    for line in f:
+      fields = line.split()
+      if not fields:
+        continue
+      if len(fields) == 1:
+        yield args.wasm_file, fields[0]
+      elif len(fields) == 2:
+        yield fields[0], fields[1]
+      else:
+        raise Error(f'Invalid line in {args.batch}: {line.strip()}')
+
+
+def main(args):
+  if not args.address and not args.batch:
+    raise Error('No addresses given')
+  options = {
+    'source': args.source,
+    'force_file': args.file,
+    'use_index': not args.no_index,
+  }
+  try:
+    requests = read_requests(args)
+    while True:
+      # Look up the requests a batch at a time, grouped by wasm file.
+      batch = list(islice(requests, SYMBOLIZER_BATCH_SIZE))
+      if not batch:
+        break
+      by_file = {}
+      for wasm_file, address in batch:
+        by_file.setdefault(wasm_file, []).append(address)
+      results = {}
+      for wasm_file, addresses in by_file.items():
+        found = symbolize(wasm_file, [parse_address(a) for a in addresses],
+                          args.addrtype, **options)
+        results[wasm_file] = iter(found)
+
+      for wasm_file, address in batch:
+        result = next(results[wasm_file])
+        if args.json:
+          output = {'wasm': wasm_file, 'address': address}
+          for name, frames in result.items():
+            output[name] = [frame._asdict() for frame in frames]
+          print(json.dumps(output))
+        else:
+          for name, frames in result.items():
+            print(FORMATTERS[name](frames))
+        sys.stdout.flush()
+  finally:
+    close_symbolizers()
 
 
 def get_args():
@@ -218,8 +506,17 @@ def get_args():
                       help='Address type (code section or file offset)')
   parser.add_argument('-v', '--verbose', action='store_true',
                       help='Print verbose info for debugging this script')
+  parser.add_argument('--no-index', action='store_true',
+                      help="Don't read or write an index file next to the "
+                      'source map, for faster loading')
+  parser.add_argument('--batch', metavar='FILE',
+                      help='Read more addresses to lookup from FILE (or stdin '
+                      'if FILE is -), one per line.  Each address can be '
+                      'preceded by the wasm file to look it up in')
+  parser.add_argument('--json', action='store_true',
+                      help='Print one JSON object per address')
   parser.add_argument('wasm_file', help='Wasm file')
-  parser.add_argument('address', help='Address to lookup')
+  parser.add_argument('address', nargs='*', help='Address(es) to lookup')
   args = parser.parse_args()
   if args.verbose:
     shared.PRINT_STAGES = 1
@@ -41,12 +41,30 @@ function load(f) {
 // Basic utilities
 load('utility.js');
 
-// Load settings from JSON passed on the command line
+global.writeFile = (filename, contents) => {
+  fs.writeFileSync(filename, contents);
+};
+
+// Load settings from JSON passed on the command line.  The settings file only
+// contains the settings that differ from the defaults snapshot (if one is
+// given), which is versioned so that we never mix up the two.
 const settingsFile = process['argv'][2];
 assert(settingsFile);
+// The data we forward back to emscripten.py is written to this file.
+global.forwardedDataFile = process['argv'][3];
+assert(forwardedDataFile);
+const defaultsFile = process['argv'][4];
 
 const settings = JSON.parse(read(settingsFile));
-Object.assign(global, settings);
+if (defaultsFile) {
+  const defaults = JSON.parse(read(defaultsFile));
+  assert(defaults.version === settings.version, `settings defaults version mismatch: ${defaults.version} vs ${settings.version}`);
+  Object.assign(global, defaults.settings);
+  for (const name of settings.removed) {
+    delete global[name];
+  }
+}
+Object.assign(global, settings.settings);
 
 EXPORTED_FUNCTIONS = new Set(EXPORTED_FUNCTIONS);
 WASM_EXPORTS = new Set(WASM_EXPORTS);
@@ -8,39 +8,76 @@
  */
 
 if (typeof window == "object" && (typeof ENVIRONMENT_IS_PTHREAD == 'undefined' || !ENVIRONMENT_IS_PTHREAD)) {
+  // When C code exit()s, we may still have remaining stdout and stderr
+  // messages and file dumps in flight. In that case, we can't close the
+  // browser until all those XHRs have finished, so the following state
+  // variables track that all communication is done, after which we can close.
+  var emrun_num_post_messages_in_flight = 0;
+  var emrun_should_close_itself = false;
+  var emrun_postExit = (msg) => {
+    var http = new XMLHttpRequest();
+    // Don't do this immediately, this may race with the notification about
+    // the return code reaching the server. Send a *sync* xhr so that we know
+    // for sure that the server has gotten the return code before we continue.
+    http.open("POST", "stdio.html", false);
+    http.send(msg);
+    try {
+      // Try closing the current browser window, since it exit()ed itself.
+      // This can shut down the browser process and then emrun does not need
+      // to kill the whole browser process.
+      window.close();
+    } catch(e) {}
+  };
+  // POSTs msg to the given url of the emrun web server, "stdio.html" by
+  // default. Calls onload, if given, once the request is done.
+  var emrun_post = (msg, url, onload) => {
+    var http = new XMLHttpRequest();
+    ++emrun_num_post_messages_in_flight;
+    http.onreadystatechange = () => {
+      if (http.readyState == 4 /*DONE*/) {
+        // Called first, so that a request made by onload keeps us from
+        // closing.
+        if (onload) onload();
+        if (--emrun_num_post_messages_in_flight == 0 && emrun_should_close_itself) {
+          emrun_postExit('^exit^'+EXITSTATUS);
+        }
+      }
+    }
+    http.open("POST", url || "stdio.html", true);
+    http.send(msg);
+  };
+
   var emrun_register_handlers = () => {
-    // When C code exit()s, we may still have remaining stdout and stderr
-    // messages in flight. In that case, we can't close the browser until all
-    // those XHRs have finished, so the following state variables track that all
-    // communication is done, after which we can close.
-    var emrun_num_post_messages_in_flight = 0;
-    var emrun_should_close_itself = false;
-    var postExit = (msg) => {
-      var http = new XMLHttpRequest();
-      // Don't do this immediately, this may race with the notification about
-      // the return code reaching the server. Send a *sync* xhr so that we know
-      // for sure that the server has gotten the return code before we continue.
-      http.open("POST", "stdio.html", false);
-      http.send(msg);
-      try {
-        // Try closing the current browser window, since it exit()ed itself.
-        // This can shut down the browser process and then emrun does not need
-        // to kill the whole browser process.
-        window.close();
-      } catch(e) {}
+    // Printed lines are not posted one by one, but buffered up and sent in
+    // batches, one message per line, so that chatty programs are not throttled
+    // by the number of requests. A batch is sent once it grows large enough,
+    // or shortly after the last line was printed.
+    var emrun_buffered_messages = [];
+    var emrun_buffered_size = 0;
+    var emrun_flush_timer = 0;
+    var emrun_last_flush_time = Date.now();
+    var flush = () => {
+      if (emrun_flush_timer) {
+        clearTimeout(emrun_flush_timer);
+        emrun_flush_timer = 0;
+      }
+      emrun_last_flush_time = Date.now();
+      if (emrun_buffered_messages.length) {
+        emrun_post(emrun_buffered_messages.join('\n'));
+        emrun_buffered_messages = [];
+        emrun_buffered_size = 0;
+      }
     };
-    var post = (msg) => {
-      var http = new XMLHttpRequest();
-      ++emrun_num_post_messages_in_flight;
-      http.onreadystatechange = () => {
-        if (http.readyState == 4 /*DONE*/) {
-          if (--emrun_num_post_messages_in_flight == 0 && emrun_should_close_itself) {
-            postExit('^exit^'+EXITSTATUS);
-          }
-        }
+    var postBuffered = (msg) => {
+      emrun_buffered_messages.push(msg);
+      emrun_buffered_size += msg.length;
+      // Also check the time here, since a page that prints a lot without ever
+      // returning to the event loop would never get to run the timer.
+      if (emrun_buffered_size >= 65536 || Date.now() - emrun_last_flush_time >= 100) {
+        flush();
+      } else if (!emrun_flush_timer) {
+        emrun_flush_timer = setTimeout(flush, 10);
       }
-      http.open("POST", "stdio.html", true);
-      http.send(msg);
     };
     // If the address contains localhost, or we are running the page from port
     // 6931, we can assume we're running the test runner and should post stdout
@@ -50,18 +87,19 @@ if (typeof window == "object" && (typeof ENVIRONMENT_IS_PTHREAD == 'undefined' |
       var prevPrint = out;
       var prevErr = err;
       addOnExit(() => {
+        flush();
         if (emrun_num_post_messages_in_flight == 0) {
-          postExit('^exit^'+EXITSTATUS);
+          emrun_postExit('^exit^'+EXITSTATUS);
         } else {
           emrun_should_close_itself = true;
         }
       });
       out = (text) => {
-        post('^out^'+(emrun_http_sequence_number++)+'^'+encodeURIComponent(text));
+        postBuffered('^out^'+(emrun_http_sequence_number++)+'^'+encodeURIComponent(text));
         prevPrint(text);
       };
       err = (text) => {
-        post('^err^'+(emrun_http_sequence_number++)+'^'+encodeURIComponent(text));
+        postBuffered('^err^'+(emrun_http_sequence_number++)+'^'+encodeURIComponent(text));
         prevErr(text);
       };
 
@@ -69,7 +107,7 @@ if (typeof window == "object" && (typeof ENVIRONMENT_IS_PTHREAD == 'undefined' |
       // page. Note that we may need to wait for the server to be ready.
       var tryToSendPageload = () => {
         try {
-          post('^pageload^');
+          emrun_post('^pageload^');
         } catch (e) {
           setTimeout(tryToSendPageload, 50);
         }
@@ -82,11 +120,30 @@ if (typeof window == "object" && (typeof ENVIRONMENT_IS_PTHREAD == 'undefined' |
   // emrun-based web server.
   // To use from C code, call e.g:
   //   EM_ASM({emrun_file_dump("file.dat", HEAPU8.subarray($0, $0 + $1));}, my_data_pointer, my_data_pointer_byte_length);
-  var emrun_file_dump = (filename, data) => {
-    var http = new XMLHttpRequest();
+  // Typed arrays are sent in chunks, one after the other, which the server
+  // writes to disk as they arrive, so that dumping large amounts of data does
+  // not need a copy of all of it in flight. The optional options object can
+  // have the fields:
+  //   append: If true, the data is appended to the file instead of
+  //           overwriting it, e.g. to write out a trace over time.
+  //   compress: If true, the server gzips the data into the file.
+  var emrun_file_dump = (filename, data, options) => {
+    options = options || {};
     out('Dumping out file "' + filename + '" with ' + data.length + ' bytes of data.');
-    http.open("POST", "stdio.html?file=" + filename, true);
-    http.send(data); // XXX  this does not work in workers, for some odd reason (issue #2681)
+    var url = "stdio.html?file=" + encodeURIComponent(filename) + (options.compress ? "&compress=gzip" : "");
+    if (!data.subarray) {
+      emrun_post(data, url + (options.append ? "&append=1" : "")); // XXX  this does not work in workers, for some odd reason (issue #2681)
+      return;
+    }
+    var chunkLength = (16 * 1024 * 1024) / (data.BYTES_PER_ELEMENT || 1);
+    var offset = 0;
+    var sendChunk = () => {
+      var chunk = data.subarray(offset, offset + chunkLength);
+      var append = options.append || offset > 0;
+      offset += chunk.length;
+      emrun_post(chunk, url + (append ? "&append=1" : ""), offset < data.length ? sendChunk : null);
+    };
+    sendChunk();
   };
 
   if (typeof Module != 'undefined' && typeof document != 'undefined') {
@@ -521,7 +521,11 @@ function ${name}(${args}) {
 
     print(processMacros(preprocess(shellParts[1], shellFile)));
 
-    print('\n//FORWARDED_DATA:' + JSON.stringify({
+    // Terminate the glue code output with a final newline.  The forwarded data
+    // itself is written to a separate file, rather than to stdout, so that the
+    // caller doesn't need to search for it in the output.
+    print('');
+    writeFile(forwardedDataFile, JSON.stringify({
       libraryFunctions: libraryFunctions,
       ATINITS: ATINITS.join('\n'),
       ATMAINS: ATMAINS.join('\n'),
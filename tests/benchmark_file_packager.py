@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Copyright 2022 The Emscripten Authors.  All rights reserved.
+# Emscripten is available under two separate licenses, the MIT license and the
+# University of Illinois/NCSA Open Source License.  Both these licenses can be
+# found in the LICENSE file.
+
+"""Times tools/file_packager.py on a large number of small files.
+
+Usage: tests/benchmark_file_packager.py [NUM_FILES]
+
+By default 50000 files are packaged, which is the kind of asset tree where the
+per-file overhead of the packager dominates.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+__rootpath__ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(__rootpath__)
+
+from tools.shared import FILE_PACKAGER, run_process
+
+FILES_PER_DIR = 1000
+
+MODES = [
+  ('embed (object file)', ['--embed', 'assets', '--obj-output=out.o']),
+  ('embed (JS)', ['--embed', 'assets', '--js-output=out.js']),
+  ('preload', ['--preload', 'assets', '--js-output=out.js']),
+]
+
+
+def create_files(num_files):
+  for i in range(num_files):
+    dirname = os.path.join('assets', 'dir%d' % (i // FILES_PER_DIR))
+    if i % FILES_PER_DIR == 0:
+      os.makedirs(dirname)
+    with open(os.path.join(dirname, 'file%d.txt' % i), 'w') as f:
+      f.write('contents of file %d\n' % i * (i % 10 + 1))
+
+
+def main(args):
+  num_files = int(args[0]) if args else 50000
+  temp_dir = tempfile.mkdtemp(prefix='benchmark_file_packager_')
+  os.chdir(temp_dir)
+  try:
+    create_files(num_files)
+    print('packaging %d files' % num_files)
+    for name, mode_args in MODES:
+      start = time.time()
+      run_process([FILE_PACKAGER, 'out.data'] + mode_args, stderr=open(os.devnull, 'w'))
+      print('%-20s: %.2f seconds' % (name, time.time() - start))
+  finally:
+    os.chdir(__rootpath__)
+    shutil.rmtree(temp_dir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
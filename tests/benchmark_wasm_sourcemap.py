@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Copyright 2022 The Emscripten Authors.  All rights reserved.
+# Emscripten is available under two separate licenses, the MIT license and the
+# University of Illinois/NCSA Open Source License.  Both these licenses can be
+# found in the LICENSE file.
+
+"""Times tools/wasm-sourcemap.py on a wasm file with a large line table.
+
+Usage: tests/benchmark_wasm_sourcemap.py [NUM_ROWS]
+
+The wasm file is synthesized with a .debug_line section holding NUM_ROWS
+rows (3 million by default), spread over functions in a few hundred source
+files, which is roughly what a big C++ application built with -g produces.
+"""
+
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+__rootpath__ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(__rootpath__)
+
+from tools.shared import run_process
+from tools.utils import path_from_root
+from tools.webassembly import to_leb
+
+NUM_FILES = 500
+FUNCTIONS_PER_UNIT = 2000
+OPCODE_BASE = 13
+LINE_BASE = -5
+LINE_RANGE = 14
+
+
+def section(section_id, contents):
+  return bytes([section_id]) + to_leb(len(contents)) + contents
+
+
+def custom_section(name, contents):
+  name = name.encode('utf-8')
+  return section(0, to_leb(len(name)) + name + contents)
+
+
+def sleb(value):
+  result = bytearray()
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+      result.append(byte)
+      return bytes(result)
+    result.append(byte | 0x80)
+
+
+def line_program_unit(functions):
+  header = bytearray()
+  header += struct.pack('<BBBbBB', 1, 1, 1, LINE_BASE, LINE_RANGE, OPCODE_BASE)
+  header += bytes([0, 1, 1, 1, 1, 0, 0, 0, 1, 0, 0, 1])
+  header += b'/src/project\0\0'
+  for i in range(NUM_FILES):
+    header += b'file%d.cpp\0\1\0\0' % i
+  header += b'\0'
+
+  program = bytearray()
+  for address, rows in functions:
+    program += b'\0\5\2' + struct.pack('<I', address)
+    for file, line_delta, column, address_delta in rows:
+      program += bytes([4]) + to_leb(file + 1)
+      program += bytes([5]) + to_leb(column)
+      if line_delta:
+        program += bytes([3]) + sleb(line_delta)
+      program += bytes([OPCODE_BASE - LINE_BASE + LINE_RANGE * address_delta])
+    program += b'\2\1\0\1\1'
+
+  header_length = struct.pack('<I', len(header))
+  unit = struct.pack('<H', 4) + header_length + header + program
+  return struct.pack('<I', len(unit)) + unit
+
+
+def create_wasm(filename, num_rows):
+  random.seed(42)
+  units = []
+  functions = []
+  address = 5
+  rows_left = num_rows
+  while rows_left > 0:
+    count = min(rows_left, random.randint(2, 40))
+    rows_left -= count
+    file = random.randrange(NUM_FILES)
+    rows = []
+    line = 1
+    for _ in range(count):
+      line_delta = random.randint(-min(line - 1, 3), 10)
+      line += line_delta
+      rows.append((file, line_delta, random.randint(0, 80), random.randint(1, 10)))
+    functions.append((address, rows))
+    address += sum(r[3] for r in rows) + 1
+    if len(functions) == FUNCTIONS_PER_UNIT:
+      units.append(line_program_unit(functions))
+      functions = []
+  if functions:
+    units.append(line_program_unit(functions))
+
+  with open(filename, 'wb') as f:
+    f.write(b'\0asm\1\0\0\0')
+    f.write(section(10, b'\0'))
+    f.write(custom_section('.debug_line', b''.join(units)))
+
+
+def main(args):
+  num_rows = int(args[0]) if args else 3000000
+  temp_dir = tempfile.mkdtemp(prefix='benchmark_wasm_sourcemap_')
+  os.chdir(temp_dir)
+  try:
+    create_wasm('test.wasm', num_rows)
+    print('%d line table rows (%d MB of .debug_line)' % (num_rows, os.path.getsize('test.wasm') // (1024 * 1024)))
+    start = time.time()
+    run_process([sys.executable, path_from_root('tools/wasm-sourcemap.py'), 'test.wasm', '-o', 'test.wasm.map', '--basepath=/src'])
+    print('wasm-sourcemap.py: %.2f seconds' % (time.time() - start))
+    # Note: ru_maxrss is in kilobytes on linux, but bytes on macOS.
+    print('peak memory: %d MB' % (resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // 1024))
+  finally:
+    os.chdir(__rootpath__)
+    shutil.rmtree(temp_dir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -3,10 +3,12 @@
 # University of Illinois/NCSA Open Source License.  Both these licenses can be
 # found in the LICENSE file.
 
-import math
+import json
 import os
+import platform
 import re
 import shutil
+import statistics
 import sys
 import time
 import unittest
@@ -33,7 +35,27 @@ from tools import building
 # 5: 10 seconds
 DEFAULT_ARG = '4'
 
-TEST_REPS = 5
+# Each benchmark is run at least TEST_REPS times, and then more (up to
+# MAX_REPS) until the 95% confidence interval of the mean is within
+# TARGET_PRECISION of it.  The first WARMUP_REPS runs are not timed.
+TEST_REPS = int(os.environ.get('EMBENCH_REPS', '5'))
+MAX_REPS = int(os.environ.get('EMBENCH_MAX_REPS', '30'))
+TARGET_PRECISION = float(os.environ.get('EMBENCH_PRECISION', '0.02'))
+WARMUP_REPS = int(os.environ.get('EMBENCH_WARMUP', '1'))
+
+# Comma separated list of CPUs to run the benchmarks on, e.g. "2,3" (linux
+# only).  Pinning them to CPUs that are otherwise idle reduces noise.
+CPU_AFFINITY = os.environ.get('EMBENCH_CPUS')
+
+# If set, the results and the environment they were measured in are written
+# to this file as JSON.
+RESULTS_FILE = os.environ.get('EMBENCH_RESULTS')
+
+# Two-sided 95% critical values of Student's t-distribution, by degrees of
+# freedom.  Beyond the table the normal distribution is close enough.
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
 
 # by default, run just core benchmarks
 CORE_BENCHMARKS = True
@@ -63,26 +85,71 @@ class Benchmarker():
     pass
 
   def bench(self, args, output_parser=None, reps=TEST_REPS, expected_output=None):
-    self.times = []
-    self.reps = reps
-    for i in range(reps):
-      start = time.time()
-      output = self.run(args)
-      if expected_output is not None and expected_output not in output:
-        raise ValueError('Incorrect benchmark output:\n' + output)
-
-      if not output_parser or args == ['0']: # if arg is 0, we are not running code, and have no output to parse
-        if IGNORE_COMPILATION:
-          curr = float(re.search(r'took +([\d\.]+) milliseconds', output).group(1)) / 1000
-        else:
-          curr = time.time() - start
-      else:
-        try:
-          curr = output_parser(output)
-        except Exception as e:
-          print(str(e))
-          print('Parsing benchmark results failed, output was: ' + output)
-      self.times.append(curr)
+    old_affinity = None
+    if CPU_AFFINITY:
+      # Subprocesses inherit the affinity, so this pins the benchmark itself.
+      old_affinity = os.sched_getaffinity(0)
+      os.sched_setaffinity(0, [int(cpu) for cpu in CPU_AFFINITY.split(',')])
+    try:
+      for i in range(WARMUP_REPS):
+        self.run_once(args, output_parser, expected_output)
+      self.times = []
+      while len(self.times) < max(reps, MAX_REPS):
+        self.times.append(self.run_once(args, output_parser, expected_output))
+        stats = self.stats()
+        if len(self.times) >= reps and stats['ci95'] <= TARGET_PRECISION * stats['mean']:
+          break
+      self.reps = len(self.times)
+    finally:
+      if old_affinity:
+        os.sched_setaffinity(0, old_affinity)
+
+  def run_once(self, args, output_parser, expected_output):
+    start = time.perf_counter_ns()
+    output = self.run(args)
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    if expected_output is not None and expected_output not in output:
+      raise ValueError('Incorrect benchmark output:\n' + output)
+
+    if not output_parser or args == ['0']: # if arg is 0, we are not running code, and have no output to parse
+      if IGNORE_COMPILATION:
+        return float(re.search(r'took +([\d\.]+) milliseconds', output).group(1)) / 1000
+      return elapsed
+    try:
+      return output_parser(output)
+    except Exception as e:
+      print(str(e))
+      print('Parsing benchmark results failed, output was: ' + output)
+      raise
+
+  # Returns the statistics of the times measured, after removing outliers:
+  # times whose modified z-score (based on the median absolute deviation) is
+  # above 3.5, which are usually caused by something else running on the
+  # machine.
+  def stats(self):
+    median = statistics.median(self.times)
+    mad = statistics.median(abs(t - median) for t in self.times)
+    if mad:
+      times = [t for t in self.times if 0.6745 * abs(t - median) / mad <= 3.5]
+    else:
+      times = self.times
+    mean = statistics.mean(times)
+    std = statistics.stdev(times) if len(times) > 1 else 0
+    t = T_95[len(times) - 2] if len(times) - 1 <= len(T_95) else 1.96
+    return {
+      'mean': mean,
+      'median': statistics.median(times),
+      'std': std,
+      'min': min(times),
+      'max': max(times),
+      'ci95': t * std / len(times) ** 0.5 if len(times) > 1 else float('inf'),
+      'outliers': len(self.times) - len(times),
+    }
+
+  def get_sizes(self):
+    size = sum(os.path.getsize(f) for f in self.get_output_files())
+    gzip_size = sum(len(zlib.compress(read_binary(f))) for f in self.get_output_files())
+    return size, gzip_size
 
   def display(self, baseline=None):
     # speed
@@ -90,36 +157,36 @@ class Benchmarker():
     if self.times:
       if baseline == self:
         baseline = None
-      mean = sum(self.times) / len(self.times)
-      squared_times = [x * x for x in self.times]
-      mean_of_squared = sum(squared_times) / len(self.times)
-      std = math.sqrt(mean_of_squared - mean * mean)
-      sorted_times = sorted(self.times)
-      count = len(sorted_times)
-      if count % 2 == 0:
-        median = sum(sorted_times[count // 2 - 1:count // 2 + 1]) / 2
-      else:
-        median = sorted_times[count // 2]
-
-      print('   %10s: mean: %4.3f (+-%4.3f) secs  median: %4.3f  range: %4.3f-%4.3f  (noise: %4.3f%%)  (%d runs)' % (self.name, mean, std, median, min(self.times), max(self.times), 100 * std / mean, self.reps), end=' ')
+      stats = self.stats()
+      mean = stats['mean']
+      print('   %10s: mean: %4.3f (+-%4.3f) secs  median: %4.3f  range: %4.3f-%4.3f  (noise: %4.3f%%)  (%d runs, %d outliers)  95%% CI: +-%4.3f' % (self.name, mean, stats['std'], stats['median'], stats['min'], stats['max'], 100 * stats['std'] / mean, self.reps, stats['outliers'], stats['ci95']), end=' ')
 
       if baseline:
-        mean_baseline = sum(baseline.times) / len(baseline.times)
-        final = mean / mean_baseline
+        final = mean / baseline.stats()['mean']
         print('  Relative: %.2f X slower' % final)
       else:
         print()
 
     # size
 
-    size = sum(os.path.getsize(f) for f in self.get_output_files())
-    gzip_size = sum(len(zlib.compress(read_binary(f))) for f in self.get_output_files())
+    size, gzip_size = self.get_sizes()
 
     print('        size: %8s, compressed: %8s' % (size, gzip_size), end=' ')
     if self.get_size_text():
       print('  (' + self.get_size_text() + ')', end=' ')
     print()
 
+  def result(self):
+    size, gzip_size = self.get_sizes()
+    result = {
+      'benchmarker': self.name,
+      'times': self.times,
+      'size': size,
+      'compressed_size': gzip_size,
+    }
+    result.update(self.stats())
+    return result
+
   def get_size_text(self):
     return ''
 
@@ -418,6 +485,32 @@ class benchmark(common.RunnerCore):
     fingerprint.append('llvm: ' + config.LLVM_ROOT)
     print('Running Emscripten benchmarks... [ %s ]' % ' | '.join(fingerprint))
 
+    cls.environment = {
+      'fingerprint': fingerprint,
+      'platform': platform.platform(),
+      'machine': platform.machine(),
+      'processor': platform.processor(),
+      'python': platform.python_version(),
+      'cpu_count': os.cpu_count(),
+      'cpu_affinity': CPU_AFFINITY,
+      'optimizations': OPTIMIZATIONS,
+      'ignore_compilation': IGNORE_COMPILATION,
+      'warmup_reps': WARMUP_REPS,
+      'min_reps': TEST_REPS,
+      'max_reps': MAX_REPS,
+      'target_precision': TARGET_PRECISION,
+      'benchmarkers': {b.name: getattr(b, 'engine', None) for b in benchmarkers},
+    }
+    cls.results = []
+
+  @classmethod
+  def tearDownClass(cls):
+    super().tearDownClass()
+    if RESULTS_FILE:
+      with open(RESULTS_FILE, 'w') as f:
+        json.dump({'environment': cls.environment, 'results': cls.results}, f, indent=2)
+      print('Wrote benchmark results to ' + RESULTS_FILE)
+
   # avoid depending on argument reception from the commandline
   def hardcode_arguments(self, code):
     if not code or 'int main()' in code:
@@ -463,6 +556,7 @@ class benchmark(common.RunnerCore):
       b.build(self, filename, args, shared_args, emcc_args, native_args, native_exec, lib_builder, has_output_parser=output_parser is not None)
       b.bench(args, output_parser, reps, expected_output)
       b.display(baseline)
+      self.results.append(dict(benchmark=name, **b.result()))
 
   def test_primes(self, check=True):
     src = r'''
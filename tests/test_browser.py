@@ -5,6 +5,8 @@
 # found in the LICENSE file.
 
 import argparse
+import gzip
+import http.client
 import json
 import multiprocessing
 import os
@@ -12,6 +14,8 @@ import random
 import shlex
 import shutil
 import subprocess
+import sys
+import textwrap
 import time
 import unittest
 import webbrowser
@@ -22,7 +26,7 @@ from urllib.request import urlopen
 
 from common import BrowserCore, RunnerCore, path_from_root, has_browser, EMTEST_BROWSER, Reporting
 from common import create_file, parameterized, ensure_dir, disabled, test_file, WEBIDL_BINDER
-from common import read_file, requires_v8, also_with_minimal_runtime, EMRUN
+from common import read_file, read_binary, requires_v8, also_with_minimal_runtime, EMRUN
 from tools import shared
 from tools import ports
 from tools.shared import EMCC, WINDOWS, FILE_PACKAGER, PIPE
@@ -556,6 +560,51 @@ If manually bisecting:
     self.run_browser('page.html', 'You should see |load me right before|.', '/report_result?exit:0')
     self.run_browser('page.html', 'You should see |load me right before|.', '/report_result?exit:1')
 
+  def test_preload_caching_delta_update(self):
+    self.set_setting('EXIT_RUNTIME')
+    create_file('test.js', '''
+      mergeInto(LibraryManager.library, {
+        checkPreloadResults: function() {
+          return Module['preloadResults']['assets.data']['fromCache'];
+        }
+      });
+    ''')
+    ensure_dir('assets')
+    for i in range(100):
+      create_file('assets/%d.txt' % i, ('file %d\n' % i) * 10000)
+
+    def build(expected):
+      create_file('main.c', r'''
+        #include <assert.h>
+        #include <stdio.h>
+        #include <string.h>
+
+        extern int checkPreloadResults();
+
+        int main(int argc, char** argv) {
+          char buf[100] = {0};
+          FILE *f = fopen("assets/50.txt", "r");
+          fread(buf, 1, 10, f);
+          fclose(f);
+          printf("|%%s|\n", buf);
+          assert(strcmp("%s", buf) == 0);
+          return checkPreloadResults();
+        }
+      ''' % expected)
+      self.run_process([FILE_PACKAGER, 'assets.data', '--use-preload-cache', '--indexedDB-name=deltadb', '--preload', 'assets', '--js-output=assets.js'])
+      self.compile_btest(['main.c', '--js-library', 'test.js', '--pre-js', 'assets.js', '-o', 'page.html', '-sFORCE_FILESYSTEM'], reporting=Reporting.JS_ONLY)
+
+    build('file 50\\nfi')
+    self.run_browser('page.html', 'You should see |file 50|.', '/report_result?exit:0')
+    self.run_browser('page.html', 'You should see |file 50|.', '/report_result?exit:1')
+
+    # After an update the changed chunks are downloaded, and combined with
+    # the rest of the package from the cache.
+    create_file('assets/50.txt', 'changed 50' * 1000)
+    build('changed 50')
+    self.run_browser('page.html', 'You should see |changed 50|.', '/report_result?exit:0')
+    self.run_browser('page.html', 'You should see |changed 50|.', '/report_result?exit:1')
+
   def test_multifile(self):
     # a few files inside a directory
     ensure_dir('subdirr/moar')
@@ -5405,6 +5454,35 @@ window.close = function() {
 
 
 class emrun(RunnerCore):
+  # Starts `emrun --no_browser` serving page.html on the given port, and returns
+  # the emrun process and a connection to it.  The tests that use this play the
+  # page themselves, so they do not need a browser.
+  def start_emrun_server(self, port, args=[]):
+    proc = subprocess.Popen([EMRUN, '--no_browser', '--port', str(port)] + args + ['page.html'], stdout=PIPE, stderr=PIPE)
+
+    def stop():
+      if proc.poll() is None:
+        proc.terminate()
+        proc.wait()
+
+    self.addCleanup(stop)
+    for _ in range(100):
+      if proc.poll() is not None:
+        self.fail('emrun exited with %d before accepting connections' % proc.returncode)
+      conn = http.client.HTTPConnection('localhost', port)
+      try:
+        conn.connect()
+        return proc, conn
+      except OSError:
+        time.sleep(0.1)
+    self.fail('emrun did not accept connections on port %d' % port)
+
+  # Posts a message or file dump to emrun the way the page does.
+  def post_to_emrun(self, conn, url, body):
+    conn.request('POST', url, body)
+    response = conn.getresponse()
+    self.assertEqual(response.read(), b'OK')
+
   def test_emrun_info(self):
     if not has_browser():
       self.skipTest('need a browser')
@@ -5443,6 +5521,165 @@ class emrun(RunnerCore):
       proc.terminate()
       proc.wait()
 
+  def test_emrun_batched_messages(self):
+    # Pages post their stdout/stderr in batches, one message per line, over a
+    # kept alive connection. Messages that arrive out of order are reordered by
+    # their sequence numbers.
+    create_file('page.html', '')
+    proc, conn = self.start_emrun_server(6943, ['--log_stdout', 'stdout.txt', '--log_stderr', 'stderr.txt'])
+
+    def post(body):
+      self.post_to_emrun(conn, '/stdio.html', body.encode('utf-8'))
+
+    post('^pageload^')
+    post('^out^3^three\n^err^4^an%20error\n^out^5^a+b%0Ac')
+    post('^out^1^one\n^out^2^two')
+    post('\n'.join('^out^%d^line%d' % (i + 6, i) for i in range(1000)))
+    post('^exit^42')
+    self.assertEqual(proc.wait(timeout=30), 42)
+    expected = ['one', 'two', 'three', 'a b', 'c'] + ['line%d' % i for i in range(1000)]
+    self.assertEqual(read_file('stdout.txt').splitlines(), expected)
+    self.assertEqual(read_file('stderr.txt'), 'an error\n')
+
+  def test_emrun_file_dump(self):
+    # Post file dumps the way emrun_file_dump() does.
+    create_file('page.html', '')
+    proc, conn = self.start_emrun_server(6948)
+
+    data = bytes(range(256)) * 10000
+    self.post_to_emrun(conn, '/stdio.html?file=nested%2Fwith%20space.dat', data[:1000])
+    # A large file dump in chunks.
+    self.post_to_emrun(conn, '/stdio.html?file=big.dat', data[:1000000])
+    self.post_to_emrun(conn, '/stdio.html?file=big.dat&append=1', data[1000000:])
+    self.post_to_emrun(conn, '/stdio.html?file=trace.gz&compress=gzip', b'first\n')
+    self.post_to_emrun(conn, '/stdio.html?file=trace.gz&compress=gzip&append=1', b'second\n')
+    self.post_to_emrun(conn, '/stdio.html', b'^exit^0')
+    self.assertEqual(proc.wait(timeout=30), 0)
+    self.assertEqual(read_binary('dump_out/nested/with space.dat'), data[:1000])
+    self.assertEqual(read_binary('dump_out/big.dat'), data)
+    with gzip.open('dump_out/trace.gz') as f:
+      self.assertEqual(f.read(), b'first\nsecond\n')
+
+  def test_emrun_bad_requests(self):
+    create_file('page.html', '')
+    proc, conn = self.start_emrun_server(6940)
+
+    # A request that makes the handler fail gets an error response, and the
+    # server carries on.
+    conn.request('POST', '/stdio.html', b'^exit^abc')
+    response = conn.getresponse()
+    self.assertEqual(response.status, 500)
+    response.read()
+    conn.close()
+
+    conn.request('GET', '/page.html', headers={'X-Padding': 'x' * 100000})
+    response = conn.getresponse()
+    self.assertEqual(response.status, 431)
+    response.read()
+    conn.close()
+
+    self.post_to_emrun(conn, '/stdio.html', b'^exit^0')
+    self.assertEqual(proc.wait(timeout=30), 0)
+    stderr = proc.communicate()[1].decode()
+    self.assertContained('Error while handling a request', stderr)
+    self.assertContained("ValueError: invalid literal for int() with base 10: 'abc'", stderr)
+
+  def test_emrun_static_serving(self):
+    create_file('page.html', '')
+    create_file('test.js', 'console.log("hello");\n')
+    create_file('test.js.br', 'compressed')
+    proc, conn = self.start_emrun_server(6944)
+
+    # All of these requests go over the same connection.
+    def get(headers={}):
+      conn.request('GET', '/test.js', headers=headers)
+      response = conn.getresponse()
+      return response, response.read()
+
+    response, body = get()
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, b'console.log("hello");\n')
+    self.assertEqual(response.getheader('Content-Type'), 'application/javascript')
+    etag = response.getheader('ETag')
+
+    response, body = get({'If-None-Match': etag})
+    self.assertEqual(response.status, 304)
+    self.assertEqual(body, b'')
+
+    response, body = get({'Range': 'bytes=8-10'})
+    self.assertEqual(response.status, 206)
+    self.assertEqual(response.getheader('Content-Range'), 'bytes 8-10/22')
+    self.assertEqual(body, b'log')
+
+    response, body = get({'Range': 'bytes=100-'})
+    self.assertEqual(response.status, 416)
+
+    # A precompressed sibling file is served if the browser accepts it.
+    response, body = get({'Accept-Encoding': 'gzip, br'})
+    self.assertEqual(response.status, 200)
+    self.assertEqual(response.getheader('Content-Encoding'), 'br')
+    self.assertEqual(body, b'compressed')
+    self.assertNotEqual(response.getheader('ETag'), etag)
+
+    # Only the failed request is logged.
+    proc.terminate()
+    stderr = proc.communicate()[1].decode()
+    self.assertContained('"GET /test.js HTTP/1.1" 416', stderr)
+    self.assertNotContained('HTTP/1.1" 200', stderr)
+    self.assertNotContained('HTTP/1.1" 206', stderr)
+    self.assertNotContained('HTTP/1.1" 304', stderr)
+
+  @unittest.skipIf(WINDOWS, 'uses a python script as the browser')
+  def test_emrun_pages(self):
+    # Use a fake browser that plays the page: it prints the arguments of the page
+    # and exits with the code given as the first one, or hangs.
+    create_file('browser.py', textwrap.dedent('''\
+      #!%s
+      import sys
+      import time
+      from urllib.parse import quote, urlsplit
+      from urllib.request import urlopen
+
+      url = sys.argv[-1]
+      urlopen(url).read()
+      args = urlsplit(url).query.split('&')
+      stdio = url[:url.rindex('/')] + '/stdio.html'
+      urlopen(stdio, ('^out^1^' + quote('args: ' + ' '.join(args))).encode()).read()
+      if args[0] == 'hang':
+        time.sleep(60)
+      urlopen(stdio, ('^exit^' + args[0]).encode()).read()
+      ''' % sys.executable))
+    os.chmod('browser.py', 0o755)
+    create_file('page.html', '')
+    create_file('pages.txt', '# A comment\npage.html 0 foo\n\npage.html 3\npage.html hang\npage.html 0 bar\n')
+    proc = self.run_process([EMRUN, '--browser', './browser.py', '--pages', 'pages.txt', '--jobs', '3',
+                             '--port', '6945', '--timeout', '10', '--summary', 'summary.json'],
+                            stdout=PIPE, check=False)
+    self.assertEqual(proc.returncode, 1)
+    self.assertContained('[page.html 0 foo] args: 0 foo', proc.stdout)
+    self.assertContained('[page.html 0 bar] args: 0 bar', proc.stdout)
+    self.assertContained('[page.html 3] args: 3', proc.stdout)
+    self.assertContained('Ran 4 pages', proc.stdout)
+
+    summary = json.loads(read_file('summary.json'))
+    self.assertEqual(summary['jobs'], 3)
+    self.assertEqual(summary['passed'], 2)
+    self.assertEqual(summary['failed'], 2)
+    pages = summary['pages']
+    self.assertEqual([p['args'] for p in pages], [['0', 'foo'], ['3'], ['hang'], ['0', 'bar']])
+    self.assertEqual([p['returncode'] for p in pages[:2]], [0, 3])
+    self.assertEqual([p['timed_out'] for p in pages], [False, False, True, False])
+    # The first three pages run at the same time on different ports, and the
+    # last one reuses the port of one that finished.
+    self.assertEqual(sorted(p['port'] for p in pages[:3]), [6945, 6946, 6947])
+    self.assertIn(pages[3]['port'], [pages[0]['port'], pages[1]['port']])
+
+    # Abbreviated options would not be stripped from the arguments passed on to
+    # the emrun process of each page.
+    proc = self.run_process([EMRUN, '--page', 'pages.txt', '--job', '3'], stderr=PIPE, check=False)
+    self.assertNotEqual(proc.returncode, 0)
+    self.assertContained('unrecognized arguments: --page', proc.stderr)
+
   def test_emrun(self):
     self.run_process([EMCC, test_file('test_emrun.c'), '--emrun', '-o', 'hello_world.html'])
     if not has_browser():
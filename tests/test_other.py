@@ -2768,6 +2768,56 @@ int f() {
 
     self.assertEqual(metadata['package_uuid'], 'sha256-53ddc03623f867c7d4a631ded19c2613f2cb61d47b6aa214f47ff3cc15445bcd')
 
+  def test_file_packager_incremental(self):
+    create_file('data1.txt', 'data1')
+    create_file('data2.txt', 'data2')
+    cmd = [FILE_PACKAGER, 'test.data', '--preload', 'data1.txt', 'data2.txt', '--js-output=test.js', '--use-preload-cache']
+    self.run_process(cmd)
+    self.assertEqual(read_file('test.data'), 'data1data2')
+    orig_timestamp = os.path.getmtime('test.data')
+    orig_uuid = json.loads(re.search(r'loadPackage\((.*)\);', read_file('test.js')).group(1))['package_uuid']
+
+    # Nothing changed, so the bundle is not rewritten.
+    time.sleep(1.0)
+    self.run_process(cmd)
+    self.assertEqual(orig_timestamp, os.path.getmtime('test.data'))
+
+    # A file of the same size is patched in place.
+    create_file('data2.txt', 'DATA2')
+    with env_modify({'EMCC_DEBUG': '1'}):
+      err = self.run_process(cmd, stderr=PIPE).stderr
+    self.assertContained('updating data2.txt in data bundle', err)
+    self.assertEqual(read_file('test.data'), 'data1DATA2')
+    self.assertNotContained(orig_uuid, read_file('test.js'))
+
+    # Any other change causes the whole bundle to be written.
+    create_file('data1.txt', 'data1 longer')
+    self.run_process(cmd)
+    self.assertEqual(read_file('test.data'), 'data1 longerDATA2')
+
+  def test_file_packager_cache_chunks(self):
+    ensure_dir('assets')
+    for i in range(100):
+      create_file('assets/%02d.txt' % i, ('file %d\n' % i) * 1000)
+    cmd = [FILE_PACKAGER, 'test.data', '--preload', 'assets', '--use-preload-cache', '--js-output=test.js']
+
+    def get_chunks():
+      metadata = json.loads(re.search(r'loadPackage\((.*)\);', read_file('test.js')).group(1))
+      chunks = metadata['cache_chunks']
+      self.assertEqual(chunks[-1][0], os.path.getsize('test.data'))
+      return chunks
+
+    self.run_process(cmd)
+    orig_hashes = set(c[1] for c in get_chunks())
+    self.assertGreater(len(orig_hashes), 1)
+
+    # Adding a file only changes the chunks around it, even though everything
+    # after it moves.
+    create_file('assets/50b.txt', 'a new file')
+    self.run_process(cmd)
+    changed = [c for c in get_chunks() if c[1] not in orig_hashes]
+    self.assertLessEqual(len(changed), 2)
+
   def test_file_packager_unicode(self):
     unicode_name = 'unicode…☃'
     try:
@@ -2835,6 +2885,161 @@ int f() {
     output = self.run_js('a.out.js')
     self.assertContained('hello data', output)
 
+  @parameterized({
+    'js': (['--js-output=data.js'], ['--pre-js', 'data.js']),
+    'obj': (['--obj-output=data.o'], ['data.o']),
+  })
+  def test_file_packager_embed_names(self, packager_args, link_args):
+    names = ['plain.txt', 'with space.txt', 'ünïcödé.txt']
+    if not WINDOWS:
+      names += ['quote"d.txt', 'back\\slash.txt']
+    ensure_dir('assets')
+    for i, name in enumerate(names):
+      create_file(os.path.join('assets', name), 'data %d' % i)
+    self.run_process([FILE_PACKAGER, 'test.data', '--embed', 'assets'] + packager_args)
+
+    create_file('test.c', r'''
+      #include <dirent.h>
+      #include <stdio.h>
+
+      int main() {
+        DIR* dir = opendir("assets");
+        struct dirent* entry;
+        while ((entry = readdir(dir))) {
+          if (entry->d_name[0] == '.') continue;
+          char path[256], buf[64] = {0};
+          snprintf(path, sizeof(path), "assets/%s", entry->d_name);
+          FILE* f = fopen(path, "r");
+          fread(buf, 1, sizeof(buf) - 1, f);
+          fclose(f);
+          printf("%s: %s\n", entry->d_name, buf);
+        }
+        closedir(dir);
+        return 0;
+      }
+    ''')
+    self.run_process([EMCC, 'test.c', '-sFORCE_FILESYSTEM'] + link_args)
+    output = self.run_js('a.out.js')
+    for i, name in enumerate(names):
+      self.assertContained('%s: data %d\n' % (name, i), output)
+
+  def test_file_packager_lazy_load(self):
+    ensure_dir('assets/ui')
+    create_file('assets/ui/menu.txt', 'menu data')
+    create_file('assets/level1.txt', 'level1 data')
+    create_file('assets/level2.txt', 'level2 data')
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'assets', '--lazy-load', '--lazy-load-chunk-size=16',
+                      '--prefetch', '/assets/ui/*', '--js-output=data.js'])
+
+    # Stand in for an HTTP server, logging the ranges that are requested.
+    create_file('fetch.js', '''
+      Module['fetchPackageRange'] = function(url, start, end) {
+        console.log('fetch ' + start + '-' + end);
+        return new Uint8Array(require('fs').readFileSync(url).subarray(start, end));
+      };
+    ''')
+    create_file('test.c', r'''
+      #include <stdio.h>
+
+      void cat(const char* name) {
+        char buf[64];
+        FILE* f = fopen(name, "r");
+        buf[fread(buf, 1, sizeof(buf) - 1, f)] = '\0';
+        fclose(f);
+        printf("%s: %s\n", name, buf);
+      }
+
+      int main() {
+        printf("main\n");
+        cat("assets/ui/menu.txt");
+        cat("assets/level2.txt");
+        return 0;
+      }
+    ''')
+    self.run_process([EMCC, 'test.c', '-sFORCE_FILESYSTEM', '--pre-js', 'fetch.js', '--pre-js', 'data.js'])
+    output = self.run_js('a.out.js')
+    # Only the prefetched file is fetched before main, and only the chunks
+    # needed by level2.txt afterwards.
+    metadata = json.loads(re.search(r'loadPackage\((.*)\);', read_file('data.js')).group(1))
+    files = {f['filename']: f for f in metadata['files']}
+    self.assertEqual(files['/assets/ui/menu.txt']['start'], 0)
+    level2 = files['/assets/level2.txt']
+    chunk_start = level2['start'] // 16 * 16
+    chunk_end = min((level2['end'] + 15) // 16 * 16, metadata['remote_package_size'])
+    self.assertContained(f'''fetch 0-9
+main
+assets/ui/menu.txt: menu data
+fetch {chunk_start}-{chunk_end}
+assets/level2.txt: level2 data
+''', output)
+    self.assertNotContained('level1', output)
+
+    # Preload plugins would need the whole file before startup.
+    stderr = self.expect_fail([FILE_PACKAGER, 'test.data', '--preload', 'assets', '--lazy-load', '--use-preload-plugins'])
+    self.assertContained('--lazy-load cannot be used with --lz4, --use-preload-cache or --use-preload-plugins', stderr)
+
+  def test_file_packager_compress(self):
+    create_file('text.txt', 'hello world\n' * 1000)
+    create_file('tiny.txt', 'tiny')
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'text.txt', 'tiny.txt', '--compress=gzip', '--js-output=data.js'])
+    # Only the file that compresses well is compressed.
+    metadata = json.loads(re.search(r'loadPackage\((.*)\);', read_file('data.js')).group(1))
+    self.assertEqual([f.get('codec') for f in metadata['files']], ['gzip', None])
+    self.assertLess(os.path.getsize('test.data'), 1000)
+
+    create_file('test.c', r'''
+      #include <stdio.h>
+      #include <string.h>
+
+      int main() {
+        static char buf[100000];
+        FILE* f = fopen("text.txt", "r");
+        size_t n = fread(buf, 1, sizeof(buf), f);
+        fclose(f);
+        printf("%zu %d\n", n, strncmp(buf, "hello world\nhello", 17));
+        f = fopen("tiny.txt", "r");
+        n = fread(buf, 1, sizeof(buf), f);
+        fclose(f);
+        printf("%.*s\n", (int)n, buf);
+        return 0;
+      }
+    ''')
+    self.run_process([EMCC, 'test.c', '-sFORCE_FILESYSTEM', '--pre-js', 'data.js'])
+    self.assertContained('12000 0\ntiny\n', self.run_js('a.out.js'))
+
+  def test_file_packager_dedup(self):
+    ensure_dir('assets/en')
+    ensure_dir('assets/fr')
+    create_file('assets/en/a.txt', 'same contents')
+    create_file('assets/fr/a.txt', 'same contents')
+    create_file('assets/fr/b.txt', 'different one')
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'assets', '--js-output=data.js'])
+    # Identical files are only stored once in the bundle.
+    self.assertEqual(os.path.getsize('test.data'), 26)
+    metadata = json.loads(re.search(r'loadPackage\((.*)\);', read_file('data.js')).group(1))
+    ranges = {f['filename']: (f['start'], f['end']) for f in metadata['files']}
+    self.assertEqual(ranges['/assets/en/a.txt'], ranges['/assets/fr/a.txt'])
+    self.assertNotEqual(ranges['/assets/en/a.txt'], ranges['/assets/fr/b.txt'])
+
+    # Writing to one of the files must not affect the other.
+    create_file('test.c', r'''
+      #include <stdio.h>
+
+      int main() {
+        char buf[100] = {0};
+        FILE* f = fopen("assets/en/a.txt", "r+");
+        fwrite("SAME", 1, 4, f);
+        fclose(f);
+        f = fopen("assets/fr/a.txt", "r");
+        fread(buf, 1, sizeof(buf) - 1, f);
+        fclose(f);
+        printf("%s\n", buf);
+        return 0;
+      }
+    ''')
+    self.run_process([EMCC, 'test.c', '-sFORCE_FILESYSTEM', '--pre-js', 'data.js'])
+    self.assertContained('same contents\n', self.run_js('a.out.js'))
+
   def test_headless(self):
     shutil.copyfile(test_file('screenshot.png'), 'example.png')
     self.run_process([EMCC, test_file('sdl_headless.c'), '-sHEADLESS'])
@@ -4142,6 +4347,20 @@ EM_ASM({ _middle() });
     self.assertEqual(os.path.getsize('test1.js'), os.path.getsize('test2.js'))
     self.assertEqual(os.path.getsize('test1.wasm'), os.path.getsize('test2.wasm'))
 
+  def test_post_link_tasks_parallel(self):
+    # The final post-link stages run concurrently where possible; check that
+    # this produces the same output as running them one at a time.
+    args = [test_file('hello_world.c'), '-O2', '-sWASM=2', '--emit-symbol-map', '--closure=1']
+    with env_modify({'EMCC_CORES': '1'}):
+      self.run_process([EMCC, '-o', 'serial.js'] + args)
+    with env_modify({'EMCC_CORES': '4'}):
+      self.run_process([EMCC, '-o', 'parallel.js'] + args)
+    self.assertEqual(read_file('serial.js'), read_file('parallel.js').replace('parallel', 'serial'))
+    self.assertEqual(read_binary('serial.wasm'), read_binary('parallel.wasm'))
+    self.assertEqual(read_file('serial.wasm.js'), read_file('parallel.wasm.js'))
+    self.assertEqual(read_file('serial.symbols'), read_file('parallel.symbols'))
+    self.assertContained('hello, world!', self.run_js('parallel.js'))
+
   def test_bc_to_bc(self):
     # emcc should 'process' bitcode to bitcode. build systems can request this if
     # e.g. they assume our 'executable' extension is bc, and compile an .o to a .bc
@@ -4880,6 +5099,56 @@ int main()
       self.run_process([EMXX, 'src.cpp', '-sDISABLE_EXCEPTION_CATCHING=0'])
     self.assertContained('Caught exception: std::exception', self.run_js('a.out.js'))
 
+  @with_env_modify({'EMCC_LINK_CACHE': '1', 'EMCC_DEBUG': '1'})
+  def test_link_cache_system_libs(self):
+    self.run_process([EMXX, '-c', test_file('hello_libcxx.cpp'), '-o', 'hello.o'])
+    err = self.run_process([EMXX, 'hello.o'], stderr=PIPE).stderr
+    self.assertNotContained('using link plan', err)
+    self.assertContained('hello, world!', self.run_js('a.out.js'))
+
+    # Relinking the same inputs reuses the plan without rescanning them.
+    err = self.run_process([EMXX, 'hello.o'], stderr=PIPE).stderr
+    self.assertContained('using link plan (inputs unchanged)', err)
+    self.assertContained('hello, world!', self.run_js('a.out.js'))
+
+    # Once the input is rebuilt it is scanned again.
+    self.run_process([EMXX, '-c', test_file('hello_libcxx.cpp'), '-o', 'hello.o', '-DFOO'])
+    os.utime('hello.o', (1, 1))
+    err = self.run_process([EMXX, 'hello.o'], stderr=PIPE).stderr
+    self.assertNotContained('using link plan', err)
+    self.assertContained('hello, world!', self.run_js('a.out.js'))
+
+  @with_env_modify({'EMCC_LINK_CACHE': '1', 'EMCC_DEBUG': '1'})
+  def test_link_cache_post_link_stages(self):
+    create_file('pre.js', 'Module.foo = 1;')
+    self.run_process([EMCC, '-c', test_file('hello_world.c'), '-o', 'hello.o'])
+    err = self.run_process([EMCC, 'hello.o', '-O2', '--pre-js', 'pre.js'], stderr=PIPE).stderr
+    self.assertNotContained('stage cache hit', err)
+    self.assertContained('hello, world!', self.run_js('a.out.js'))
+
+    # Changing only the pre-js means that the wasm-only stages can be reused,
+    # but not the ones that operate on the JS.
+    create_file('pre.js', 'Module.foo = 2;')
+    err = self.run_process([EMCC, 'hello.o', '-O2', '--pre-js', 'pre.js'], stderr=PIPE).stderr
+    self.assertContained('stage cache hit: wasm-opt', err)
+    self.assertContained('stage cache miss: acorn-optimizer', err)
+    self.assertContained('hello, world!', self.run_js('a.out.js'))
+    self.assertContained('foo=2', read_file('a.out.js'))
+
+  @with_env_modify({'EMCC_LINK_CACHE': '1', 'EMCC_DEBUG': '1'})
+  def test_link_cache_closure_externs(self):
+    create_file('externs.js', 'var foo;')
+    cmd = [EMCC, test_file('hello_world.c'), '-O2', '--closure=1', '--closure-args=--externs=' + os.path.abspath('externs.js')]
+    self.run_process(cmd)
+    err = self.run_process(cmd, stderr=PIPE).stderr
+    self.assertContained('stage cache hit: closure', err)
+
+    # Externs given as `--externs=file` are keyed on their contents too.
+    create_file('externs.js', 'var bar;')
+    err = self.run_process(cmd, stderr=PIPE).stderr
+    self.assertContained('stage cache miss: closure', err)
+    self.assertContained('hello, world!', self.run_js('a.out.js'))
+
   def test_strftime_zZ(self):
     create_file('src.cpp', r'''
 #include <cerrno>
@@ -8284,6 +8553,25 @@ end
     self.run_process([EMCC, test_file('hello_world.c')])
     self.assertEqual('hello, world!', self.run_js('a.out.js').strip())
 
+    self.run_process([emprofile, '--trace', '--no-clear', '-o', 'trace.json'])
+    trace = json.loads(read_file('trace.json'))['traceEvents']
+    processes = [e for e in trace if e['ph'] == 'X' and e['cat'] == 'process']
+    self.assertEqual([e['name'] for e in processes], ['emcc'])
+    self.assertEqual(processes[0]['args']['returncode'], 0)
+    subprocesses = {e['name']: e for e in trace if e['ph'] == 'X' and e['cat'] == 'subprocess'}
+    self.assertIn('clang', subprocesses)
+    self.assertIn('wasm-ld', subprocesses)
+    self.assertEqual(subprocesses['wasm-ld']['pid'], processes[0]['pid'])
+    if not WINDOWS:
+      self.assertGreater(subprocesses['clang']['args']['maxRss'], 0)
+
+    report = self.run_process([emprofile, '--report', 'trace.json'], stdout=PIPE).stdout
+    self.assertContained('Critical path:', report)
+    self.assertContained('wasm-ld', report)
+    diff = self.run_process([emprofile, '--diff', 'trace.json', 'trace.json', '--threshold=0'], stdout=PIPE).stdout
+    self.assertContained('critical path', diff)
+    self.assertNotContained('regression', diff)
+
     self.run_process([emprofile, '--graph'])
     self.assertTrue(glob.glob('toolchain_profiler.results*.html'))
 
@@ -8293,6 +8581,18 @@ end
     self.assertContained('start block "main"', stderr)
     self.assertContained('block "main" took', stderr)
 
+  def test_timing_report(self):
+    self.run_process([EMCC, test_file('hello_world.c'), '--timing-report=report.json'])
+    report = json.loads(read_file('report.json'))
+    self.assertGreater(report['total']['subprocesses'], 0)
+    blocks = report['blocks']
+    self.assertIn('compile inputs', blocks)
+    self.assertIn('link', blocks)
+    self.assertEqual(blocks['link']['count'], 1)
+    self.assertGreater(blocks['link']['subprocesses'], 0)
+    for block in blocks.values():
+      self.assertLessEqual(block['wallTime'], report['total']['wallTime'])
+
   def test_noderawfs(self):
     self.run_process([EMXX, test_file('fs/test_fopen_write.cpp'), '-sNODERAWFS'])
     self.assertContained("read 11 bytes. Result: Hello data!", self.run_js('a.out.js'))
@@ -8529,6 +8829,7 @@ int main() {
     self.assertIn('int foo()', output)
     # has some entries
     self.assertRegexpMatches(output, r'"mappings":\s*"[A-Za-z0-9+/]')
+    self.assertIn('"mappings":"8GAGA,OACE,GAAA"', output)
 
   def test_wasm_sourcemap_dead(self):
     wasm_map_cmd = [PYTHON, path_from_root('tools/wasm-sourcemap.py'),
@@ -8542,6 +8843,30 @@ int main() {
     # has only two entries
     self.assertRegexpMatches(output, r'"mappings":\s*"[A-Za-z0-9+/]+,[A-Za-z0-9+/]+"')
 
+  @parameterized({
+    '': ([],),
+    'dwarf5': (['-gdwarf-5'],),
+  })
+  def test_wasm_sourcemap_native(self, args):
+    # Without --dwarfdump-output the line tables are read directly from the
+    # wasm file, which should give exactly the same result as llvm-dwarfdump.
+    self.run_process([EMCC, test_file('core/test_dwarf.c'), test_file('other/wasm_sourcemap/no_main.c'), '-c'] + args)
+    self.run_process([EMCC, 'test_dwarf.o', 'no_main.o', '-g', '-o', 'a.js'])
+    dump = self.run_process([LLVM_DWARFDUMP, '-debug-info', '-debug-line', '--recurse-depth=0', 'a.wasm'], stdout=PIPE).stdout
+    create_file('a.wasm.dump', dump)
+    wasm_map_cmd = [PYTHON, path_from_root('tools/wasm-sourcemap.py'), 'a.wasm', '--basepath=' + os.getcwd()]
+    self.run_process(wasm_map_cmd + ['-o', 'native.map'])
+    self.run_process(wasm_map_cmd + ['-o', 'text.map', '--dwarfdump-output', 'a.wasm.dump'])
+    self.assertIn('test_dwarf.c', read_file('native.map'))
+    self.assertIn('no_main.c', read_file('native.map'))
+    self.assertEqual(read_file('text.map'), read_file('native.map'))
+
+    # The dead code heuristics apply in the same way.
+    self.run_process([PYTHON, path_from_root('tools/wasm-sourcemap.py'),
+                      test_file('other/wasm_sourcemap_dead/t.wasm'),
+                      '-o', 'a.out.wasm.map', '--basepath=' + os.getcwd()])
+    self.assertRegexpMatches(read_file('a.out.wasm.map'), r'"mappings":\s*"[A-Za-z0-9+/]+,[A-Za-z0-9+/]+"')
+
   def test_wasm_sourcemap_relative_paths(self):
     def test(infile, source_map_added_dir=''):
       expected_source_map_path = 'a.cpp'
@@ -8586,6 +8911,40 @@ int main() {
     # stabilizes more
     self.assertRegex(get_addr('0x124').replace('\n', ''),
                      'test_dwarf.c:15:3.*test_dwarf.c:20:3')
+    # Several addresses can be looked up with a single invocation.
+    self.assertEqual(get_addr('0x101') + get_addr('0x124'),
+                     self.run_process([emsymbolizer, 'test_dwarf.wasm', '0x101', '0x124'], stdout=PIPE).stdout)
+    # Or read from a file (or stdin), and printed as JSON.
+    self.assertEqual(get_addr('0x101'),
+                     self.run_process([emsymbolizer, 'test_dwarf.wasm', '--batch', '-'], input='0x101\n', stdout=PIPE).stdout)
+    create_file('addresses.txt', '0x101\ntest_dwarf.wasm 0x124\n')
+    output = self.run_process([emsymbolizer, '--json', '--batch', 'addresses.txt', 'test_dwarf.wasm'], stdout=PIPE).stdout
+    results = [json.loads(line) for line in output.splitlines()]
+    self.assertEqual(len(results), 2)
+    self.assertEqual(results[0]['address'], '0x101')
+    self.assertTrue(results[0]['dwarf'][0]['source'].endswith('test_dwarf.c'))
+    self.assertEqual((results[0]['dwarf'][0]['line'], results[0]['dwarf'][0]['column']), (6, 3))
+    self.assertEqual([frame['line'] for frame in results[1]['dwarf']], [15, 20])
+
+  def test_emsymbolizer_sourcemap(self):
+    self.run_process([EMCC, test_file('core/test_dwarf.c'),
+                      '-gsource-map', '-O1', '-o', 'test_dwarf.js'])
+
+    def symbolize(*args):
+      return self.run_process([emsymbolizer, '-s', 'sourcemap', 'test_dwarf.wasm'] + list(args), stdout=PIPE).stdout
+
+    single = symbolize('--no-index', '0x101') + symbolize('--no-index', '0x124')
+    self.assertContained('test_dwarf.c', single)
+    self.assertNotExists('test_dwarf.wasm.map.idx')
+    self.assertEqual(symbolize('--no-index', '0x101', '0x124'), single)
+    # The parsed source map is saved to an index file, which later runs load
+    # instead.
+    self.assertEqual(symbolize('0x101', '0x124'), single)
+    self.assertExists('test_dwarf.wasm.map.idx')
+    self.assertEqual(symbolize('0x101', '0x124'), single)
+    # The index is not used once the source map changes.
+    create_file('test_dwarf.wasm.map', read_file('test_dwarf.wasm.map').replace('test_dwarf.c', 'changed.c'))
+    self.assertContained('changed.c', symbolize('0x101'))
 
   def test_separate_dwarf(self):
     self.run_process([EMCC, test_file('hello_world.c'), '-g'])
@@ -19,6 +19,7 @@ from subprocess import PIPE
 from . import diagnostics
 from . import response_file
 from . import shared
+from . import stage_cache
 from . import webassembly
 from . import config
 from . import utils
@@ -647,10 +648,17 @@ def acorn_optimizer(filename, passes, extra_info=None, return_output=False):
   if not return_output:
     next = original_filename + '.jso.js'
     shared.get_temp_files().note(next)
-    check_call(cmd, stdout=open(next, 'w'))
+    stage = stage_cache.CachedStage('acorn-optimizer', cmd, inputs=[filename], outputs=[next])
+    if not stage.restore():
+      check_call(cmd, stdout=open(next, 'w'))
+      stage.save()
     save_intermediate(next, '%s.js' % passes[0])
     return next
+  stage = stage_cache.CachedStage('acorn-optimizer-output', cmd, inputs=[filename], outputs=[])
+  if stage.restore():
+    return stage.result
   output = check_call(cmd, stdout=PIPE).stdout
+  stage.save(output)
   return output
 
 
@@ -900,6 +908,26 @@ def run_closure_cmd(cmd, filename, env, pretty):
   if pretty:
     cmd += ['--formatting', 'PRETTY_PRINT']
 
+  # The input JS and all externs are keyed on their contents, except for the
+  # externs that ship with emscripten, which are keyed on their size and mtime.
+  emscripten_src = utils.path_from_root('src')
+  inputs = []
+  for i, arg in enumerate(cmd):
+    if arg in ('--js', '--externs') and i + 1 < len(cmd):
+      filename = cmd[i + 1]
+    elif arg.startswith(('--js=', '--externs=')):
+      filename = arg.split('=', 1)[1]
+    else:
+      continue
+    path = os.path.abspath(os.path.join(tempfiles.tmpdir, filename))
+    if os.path.commonpath([path, emscripten_src]) != emscripten_src:
+      inputs.append(filename)
+  stage = stage_cache.CachedStage('closure', cmd, inputs=inputs,
+                                  outputs=[os.path.relpath(outfile, tempfiles.tmpdir)],
+                                  cwd=tempfiles.tmpdir)
+  if stage.restore():
+    return outfile
+
   shared.print_compiler_stage(cmd)
 
   # Closure compiler does not work if any of the input files contain characters outside the
@@ -954,6 +982,9 @@ def run_closure_cmd(cmd, filename, env, pretty):
 
     if settings.CLOSURE_WARNINGS == 'error':
       exit_with_error('closure compiler produced warnings and -sCLOSURE_WARNINGS=error enabled')
+  else:
+    # Only cache clean runs, so that any warnings are always reported.
+    stage.save()
 
   return outfile
 
@@ -1489,6 +1520,28 @@ def get_binaryen_bin():
 binaryen_kept_debug_info = False
 
 
+# Binaryen tools whose only effects are to write the files named on their
+# command line, and whose results can therefore be cached (see stage_cache.py).
+CACHEABLE_BINARYEN_TOOLS = {'wasm-opt', 'wasm-emscripten-finalize', 'wasm-metadce', 'wasm-ctor-eval', 'wasm2js'}
+
+# Binaryen arguments that name additional input or output files.
+BINARYEN_INPUT_FILE_ARGS = ('--graph-file=', '--input-source-map=')
+BINARYEN_OUTPUT_FILE_ARGS = ('--output-source-map=', '--separate-data-segments=', '--symbols-file=')
+
+
+def get_binaryen_file_args(cmd, infile, outfile):
+  inputs = [infile]
+  outputs = [outfile] if outfile else []
+  for i, arg in enumerate(cmd):
+    if arg.startswith(BINARYEN_INPUT_FILE_ARGS):
+      inputs.append(arg.split('=', 1)[1])
+    elif arg.startswith(BINARYEN_OUTPUT_FILE_ARGS):
+      outputs.append(arg.split('=', 1)[1])
+    elif arg == '-o' and i + 1 < len(cmd) and cmd[i + 1] not in outputs:
+      outputs.append(cmd[i + 1])
+  return inputs, outputs
+
+
 def run_binaryen_command(tool, infile, outfile=None, args=[], debug=False, stdout=None):
   cmd = [os.path.join(get_binaryen_bin(), tool)]
   cmd += args
@@ -1518,7 +1571,16 @@ def run_binaryen_command(tool, infile, outfile=None, args=[], debug=False, stdou
   if settings.GENERATE_SOURCE_MAP and outfile and tool in ['wasm-opt', 'wasm-emscripten-finalize']:
     cmd += [f'--input-source-map={infile}.map']
     cmd += [f'--output-source-map={outfile}.map']
-  ret = check_call(cmd, stdout=stdout).stdout
+  stage = None
+  if tool in CACHEABLE_BINARYEN_TOOLS and infile and stage_cache.enabled():
+    inputs, outputs = get_binaryen_file_args(cmd, infile, outfile)
+    stage = stage_cache.CachedStage(tool, cmd, inputs=inputs, outputs=outputs)
+  if stage and stage.restore():
+    ret = stage.result
+  else:
+    ret = check_call(cmd, stdout=stdout).stdout
+    if stage:
+      stage.save(ret)
   if outfile:
     save_intermediate(outfile, '%s.wasm' % tool)
     global binaryen_kept_debug_info
@@ -0,0 +1,630 @@
+# Copyright 2022 The Emscripten Authors.  All rights reserved.
+# Emscripten is available under two separate licenses, the MIT license and the
+# University of Illinois/NCSA Open Source License.  Both these licenses can be
+# found in the LICENSE file.
+
+"""Minimal reader for the DWARF debug information in wasm files.
+
+Only the parts needed to map code addresses back to source locations are
+supported: the line tables in .debug_line (DWARF versions 2 to 5), along with
+the compilation directories of the units in .debug_info.  The debug sections
+are accessed through mmap so that large binaries are not read into memory up
+front.
+"""
+
+from array import array
+import mmap
+import struct
+
+from . import webassembly
+
+DEBUG_SECTIONS = ('.debug_line', '.debug_info', '.debug_abbrev', '.debug_str',
+                  '.debug_line_str', '.debug_str_offsets')
+
+# Attributes
+DW_AT_stmt_list = 0x10
+DW_AT_comp_dir = 0x1b
+DW_AT_str_offsets_base = 0x72
+
+# Forms
+DW_FORM_addr = 0x01
+DW_FORM_block2 = 0x03
+DW_FORM_block4 = 0x04
+DW_FORM_data2 = 0x05
+DW_FORM_data4 = 0x06
+DW_FORM_data8 = 0x07
+DW_FORM_string = 0x08
+DW_FORM_block = 0x09
+DW_FORM_block1 = 0x0a
+DW_FORM_data1 = 0x0b
+DW_FORM_flag = 0x0c
+DW_FORM_sdata = 0x0d
+DW_FORM_strp = 0x0e
+DW_FORM_udata = 0x0f
+DW_FORM_ref_addr = 0x10
+DW_FORM_ref1 = 0x11
+DW_FORM_ref2 = 0x12
+DW_FORM_ref4 = 0x13
+DW_FORM_ref8 = 0x14
+DW_FORM_ref_udata = 0x15
+DW_FORM_indirect = 0x16
+DW_FORM_sec_offset = 0x17
+DW_FORM_exprloc = 0x18
+DW_FORM_flag_present = 0x19
+DW_FORM_strx = 0x1a
+DW_FORM_addrx = 0x1b
+DW_FORM_ref_sup4 = 0x1c
+DW_FORM_strp_sup = 0x1d
+DW_FORM_data16 = 0x1e
+DW_FORM_line_strp = 0x1f
+DW_FORM_ref_sig8 = 0x20
+DW_FORM_implicit_const = 0x21
+DW_FORM_loclistx = 0x22
+DW_FORM_rnglistx = 0x23
+DW_FORM_ref_sup8 = 0x24
+DW_FORM_strx1 = 0x25
+DW_FORM_strx2 = 0x26
+DW_FORM_strx3 = 0x27
+DW_FORM_strx4 = 0x28
+DW_FORM_addrx1 = 0x29
+DW_FORM_addrx2 = 0x2a
+DW_FORM_addrx3 = 0x2b
+DW_FORM_addrx4 = 0x2c
+
+FIXED_FORM_SIZES = {
+  DW_FORM_data1: 1, DW_FORM_ref1: 1, DW_FORM_flag: 1, DW_FORM_strx1: 1, DW_FORM_addrx1: 1,
+  DW_FORM_data2: 2, DW_FORM_ref2: 2, DW_FORM_strx2: 2, DW_FORM_addrx2: 2,
+  DW_FORM_strx3: 3, DW_FORM_addrx3: 3,
+  DW_FORM_data4: 4, DW_FORM_ref4: 4, DW_FORM_ref_sup4: 4, DW_FORM_strx4: 4, DW_FORM_addrx4: 4,
+  DW_FORM_data8: 8, DW_FORM_ref8: 8, DW_FORM_ref_sig8: 8, DW_FORM_ref_sup8: 8,
+  DW_FORM_data16: 16,
+  DW_FORM_flag_present: 0, DW_FORM_implicit_const: 0,
+}
+OFFSET_FORMS = (DW_FORM_strp, DW_FORM_ref_addr, DW_FORM_sec_offset, DW_FORM_strp_sup, DW_FORM_line_strp)
+ULEB_FORMS = (DW_FORM_udata, DW_FORM_ref_udata, DW_FORM_strx, DW_FORM_addrx, DW_FORM_loclistx, DW_FORM_rnglistx)
+STRX_FORMS = (DW_FORM_strx, DW_FORM_strx1, DW_FORM_strx2, DW_FORM_strx3, DW_FORM_strx4)
+
+# Line number program content types (DWARF 5)
+DW_LNCT_path = 0x1
+DW_LNCT_directory_index = 0x2
+
+# Standard opcodes
+DW_LNS_copy = 1
+DW_LNS_advance_pc = 2
+DW_LNS_advance_line = 3
+DW_LNS_set_file = 4
+DW_LNS_set_column = 5
+DW_LNS_negate_stmt = 6
+DW_LNS_set_basic_block = 7
+DW_LNS_const_add_pc = 8
+DW_LNS_fixed_advance_pc = 9
+DW_LNS_set_prologue_end = 10
+DW_LNS_set_epilogue_begin = 11
+DW_LNS_set_isa = 12
+
+# Extended opcodes
+DW_LNE_end_sequence = 1
+DW_LNE_set_address = 2
+DW_LNE_define_file = 3
+DW_LNE_set_discriminator = 4
+
+
+class DwarfError(Exception):
+  """Raised for debug info that is malformed or uses features not supported
+  here.  Callers can fall back to llvm-dwarfdump in that case."""
+  pass
+
+
+class LineTable:
+  """The rows of all the line programs in a module, stored column-wise.
+
+  The `file` column indexes into `files`, which holds each distinct source
+  path once.  Rows are kept in the order the line programs emit them, so each
+  sequence ends with a row that has `end_sequence` set.
+  """
+  def __init__(self):
+    self.files = []
+    self.file_ids = {}
+    self.address = array('Q')
+    self.file = array('I')
+    self.line = array('I')
+    self.column = array('I')
+    self.end_sequence = bytearray()
+
+  def __len__(self):
+    return len(self.address)
+
+  def add_file(self, path):
+    file_id = self.file_ids.get(path)
+    if file_id is None:
+      file_id = self.file_ids[path] = len(self.files)
+      self.files.append(path)
+    return file_id
+
+  def add_row(self, address, file_id, line, column, end_sequence):
+    self.address.append(address)
+    self.file.append(file_id)
+    self.line.append(line)
+    self.column.append(column)
+    self.end_sequence.append(end_sequence)
+
+  def extend(self, other, start, end):
+    """Appends rows start to end (exclusive) of another table that shares the
+    same list of files."""
+    self.address += other.address[start:end]
+    self.file += other.file[start:end]
+    self.line += other.line[start:end]
+    self.column += other.column[start:end]
+    self.end_sequence += other.end_sequence[start:end]
+
+  def truncate(self, size):
+    """Removes all the rows from the given index onwards."""
+    del self.address[size:]
+    del self.file[size:]
+    del self.line[size:]
+    del self.column[size:]
+    del self.end_sequence[size:]
+
+  def select(self, indices):
+    """Returns a new table holding the rows at the given indices, in that
+    order."""
+    table = LineTable()
+    table.files = self.files
+    table.file_ids = self.file_ids
+    table.address = array('Q', map(self.address.__getitem__, indices))
+    table.file = array('I', map(self.file.__getitem__, indices))
+    table.line = array('I', map(self.line.__getitem__, indices))
+    table.column = array('I', map(self.column.__getitem__, indices))
+    table.end_sequence = bytearray(map(self.end_sequence.__getitem__, indices))
+    return table
+
+
+def join_path(dirname, name):
+  if name.startswith('/'):
+    return name
+  return dirname + '/' + name
+
+
+def read_uleb(data, pos):
+  result = 0
+  shift = 0
+  while True:
+    byte = data[pos]
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return result, pos
+    shift += 7
+
+
+def read_sleb(data, pos):
+  result = 0
+  shift = 0
+  while True:
+    byte = data[pos]
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    shift += 7
+    if byte < 0x80:
+      if byte & 0x40:
+        result -= 1 << shift
+      return result, pos
+
+
+class Reader:
+  """Sequential reader over a range of a buffer."""
+  def __init__(self, data, pos, end):
+    self.data = data
+    self.pos = pos
+    self.end = end
+    self.offset_size = 4
+
+  def at_end(self):
+    return self.pos >= self.end
+
+  def skip(self, count):
+    self.pos += count
+    if self.pos > self.end:
+      raise DwarfError('unexpected end of data at 0x%x' % self.end)
+
+  def unpack(self, fmt, size):
+    value = struct.unpack_from(fmt, self.data, self.pos)[0]
+    self.skip(size)
+    return value
+
+  def u8(self):
+    return self.unpack('<B', 1)
+
+  def i8(self):
+    return self.unpack('<b', 1)
+
+  def u16(self):
+    return self.unpack('<H', 2)
+
+  def u32(self):
+    return self.unpack('<I', 4)
+
+  def u64(self):
+    return self.unpack('<Q', 8)
+
+  def uint(self, size):
+    value = int.from_bytes(self.data[self.pos:self.pos + size], 'little')
+    self.skip(size)
+    return value
+
+  def offset(self):
+    return self.uint(self.offset_size)
+
+  def uleb(self):
+    value, pos = read_uleb(self.data, self.pos)
+    self.skip(pos - self.pos)
+    return value
+
+  def sleb(self):
+    value, pos = read_sleb(self.data, self.pos)
+    self.skip(pos - self.pos)
+    return value
+
+  def cstr(self):
+    end = self.data.find(b'\0', self.pos, self.end)
+    if end < 0:
+      raise DwarfError('unterminated string at 0x%x' % self.pos)
+    value = self.data[self.pos:end].decode('utf-8', 'replace')
+    self.pos = end + 1
+    return value
+
+  def unit_length(self):
+    """Reads an initial length field, which also determines whether the unit
+    uses 32-bit or 64-bit DWARF offsets.  Returns the end of the unit."""
+    length = self.u32()
+    if length == 0xffffffff:
+      length = self.u64()
+      self.offset_size = 8
+    elif length >= 0xfffffff0:
+      raise DwarfError('reserved unit length 0x%x' % length)
+    else:
+      self.offset_size = 4
+    end = self.pos + length
+    if end > self.end:
+      raise DwarfError('unit at 0x%x extends past the end of its section' % self.pos)
+    return end
+
+
+class DebugInfo:
+  """The DWARF sections of a wasm file, mapped into memory."""
+  def __init__(self, filename):
+    self.sections = {}
+    module = webassembly.Module(filename)
+    for section in module.sections():
+      if section.type == webassembly.SecType.CUSTOM and section.name in DEBUG_SECTIONS:
+        name_size = len(section.name.encode('utf-8'))
+        start = section.offset + len(webassembly.to_leb(name_size)) + name_size
+        self.sections[section.name] = (start, section.offset + section.size)
+    del module
+    with open(filename, 'rb') as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def close(self):
+    self.data.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def reader(self, section, offset=0):
+    if section not in self.sections:
+      raise DwarfError('missing %s section' % section)
+    start, end = self.sections[section]
+    if start + offset > end:
+      raise DwarfError('offset 0x%x is outside of %s' % (offset, section))
+    return Reader(self.data, start + offset, end)
+
+  def read_string(self, section, offset):
+    return self.reader(section, offset).cstr()
+
+  def read_abbrevs(self, offset):
+    """Reads the abbreviation table at the given offset into a dict from
+    abbreviation code to its list of (attribute, form, implicit_const)."""
+    abbrevs = {}
+    r = self.reader('.debug_abbrev', offset)
+    while True:
+      code = r.uleb()
+      if code == 0:
+        return abbrevs
+      r.uleb() # tag
+      r.u8() # children
+      attrs = []
+      while True:
+        attr = r.uleb()
+        form = r.uleb()
+        if attr == 0 and form == 0:
+          break
+        implicit_const = r.sleb() if form == DW_FORM_implicit_const else None
+        attrs.append((attr, form, implicit_const))
+      abbrevs[code] = attrs
+
+  def read_form(self, r, form, address_size):
+    """Reads a single attribute value.  Strings are returned decoded, block
+    forms as bytes, and all other forms as integers."""
+    size = FIXED_FORM_SIZES.get(form)
+    if size is not None:
+      return r.uint(size)
+    if form in OFFSET_FORMS:
+      value = r.offset()
+      if form == DW_FORM_strp:
+        return self.read_string('.debug_str', value)
+      if form == DW_FORM_line_strp:
+        return self.read_string('.debug_line_str', value)
+      return value
+    if form in ULEB_FORMS:
+      return r.uleb()
+    if form == DW_FORM_sdata:
+      return r.sleb()
+    if form == DW_FORM_string:
+      return r.cstr()
+    if form == DW_FORM_addr:
+      return r.uint(address_size)
+    if form in (DW_FORM_block, DW_FORM_exprloc):
+      size = r.uleb()
+    elif form == DW_FORM_block1:
+      size = r.u8()
+    elif form == DW_FORM_block2:
+      size = r.u16()
+    elif form == DW_FORM_block4:
+      size = r.u32()
+    elif form == DW_FORM_indirect:
+      return self.read_form(r, r.uleb(), address_size)
+    else:
+      raise DwarfError('unsupported form 0x%x' % form)
+    value = r.data[r.pos:r.pos + size]
+    r.skip(size)
+    return value
+
+  def read_str_offset(self, base, index, offset_size):
+    r = self.reader('.debug_str_offsets', base + index * offset_size)
+    r.offset_size = offset_size
+    return self.read_string('.debug_str', r.offset())
+
+  def read_comp_dirs(self):
+    """Returns a dict from line table offset (DW_AT_stmt_list) to the
+    compilation directory of the unit that refers to it."""
+    comp_dirs = {}
+    if '.debug_info' not in self.sections:
+      return comp_dirs
+    abbrev_tables = {}
+    r = self.reader('.debug_info')
+    while not r.at_end():
+      unit_end = r.unit_length()
+      version = r.u16()
+      if version >= 5:
+        unit_type = r.u8()
+        address_size = r.u8()
+        abbrev_offset = r.offset()
+        if unit_type in (4, 5): # DW_UT_skeleton, DW_UT_split_compile
+          r.skip(8)
+        elif unit_type in (2, 6): # DW_UT_type, DW_UT_split_type
+          r.skip(8 + r.offset_size)
+      else:
+        abbrev_offset = r.offset()
+        address_size = r.u8()
+      if abbrev_offset not in abbrev_tables:
+        abbrev_tables[abbrev_offset] = self.read_abbrevs(abbrev_offset)
+      abbrevs = abbrev_tables[abbrev_offset]
+      code = r.uleb()
+      if code in abbrevs:
+        # Only the unit DIE itself is needed, so the rest of the unit is
+        # skipped over.
+        values = {}
+        for attr, form, implicit_const in abbrevs[code]:
+          if form == DW_FORM_implicit_const:
+            value = implicit_const
+          elif form in STRX_FORMS and attr == DW_AT_comp_dir:
+            value = (r.uleb() if form == DW_FORM_strx else r.uint(FIXED_FORM_SIZES[form]), r.offset_size)
+          else:
+            value = self.read_form(r, form, address_size)
+          values[attr] = value
+        comp_dir = values.get(DW_AT_comp_dir)
+        if isinstance(comp_dir, tuple):
+          index, offset_size = comp_dir
+          base = values.get(DW_AT_str_offsets_base, 8)
+          comp_dir = self.read_str_offset(base, index, offset_size)
+        if DW_AT_stmt_list in values and isinstance(comp_dir, str):
+          comp_dirs[values[DW_AT_stmt_list]] = comp_dir
+      r.pos = unit_end
+    return comp_dirs
+
+  def read_entry_formats(self, r):
+    formats = []
+    for _ in range(r.u8()):
+      formats.append((r.uleb(), r.uleb()))
+    return formats
+
+  def read_entries(self, r, formats, address_size):
+    entries = []
+    for _ in range(r.uleb()):
+      entry = {}
+      for content_type, form in formats:
+        if form in STRX_FORMS:
+          raise DwarfError('unsupported form 0x%x in line table header' % form)
+        entry[content_type] = self.read_form(r, form, address_size)
+      entries.append(entry)
+    return entries
+
+  def read_line_table(self, table=None):
+    """Runs every line program in .debug_line and collects the rows into a
+    LineTable."""
+    if table is None:
+      table = LineTable()
+    if '.debug_line' not in self.sections:
+      return table
+    comp_dirs = self.read_comp_dirs()
+    data = self.data
+    r = self.reader('.debug_line')
+    section_start = r.pos
+    while not r.at_end():
+      stmt_list = r.pos - section_start
+      unit_end = r.unit_length()
+      version = r.u16()
+      if version < 2 or version > 5:
+        raise DwarfError('unsupported line table version %d' % version)
+      address_size = 4
+      if version >= 5:
+        address_size = r.u8()
+        r.u8() # segment_selector_size
+      header_length = r.offset()
+      program_start = r.pos + header_length
+      min_inst_length = r.u8()
+      if version >= 4:
+        r.u8() # maximum_operations_per_instruction
+      r.u8() # default_is_stmt
+      line_base = r.i8()
+      line_range = r.u8()
+      opcode_base = r.u8()
+      if line_range == 0:
+        raise DwarfError('line table at 0x%x has a line_range of 0' % stmt_list)
+      opcode_lengths = [0] + [r.u8() for _ in range(opcode_base - 1)]
+
+      comp_dir = comp_dirs.get(stmt_list, '')
+      if version >= 5:
+        dir_formats = self.read_entry_formats(r)
+        dirs = [d.get(DW_LNCT_path, '') for d in self.read_entries(r, dir_formats, address_size)]
+        if not dirs:
+          dirs = [comp_dir]
+        file_formats = self.read_entry_formats(r)
+        file_ids = []
+        for f in self.read_entries(r, file_formats, address_size):
+          dir_index = f.get(DW_LNCT_directory_index, 0)
+          dirname = dirs[dir_index] if dir_index < len(dirs) else ''
+          file_ids.append(table.add_file(join_path(dirname, f.get(DW_LNCT_path, ''))))
+      else:
+        dirs = [comp_dir]
+        while True:
+          dirname = r.cstr()
+          if not dirname:
+            break
+          dirs.append(dirname)
+        # File numbering starts at 1 before DWARF 5.
+        file_ids = [None]
+        while True:
+          name = r.cstr()
+          if not name:
+            break
+          dir_index = r.uleb()
+          r.uleb() # modification time
+          r.uleb() # file length
+          dirname = dirs[dir_index] if dir_index < len(dirs) else ''
+          file_ids.append(table.add_file(join_path(dirname, name)))
+      if program_start > unit_end:
+        raise DwarfError('line table header at 0x%x is too long' % stmt_list)
+
+      def file_id(index):
+        if 0 <= index < len(file_ids) and file_ids[index] is not None:
+          return file_ids[index]
+        return table.add_file('')
+
+      # Run the line number program.  This is by far the hottest loop, so the
+      # state machine registers are kept in locals and the single byte LEB
+      # case is handled inline.
+      add_address = table.address.append
+      add_file = table.file.append
+      add_line = table.line.append
+      add_column = table.column.append
+      add_end_sequence = table.end_sequence.append
+      pos = program_start
+      address = 0
+      file = file_id(1)
+      line = 1
+      column = 0
+      while pos < unit_end:
+        opcode = data[pos]
+        pos += 1
+        if opcode >= opcode_base:
+          adjusted = opcode - opcode_base
+          address += (adjusted // line_range) * min_inst_length
+          line += line_base + adjusted % line_range
+          add_address(address)
+          add_file(file)
+          add_line(line)
+          add_column(column)
+          add_end_sequence(0)
+        elif opcode == DW_LNS_copy:
+          add_address(address)
+          add_file(file)
+          add_line(line)
+          add_column(column)
+          add_end_sequence(0)
+        elif opcode == DW_LNS_advance_line:
+          value = data[pos]
+          pos += 1
+          if value < 0x40:
+            line += value
+          elif value < 0x80:
+            line += value - 0x80
+          else:
+            value, pos = read_sleb(data, pos - 1)
+            line += value
+        elif opcode == DW_LNS_set_column:
+          column = data[pos]
+          pos += 1
+          if column >= 0x80:
+            column, pos = read_uleb(data, pos - 1)
+        elif opcode == DW_LNS_advance_pc:
+          value, pos = read_uleb(data, pos)
+          address += value * min_inst_length
+        elif opcode == DW_LNS_set_file:
+          value, pos = read_uleb(data, pos)
+          file = file_id(value)
+        elif opcode == DW_LNS_const_add_pc:
+          address += ((255 - opcode_base) // line_range) * min_inst_length
+        elif opcode == 0:
+          length, pos = read_uleb(data, pos)
+          end = pos + length
+          if length == 0 or end > unit_end:
+            raise DwarfError('bad extended opcode at 0x%x' % pos)
+          sub_opcode = data[pos]
+          pos += 1
+          if sub_opcode == DW_LNE_end_sequence:
+            add_address(address)
+            add_file(file)
+            add_line(line)
+            add_column(column)
+            add_end_sequence(1)
+            address = 0
+            file = file_id(1)
+            line = 1
+            column = 0
+          elif sub_opcode == DW_LNE_set_address:
+            address = int.from_bytes(data[pos:end], 'little')
+          elif sub_opcode == DW_LNE_define_file:
+            r.pos = pos
+            name = r.cstr()
+            dir_index = r.uleb()
+            dirname = dirs[dir_index] if dir_index < len(dirs) else ''
+            file_ids.append(table.add_file(join_path(dirname, name)))
+          pos = end
+        elif opcode == DW_LNS_fixed_advance_pc:
+          address += data[pos] | (data[pos + 1] << 8)
+          pos += 2
+        elif opcode in (DW_LNS_negate_stmt, DW_LNS_set_basic_block, DW_LNS_set_prologue_end, DW_LNS_set_epilogue_begin):
+          pass
+        else:
+          # DW_LNS_set_isa and any opcodes unknown to us have their number of
+          # LEB operands given in the header.
+          for _ in range(opcode_lengths[opcode]):
+            _, pos = read_uleb(data, pos)
+      r.pos = unit_end
+    return table
+
+
+def read_line_table(filename):
+  """Returns the LineTable of the given wasm file.  Raises DwarfError if the
+  debug info cannot be read."""
+  with DebugInfo(filename) as debug_info:
+    try:
+      return debug_info.read_line_table()
+    except (IndexError, struct.error) as e:
+      raise DwarfError('truncated debug info: %s' % e)
+    except OverflowError as e:
+      raise DwarfError('value out of range: %s' % e)
@@ -4,6 +4,7 @@
 # University of Illinois/NCSA Open Source License.  Both these licenses can be
 # found in the LICENSE file.
 
+import bisect
 import json
 import os
 import shutil
@@ -32,7 +33,9 @@ def list_files_in_directory(d):
   return files
 
 
-def create_profiling_graph(outfile):
+# Reads the events recorded by all profiled processes, in time order. Each log
+# file holds one JSON array of events per line.
+def load_profiler_logs():
   log_files = [f for f in list_files_in_directory(profiler_logs_path) if 'toolchain_profiler.pid_' in f]
 
   all_results = []
@@ -40,27 +43,26 @@ def create_profiling_graph(outfile):
     print(f'Processing {len(log_files)} profile log files in {profiler_logs_path}...')
   for f in log_files:
     print(f'Processing: {f}')
-    json_data = Path(f).read_text()
-    if len(json_data.strip()) == 0:
-      continue
-    lines = json_data.split('\n')
-    lines = [x for x in lines if x != '[' and x != ']' and x != ',' and len(x.strip())]
-    lines = [(x + ',') if not x.endswith(',') else x for x in lines]
-    lines[-1] = lines[-1][:-1]
-    json_data = '[' + '\n'.join(lines) + ']'
-    try:
-      all_results += json.loads(json_data)
-    except json.JSONDecodeError as e:
-      print(str(e), file=sys.stderr)
-      print('Failed to parse JSON file "' + f + '"!', file=sys.stderr)
-      return 1
+    for line in Path(f).read_text().splitlines():
+      if not line.strip():
+        continue
+      try:
+        all_results += json.loads(line)
+      except json.JSONDecodeError as e:
+        # A process that was killed while writing out its log leaves a
+        # truncated line behind; that should not lose the rest of the build.
+        print(str(e), file=sys.stderr)
+        print('Skipping malformed entry in JSON file "' + f + '"!', file=sys.stderr)
   if len(all_results) == 0:
     print(f'No profiler logs were found in path: ${profiler_logs_path}.\nTry setting the environment variable EMPROFILE=1 and run some emcc commands, then re-run "emprofile.py --graph".', file=sys.stderr)
-    return 1
+    return None
 
   all_results.sort(key=lambda x: x['time'])
+  return all_results
+
 
-  emprofile_json_data = json.dumps(all_results, indent=2)
+def create_profiling_graph(events, outfile):
+  emprofile_json_data = json.dumps(events, indent=2)
 
   html_file = outfile + '.html'
   html_contents = Path(os.path.dirname(os.path.realpath(__file__)), 'toolchain_profiler.results_template.html').read_text().replace('{{{ emprofile_json_data }}}', emprofile_json_data)
@@ -69,6 +71,345 @@ def create_profiling_graph(outfile):
   return 0
 
 
+# Splits a command line into a short name for the program it runs and its
+# arguments. For interpreters (python, node, java) the name is that of the
+# script they run instead.
+def split_command(cmdline):
+  name = os.path.basename(cmdline[0])
+  args = cmdline[1:]
+  if name.startswith(('python', 'node', 'java')):
+    for i, arg in enumerate(args):
+      if not arg.startswith('-'):
+        name = os.path.basename(arg)
+        args = args[i + 1:]
+        break
+  for suffix in ('.exe', '.bat', '.cmd', '.py'):
+    if name.endswith(suffix):
+      name = name[:-len(suffix)]
+  return name, args
+
+
+def tool_name(cmdline):
+  return split_command(cmdline)[0]
+
+
+def event_args(start, end):
+  args = {'cmdLine': start['cmdLine'], 'returncode': end['returncode']}
+  for key in ('cpuTime', 'maxRss'):
+    if key in end:
+      args[key] = end[key]
+  return args
+
+
+# Converts the recorded events to the Chrome Trace Event Format, which can be
+# viewed in https://ui.perfetto.dev or chrome://tracing. Every profiled process
+# (e.g. each emcc invocation of a build) becomes a trace process showing its
+# profiling blocks on its main thread. The subprocesses it spawns are shown on
+# separate "subprocesses" lanes, since those run in parallel may overlap, and
+# are linked with an arrow to the process they became if that was profiled too.
+def create_trace(events):
+  t0 = events[0]['time']
+
+  def ts(event):
+    return int((event['time'] - t0) * 1000000)
+
+  def complete_event(name, cat, pid, tid, start, end, args):
+    return {'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': ts(start), 'dur': ts(end) - ts(start), 'args': args}
+
+  def metadata_event(name, pid, tid, args):
+    return {'name': name, 'ph': 'M', 'pid': pid, 'tid': tid, 'args': args}
+
+  trace = []
+  started = {}
+  processes = []
+  spawns = {}
+  subprocesses = []
+  blocks = {}
+  for e in events:
+    pid = e['pid']
+    op = e['op']
+    if op == 'start':
+      started[pid] = e
+    elif op == 'exit':
+      start = started.pop(pid, None)
+      if start:
+        processes.append(start)
+        trace.append(complete_event(tool_name(start['cmdLine']), 'process', pid, pid, start, e, event_args(start, e)))
+    elif op == 'spawn':
+      spawns[(pid, e['targetPid'])] = e
+    elif op == 'finish':
+      spawn = spawns.pop((pid, e['targetPid']), None)
+      if spawn:
+        subprocesses.append((spawn, e))
+    elif op == 'enterBlock':
+      blocks.setdefault((pid, e['subprocessPid'], e['name']), []).append(e)
+    elif op == 'exitBlock':
+      stack = blocks.get((pid, e['subprocessPid'], e['name']))
+      if stack:
+        trace.append(complete_event(e['name'], 'block', pid, e['subprocessPid'], stack.pop(), e, {}))
+
+  for i, start in enumerate(sorted(processes, key=lambda s: s['time'])):
+    name = ' '.join([tool_name(start['cmdLine'])] + start['cmdLine'][1:])
+    trace.append(metadata_event('process_name', start['pid'], start['pid'], {'name': name}))
+    trace.append(metadata_event('process_sort_index', start['pid'], start['pid'], {'sort_index': i}))
+
+  # Assign each subprocess to the first lane of its parent that is free by the
+  # time it is spawned.
+  lanes = {}
+  profiled = {(start['parentPid'], start['pid']): start for start in processes if 'parentPid' in start}
+  for spawn, finish in sorted(subprocesses, key=lambda s: s[0]['time']):
+    pid = spawn['pid']
+    lane_ends = lanes.setdefault(pid, [])
+    for lane, end in enumerate(lane_ends):
+      if end <= spawn['time']:
+        break
+    else:
+      lane = len(lane_ends)
+      lane_ends.append(0)
+      trace.append(metadata_event('thread_name', pid, lane + 1, {'name': f'subprocesses {lane + 1}'}))
+    lane_ends[lane] = finish['time']
+    args = event_args(spawn, finish)
+    args['pid'] = spawn['targetPid']
+    trace.append(complete_event(tool_name(spawn['cmdLine']), 'subprocess', pid, lane + 1, spawn, finish, args))
+
+    child = profiled.get((pid, spawn['targetPid']))
+    if child:
+      flow = {'name': 'spawn', 'cat': 'spawn', 'id': len(trace)}
+      trace.append(dict(flow, ph='s', pid=pid, tid=lane + 1, ts=ts(spawn)))
+      trace.append(dict(flow, ph='f', bp='e', pid=child['pid'], tid=child['pid'], ts=ts(child)))
+
+  return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+
+def create_trace_file(events, outfile):
+  trace_file = outfile + '.json'
+  with open(trace_file, 'w') as f:
+    json.dump(create_trace(events), f, separators=(',', ':'))
+  print(f'Wrote "{trace_file}"')
+  return 0
+
+
+# The phases of a build that --report and --diff break the time down into.
+# "emcc" is the time spent in the python code of the profiled tools themselves,
+# outside of any subprocess.
+PHASES = ['compile', 'llvm-nm', 'wasm-ld', 'finalize', 'wasm-opt', 'acorn', 'closure', 'emcc', 'other']
+
+# Changes in time smaller than this are ignored by --diff --threshold, since
+# they are mostly noise.
+DIFF_MIN_SECONDS = 0.1
+
+
+def phase_of(name):
+  if name.startswith('clang'):
+    return 'compile'
+  if name in ('llvm-nm', 'wasm-ld', 'wasm-opt'):
+    return name
+  if name == 'wasm-emscripten-finalize':
+    return 'finalize'
+  if name == 'acorn-optimizer.js':
+    return 'acorn'
+  if 'closure' in name:
+    return 'closure'
+  return 'other'
+
+
+class Invocation:
+  def __init__(self, event):
+    self.name = event['name']
+    self.pid = event['pid']
+    self.start = event['ts'] / 1000000
+    self.end = (event['ts'] + event['dur']) / 1000000
+    self.duration = self.end - self.start
+    self.args = event['args']
+    self.is_process = event['cat'] == 'process'
+    self.phase = 'emcc' if self.is_process else phase_of(self.name)
+    self.subprocesses = []
+    # For a subprocess that was profiled itself, the process it became.
+    self.process = None
+    self.spawned = False
+
+  def command(self):
+    name, args = split_command(self.args['cmdLine'])
+    command = ' '.join([name] + args)
+    if len(command) > 120:
+      command = command[:117] + '...'
+    return command
+
+
+# The profiled processes of a build and the subprocesses they ran, read from
+# the events of a trace written by create_trace().
+class Profile:
+  def __init__(self, trace_events):
+    self.processes = []
+    self.subprocesses = []
+    for e in trace_events:
+      if e.get('ph') == 'X' and e.get('cat') == 'process':
+        self.processes.append(Invocation(e))
+      elif e.get('ph') == 'X' and e.get('cat') == 'subprocess':
+        self.subprocesses.append(Invocation(e))
+
+    # PIDs may have been reused over the build, so match processes by time too.
+    processes_by_pid = {}
+    for p in self.processes:
+      processes_by_pid.setdefault(p.pid, []).append(p)
+    for s in self.subprocesses:
+      for p in processes_by_pid.get(s.pid, []):
+        if p.start <= s.start <= p.end:
+          p.subprocesses.append(s)
+      for p in processes_by_pid.get(s.args.get('pid'), []):
+        if s.start <= p.start <= s.end:
+          s.process = p
+          p.spawned = True
+    self.top_level = [p for p in self.processes if not p.spawned]
+
+  def wall_time(self):
+    if not self.processes:
+      return 0
+    return max(p.end for p in self.processes) - min(p.start for p in self.processes)
+
+  def phase_totals(self):
+    totals = {phase: {'count': 0, 'time': 0, 'cpuTime': 0, 'maxRss': 0} for phase in PHASES}
+
+    def add(phase, time, args):
+      t = totals[phase]
+      t['count'] += 1
+      t['time'] += time
+      t['cpuTime'] += args.get('cpuTime', 0)
+      t['maxRss'] = max(t['maxRss'], args.get('maxRss', 0))
+
+    for p in self.processes:
+      add('emcc', self_time(p), p.args)
+    for s in self.subprocesses:
+      # The time of profiled subprocesses is accounted for by their own
+      # subprocesses and self time.
+      if not s.process:
+        add(s.phase, s.duration, s.args)
+    return totals
+
+  # Returns the critical path through the top level processes of the build,
+  # along with how much of it was spent in each phase.
+  def critical_path(self):
+    path = critical_path(self.top_level)
+    phases = dict.fromkeys(PHASES, 0)
+    for p in path:
+      add_critical_path_phases(p, phases)
+    return path, phases
+
+
+# Returns the time of a process that was not spent waiting on a subprocess.
+def self_time(process):
+  busy = 0
+  busy_until = process.start
+  for s in sorted(process.subprocesses, key=lambda s: s.start):
+    if s.end > busy_until:
+      busy += s.end - max(s.start, busy_until)
+      busy_until = s.end
+  return max(process.duration - busy, 0)
+
+
+# Without knowing the dependencies between the invocations, assume that each
+# one waited for the one that finished last before it started, and follow that
+# chain back from the invocation that finished last.
+def critical_path(invocations):
+  by_end = sorted(invocations, key=lambda i: i.end)
+  ends = [i.end for i in by_end]
+  path = []
+  current = by_end[-1] if by_end else None
+  while current:
+    path.append(current)
+    index = bisect.bisect_left(ends, current.start)
+    current = by_end[index - 1] if index else None
+  return path[::-1]
+
+
+def add_critical_path_phases(invocation, phases):
+  if invocation.process:
+    invocation = invocation.process
+  if not invocation.is_process:
+    phases[invocation.phase] += invocation.duration
+    return
+  waited = 0
+  for s in critical_path(invocation.subprocesses):
+    add_critical_path_phases(s, phases)
+    waited += s.duration
+  phases['emcc'] += max(invocation.duration - waited, 0)
+
+
+def load_profile(filename):
+  with open(filename) as f:
+    trace = json.load(f)
+  # The trace format allows either an object or a bare array of events.
+  if isinstance(trace, dict):
+    trace = trace['traceEvents']
+  return Profile(trace)
+
+
+def print_report(profile, top):
+  print(f'{len(profile.processes)} processes, {len(profile.subprocesses)} subprocesses, {profile.wall_time():.2f}s wall time')
+  print()
+  print('Phase               Count     Time (s)      CPU (s)   Peak RSS (MB)')
+  for phase, t in profile.phase_totals().items():
+    if t['count']:
+      print(f"{phase:<14} {t['count']:>10} {t['time']:>12.2f} {t['cpuTime']:>12.2f} {t['maxRss'] / (1024 * 1024):>15.1f}")
+  print()
+
+  path, phases = profile.critical_path()
+  if path:
+    length = path[-1].end - path[0].start
+    print(f'Critical path: {length:.2f}s through {len(path)} processes')
+    for phase, seconds in phases.items():
+      if seconds:
+        print(f'  {phase:<14} {seconds:>10.2f}s')
+    print(f'  {"(idle)":<14} {length - sum(phases.values()):>10.2f}s')
+    print()
+
+  def print_slowest(title, invocations):
+    slowest = sorted(invocations, key=lambda i: i.duration, reverse=True)[:top]
+    if slowest:
+      print(f'Slowest {title}:')
+      print('    Time (s)      CPU (s)   Peak RSS (MB)   Command')
+      for i in slowest:
+        print(f"{i.duration:>12.2f} {i.args.get('cpuTime', 0):>12.2f} {i.args.get('maxRss', 0) / (1024 * 1024):>15.1f}   {i.command()}")
+      print()
+
+  print_slowest('processes', profile.processes)
+  print_slowest('tools', [s for s in profile.subprocesses if not s.process])
+  return 0
+
+
+def profile_summary(profile):
+  path, phases = profile.critical_path()
+  summary = {
+    'total': profile.wall_time(),
+    'critical path': path[-1].end - path[0].start if path else 0,
+  }
+  for phase, t in profile.phase_totals().items():
+    summary[phase] = t['time']
+  return summary
+
+
+# Compares the time spent in each phase of two profiles. Returns 1 if a
+# threshold (in percent) is given and any of them got slower by more than that.
+def diff_profiles(old, new, threshold):
+  old_summary = profile_summary(old)
+  new_summary = profile_summary(new)
+  regressed = False
+  print('                        Old (s)      New (s)   Change (s)   Change (%)')
+  for key in old_summary:
+    old_time = old_summary[key]
+    new_time = new_summary[key]
+    if not old_time and not new_time:
+      continue
+    change = new_time - old_time
+    percent = f'{change / old_time * 100:+11.1f}%' if old_time else ' ' * 11 + '-'
+    mark = ''
+    if threshold is not None and change > DIFF_MIN_SECONDS and (not old_time or change / old_time * 100 > threshold):
+      mark = '  <- regression'
+      regressed = True
+    print(f'{key:<18} {old_time:>12.2f} {new_time:>12.2f} {change:>+12.2f} {percent}{mark}')
+  return 1 if regressed else 0
+
+
 def main(args):
   if '--help' in args:
     print('''\
@@ -78,7 +419,7 @@ Usage:
          Use this to abort/drop any previously collected
          profiling data for a new profiling run.
 
-       emprofile.py [--no-clear]
+       emprofile.py [--no-clear] [--trace]
          Draws a graph from all recorded profiling log files,
          and deletes the recorded profiling files, unless
          --no-clear is also passed.
@@ -87,9 +428,54 @@ Optional parameters:
 
         --outfile=x.html (or -o=x.html)
           Specifies the name of the results file to generate.
+
+        --trace
+          Writes the results as a .json file in the Chrome Trace
+          Event Format instead of a HTML page. It can be viewed
+          in https://ui.perfetto.dev or chrome://tracing.
+
+       emprofile.py --report [--top=N] [trace.json]
+         Prints the time spent in each phase of the build (compile,
+         llvm-nm, wasm-ld, ...), the critical path through the build
+         and the N slowest (10 by default) processes and tools, from
+         the recorded profiling log files or from a trace written
+         with --trace. The log files are not deleted.
+
+       emprofile.py --diff old.json new.json [--threshold=PERCENT]
+         Compares the phase times of two traces written with --trace.
+         With --threshold, returns an error if any of them got slower
+         by more than the given percentage.
 ''')
     return 0
 
+  files = []
+  top = 10
+  threshold = None
+  for i, arg in enumerate(args):
+    if arg.startswith('--top='):
+      top = int(arg.split('=', 1)[1])
+    elif arg.startswith('--threshold='):
+      threshold = float(arg.split('=', 1)[1])
+    elif not arg.startswith('-') and (i == 0 or args[i - 1] != '-o'):
+      files.append(arg)
+
+  if '--diff' in args:
+    if len(files) != 2:
+      print('emprofile.py --diff takes two trace files to compare', file=sys.stderr)
+      return 1
+    return diff_profiles(load_profile(files[0]), load_profile(files[1]), threshold)
+
+  if '--report' in args:
+    if files:
+      profile = load_profile(files[0])
+    else:
+      events = load_profiler_logs()
+      if not events:
+        return 1
+      profile = Profile(create_trace(events)['traceEvents'])
+      print()
+    return print_report(profile, top)
+
   if '--reset' in args or '--clear' in args or '-c' in args:
     delete_profiler_logs()
     return 0
@@ -97,11 +483,16 @@ Optional parameters:
     outfile = 'toolchain_profiler.results_' + time.strftime('%Y%m%d_%H%M')
     for i, arg in enumerate(args):
       if arg.startswith('--outfile=') or arg.startswith('-o='):
-        outfile = arg.split('=', 1)[1].strip().replace('.html', '')
+        outfile = arg.split('=', 1)[1].strip()
       elif arg == '-o':
-        outfile = args[i + 1].strip().replace('.html', '')
-    if create_profiling_graph(outfile):
+        outfile = args[i + 1].strip()
+    events = load_profiler_logs()
+    if not events:
       return 1
+    if '--trace' in args:
+      create_trace_file(events, outfile.replace('.json', ''))
+    else:
+      create_profiling_graph(events, outfile.replace('.html', ''))
     if '--no-clear' not in args:
       delete_profiler_logs()
 
@@ -21,7 +21,7 @@ data downloads.
 
 Usage:
 
-  file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--use-preload-plugins] [--no-node]
+  file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--compress=CODECS] [--compress-threshold=R] [--lazy-load] [--lazy-load-chunk-size=N] [--prefetch P [Q..]] [--use-preload-plugins] [--no-node]
 
   --preload  ,
   --embed    See emcc --help for more details on those options.
@@ -42,6 +42,8 @@ Usage:
   --no-force Don't create output if no valid input file is specified.
 
   --use-preload-cache Stores package in IndexedDB so that subsequent loads don't need to do XHR. Checks package version.
+                      The package is stored in chunks keyed by their contents, so that after an update only the chunks
+                      that changed are downloaded (using HTTP range requests).
 
   --indexedDB-name Use specified IndexedDB database name (Default: 'EM_PRELOAD_CACHE')
 
@@ -50,6 +52,28 @@ Usage:
   --lz4 Uses LZ4. This compresses the data using LZ4 when this utility is run, then the client decompresses chunks on the fly, avoiding storing
         the entire decompressed data in memory at once. See LZ4 in src/settings.js, you must build the main program with that flag.
 
+  --compress=CODECS Compresses each preloaded file with whichever of the given comma-separated codecs (gzip, brotli or zstd)
+                    works best. The files are decompressed individually when the package is loaded, using
+                    DecompressionStream in browsers (gzip only) and zlib in Node.js. brotli and zstd require the `brotli` and
+                    `zstandard` python packages respectively, and in browsers a decoder must be provided by defining
+                    Module.decompressPackageFile(codec, data, callback).
+
+  --compress-threshold=R A file is only stored compressed if that reduces its size to at most this ratio (default 0.9)
+                         of the original.
+
+  --lazy-load Rather than downloading the whole package before startup, fetch the contents of each preloaded file from the
+              package using an HTTP range request when the file is first opened. Only the files matching --prefetch are
+              downloaded before startup. Files are fetched synchronously when opened, which on the main browser thread
+              means reading them as text (so it is best to run the program in a worker). Module.fetchPackageRange(url,
+              start, end) can be defined to override how ranges are fetched. Cannot be used with --lz4, --use-preload-cache
+              or --use-preload-plugins.
+
+  --lazy-load-chunk-size=N The package is fetched in chunks of this many bytes (default 1MB), so that neighboring small
+                           files can share a request.
+
+  --prefetch P [Q..] Specifies filename patterns (matched against the path in the virtual file system, e.g. /data/*.png) of
+                     preloaded files that are needed at startup when using --lazy-load.
+
   --use-preload-plugins Tells the file packager to run preload plugins on the files as they are loaded. This performs tasks like decoding images
                         and audio using the browser's codecs.
 
@@ -64,13 +88,18 @@ Notes:
 import base64
 import ctypes
 import fnmatch
+import gzip
 import hashlib
+import io
 import json
 import os
 import posixpath
 import random
+import re
 import shutil
+import stat
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import PIPE
 from textwrap import dedent
 
@@ -78,7 +107,7 @@ __scriptdir__ = os.path.dirname(os.path.abspath(__file__))
 __rootdir__ = os.path.dirname(__scriptdir__)
 sys.path.append(__rootdir__)
 
-from tools import shared, utils, js_manipulation
+from tools import config, shared, utils, js_manipulation
 
 
 DEBUG = os.environ.get('EMCC_DEBUG')
@@ -93,6 +122,21 @@ DDS_HEADER_SIZE = 128
 # to work around silly av false positives
 AV_WORKAROUND = 0
 
+# With --use-preload-cache the package is stored in IndexedDB in chunks, keyed
+# by their contents, so that after an update only the chunks that changed need
+# to be downloaded.  A chunk ends after a file whose hash is a multiple of
+# CACHE_CHUNK_FILES (or once it is at least CACHE_CHUNK_SIZE), so that unlike
+# with fixed-size chunks, adding or resizing a file only affects the chunks
+# around it.  No chunk is larger than CACHE_CHUNK_MAX_SIZE, to stay well below
+# the limit browsers have on the size of IndexedDB entries.
+CACHE_CHUNK_FILES = 16
+CACHE_CHUNK_SIZE = 1024 * 1024
+CACHE_CHUNK_MAX_SIZE = 16 * 1024 * 1024
+
+# The maximum number of data bundle manifests kept in the cache.  The manifests
+# of the least recently written bundles are removed once this is exceeded.
+MAX_MANIFESTS = 200
+
 excluded_patterns = []
 new_data_files = []
 
@@ -117,6 +161,11 @@ class Options:
     # which makes js-output file to mutate on each invocation of this packager tool.
     self.separate_metadata = False
     self.lz4 = False
+    self.compress = []
+    self.compress_threshold = 0.9
+    self.lazy_load = False
+    self.lazy_load_chunk_size = 1024 * 1024
+    self.prefetch_patterns = []
     self.use_preload_plugins = False
     self.support_node = True
     self.wasm64 = False
@@ -128,6 +177,17 @@ class DataFile:
     self.dstpath = dstpath
     self.mode = mode
     self.explicit_dst_path = explicit_dst_path
+    self.size = None
+    self.mtime = None
+    # With --lazy-load, whether the contents are fetched when the file is first
+    # opened rather than at startup.
+    self.lazy = False
+    # With --compress, the codec the file is compressed with in the bundle (if
+    # any).
+    self.codec = None
+    # An earlier file with the same contents, if any.  Only one copy of the
+    # contents is stored in the data bundle.
+    self.duplicate_of = None
 
 
 options = Options()
@@ -182,16 +242,19 @@ def add(mode, rootpathsrc, rootpathdst):
   rootpathdst: The name we want to make the source path available on the
                emscripten virtual FS.
   """
+  # Visit the files in a consistent order, so that the layout of the data
+  # bundle only changes where files were added or removed (which allows
+  # --use-preload-cache to reuse the rest of it).
   for dirpath, dirnames, filenames in os.walk(rootpathsrc):
     new_dirnames = []
-    for name in dirnames:
+    for name in sorted(dirnames):
       fullname = os.path.join(dirpath, name)
       if not should_ignore(fullname):
         new_dirnames.append(name)
       elif DEBUG:
         err('Skipping directory "%s" from inclusion in the emscripten '
             'virtual file system.' % fullname)
-    for name in filenames:
+    for name in sorted(filenames):
       fullname = os.path.join(dirpath, name)
       if not should_ignore(fullname):
         # Convert source filename relative to root directory of target FS.
@@ -206,44 +269,357 @@ def add(mode, rootpathsrc, rootpathdst):
     dirnames.extend(new_dirnames)
 
 
+def stat_files(data_files):
+  """Stat all the given files, filling in their size and mtime, and return
+  only those that are not directories.
+
+  This is done on a thread pool since for large directory trees (and
+  especially on network filesystems) the stat calls can otherwise dominate.
+  """
+  def stat_file(path):
+    try:
+      return os.stat(path)
+    except OSError:
+      # Reported later, when we try to read the file.
+      return None
+
+  def stat_batch(batch):
+    return [stat_file(f.srcpath) for f in batch]
+
+  # Hand out the files in batches, as scheduling each stat call separately
+  # costs more than the call itself for local files.
+  batch_size = 256
+  batches = [data_files[i:i + batch_size] for i in range(0, len(data_files), batch_size)]
+  with ThreadPoolExecutor() as executor:
+    stats = [st for batch in executor.map(stat_batch, batches) for st in batch]
+  result = []
+  for file_, st in zip(data_files, stats):
+    if st:
+      if stat.S_ISDIR(st.st_mode):
+        continue
+      file_.size = st.st_size
+      file_.mtime = st.st_mtime_ns
+    result.append(file_)
+  return result
+
+
+def copy_file_data(src, dst, package_hash=None):
+  """Append the contents of the file object `src` to `dst`, and return the
+  number of bytes copied.
+
+  If `package_hash` is given it is updated with the data as it is copied,
+  otherwise the kernel is left to do the copy where possible.
+  """
+  if package_hash is None and hasattr(os, 'sendfile'):
+    dst.flush()
+    offset = 0
+    try:
+      while True:
+        sent = os.sendfile(dst.fileno(), src.fileno(), offset, 1024 * 1024 * 1024)
+        if not sent:
+          return offset
+        offset += sent
+    except OSError:
+      if offset:
+        raise
+      # sendfile does not support these files; fall back to copying below.
+  size = 0
+  for chunk in iter(lambda: src.read(1024 * 1024), b''):
+    if package_hash:
+      package_hash.update(chunk)
+    dst.write(chunk)
+    size += len(chunk)
+  return size
+
+
+def hash_file(filename):
+  package_hash = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      package_hash.update(chunk)
+  return package_hash
+
+
+def find_duplicates(data_files):
+  """Find the files that have the same contents as an earlier file, setting
+  their `duplicate_of`.  Only files whose size matches that of another file
+  need to be read."""
+  by_size = {}
+  for file_ in data_files:
+    if file_.size is not None:
+      by_size.setdefault(file_.size, []).append(file_)
+  candidates = [f for group in by_size.values() if len(group) > 1 for f in group]
+  if not candidates:
+    return
+  with ThreadPoolExecutor() as executor:
+    digests = executor.map(lambda f: hash_file(f.srcpath).digest(), candidates)
+  seen = {}
+  for file_, digest in zip(candidates, digests):
+    key = (file_.size, digest)
+    if key in seen:
+      file_.duplicate_of = seen[key]
+      if DEBUG:
+        err('"%s" has the same contents as "%s"' % (file_.srcpath, file_.duplicate_of.srcpath))
+    else:
+      seen[key] = file_
+
+
+def write_data_bundle(data_target, data_files, package_hash=None):
+  """Bundle all the data files into a single archive, streaming the contents
+  of each file rather than reading it into memory."""
+  start = 0
+  with open(data_target, 'wb') as data:
+    for file_ in data_files:
+      file_.data_start = start
+      with open(file_.srcpath, 'rb') as f:
+        size = copy_file_data(f, data, package_hash)
+      file_.data_end = start + size
+      start += size
+      if AV_WORKAROUND:
+        padding = b'\x00'
+        if package_hash:
+          package_hash.update(padding)
+        data.write(padding)
+        start += len(padding)
+  return start
+
+
+def get_manifest_file(data_target):
+  # Manifests live in the cache, rather than next to the bundle, so that they
+  # are not mistakenly deployed along with it.
+  if config.FROZEN_CACHE:
+    return None
+  key = hashlib.sha256(os.path.abspath(data_target).encode('utf-8')).hexdigest()
+  return shared.Cache.get_path(os.path.join('file_packager', key + '.json'))
+
+
+def read_manifest(manifest_file, data_target):
+  """Read the manifest describing the existing data bundle, returning None if
+  there isn't one or if the bundle has been modified since it was written."""
+  try:
+    manifest = json.loads(utils.read_file(manifest_file))
+    st = os.stat(data_target)
+  except (OSError, ValueError):
+    return None
+  if manifest['bundle'] != [st.st_size, st.st_mtime_ns]:
+    return None
+  return manifest
+
+
+def write_manifest(manifest_file, data_target, files, package_digest):
+  st = os.stat(data_target)
+  manifest = {
+    'bundle': [st.st_size, st.st_mtime_ns],
+    'files': files,
+    'package_digest': package_digest,
+  }
+  utils.safe_ensure_dirs(os.path.dirname(manifest_file))
+  temp_file = f'{manifest_file}.{os.getpid()}.tmp'
+  utils.write_file(temp_file, json.dumps(manifest))
+  os.replace(temp_file, manifest_file)
+  prune_manifests(os.path.dirname(manifest_file))
+
+
+def prune_manifests(manifest_dir):
+  entries = [e for e in os.scandir(manifest_dir) if e.name.endswith('.json')]
+  if len(entries) <= MAX_MANIFESTS:
+    return
+  entries.sort(key=lambda e: e.stat().st_mtime)
+  for entry in entries[:len(entries) - MAX_MANIFESTS]:
+    if DEBUG:
+      err('removing data bundle manifest: %s' % entry.name)
+    shared.try_delete(entry.path)
+
+
+def patch_data_bundle(data_target, data_files, changed):
+  """Rewrite just the given files in an existing data bundle.  Returns False
+  if this isn't possible because the size of a file changed."""
+  with open(data_target, 'r+b') as data:
+    for file_ in changed:
+      if DEBUG:
+        err('updating %s in data bundle' % file_.srcpath)
+      data.seek(file_.data_start)
+      with open(file_.srcpath, 'rb') as f:
+        size = copy_file_data(f, data)
+      if size != file_.data_end - file_.data_start:
+        return False
+  return True
+
+
+def update_data_bundle(data_target, data_files, compute_hash):
+  """Like `write_data_bundle`, but avoids rewriting the data bundle when the
+  input files have not changed since it was last written.
+
+  A manifest recording the path, size and mtime of each file in the bundle is
+  kept in the cache.  If the same files are being bundled then only those
+  whose mtime changed are rewritten in place (or none at all, in which case
+  the bundle keeps its timestamp).  Otherwise the whole bundle is written.
+
+  Returns the size of the bundle, and its sha256 if `compute_hash` is set.
+  """
+  manifest_file = get_manifest_file(data_target)
+  files = [[os.path.abspath(f.srcpath), f.size, f.mtime] for f in data_files]
+  manifest = manifest_file and read_manifest(manifest_file, data_target)
+  package_digest = None
+  if manifest and [f[:2] for f in manifest['files']] == [f[:2] for f in files]:
+    start = 0
+    changed = []
+    for file_, old in zip(data_files, manifest['files']):
+      file_.data_start = start
+      file_.data_end = start + file_.size
+      start = file_.data_end
+      if old[2] != file_.mtime:
+        changed.append(file_)
+    if not changed:
+      if DEBUG:
+        err('data bundle is up to date: %s' % data_target)
+      package_digest = manifest['package_digest']
+    elif not patch_data_bundle(data_target, data_files, changed):
+      manifest = None
+  else:
+    manifest = None
+
+  if not manifest:
+    package_hash = hashlib.sha256() if compute_hash else None
+    start = write_data_bundle(data_target, data_files, package_hash)
+    if package_hash:
+      package_digest = package_hash.hexdigest()
+
+  if compute_hash and not package_digest:
+    package_digest = hash_file(data_target).hexdigest()
+  if manifest_file:
+    write_manifest(manifest_file, data_target, files, package_digest)
+  return start, package_digest
+
+
+def compute_cache_chunks(data_target, data_files):
+  """Split the data bundle into the chunks that are stored in IndexedDB with
+  --use-preload-cache, with boundaries after the given files.  Returns a list of
+  the end offset and hash of each chunk."""
+  files = sorted((f for f in data_files if not f.duplicate_of), key=lambda f: f.data_end)
+  files.append(None)
+  size = os.path.getsize(data_target)
+  chunks = []
+  chunk_start = pos = 0
+  chunk_hash = hashlib.sha256()
+
+  def end_chunk():
+    nonlocal chunk_start, chunk_hash
+    chunks.append([pos, chunk_hash.hexdigest()[:32]])
+    chunk_start = pos
+    chunk_hash = hashlib.sha256()
+
+  with open(data_target, 'rb') as data:
+    for file_ in files:
+      # Any padding after the last file is part of the final chunk.
+      end = file_.data_end if file_ else size
+      file_hash = hashlib.sha256()
+      while pos < end:
+        contents = data.read(min(end - pos, chunk_start + CACHE_CHUNK_MAX_SIZE - pos))
+        assert contents, 'unexpected end of data bundle'
+        file_hash.update(contents)
+        chunk_hash.update(contents)
+        pos += len(contents)
+        if pos - chunk_start == CACHE_CHUNK_MAX_SIZE:
+          end_chunk()
+      if pos > chunk_start:
+        if not file_ or pos - chunk_start >= CACHE_CHUNK_SIZE or \
+           int.from_bytes(file_hash.digest()[:4], 'little') % CACHE_CHUNK_FILES == 0:
+          end_chunk()
+  return chunks
+
+
+def compress_gzip(data):
+  # Use a fixed mtime so that the output is deterministic.
+  out = io.BytesIO()
+  with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as f:
+    f.write(data)
+  return out.getvalue()
+
+
+def compress_brotli(data):
+  import brotli
+  return brotli.compress(data)
+
+
+def compress_zstd(data):
+  import zstandard
+  return zstandard.ZstdCompressor(level=19).compress(data)
+
+
+COMPRESSORS = {
+  'gzip': compress_gzip,
+  'brotli': compress_brotli,
+  'zstd': compress_zstd,
+}
+
+
+def compress_file(file_):
+  """Read the given file, and compress it with whichever of the enabled codecs
+  works best.  Returns the codec (or None, if compression doesn't reduce the
+  size enough to be worthwhile) along with the data to store."""
+  data = utils.read_binary(file_.srcpath)
+  best_codec = None
+  best = data
+  if file_.mode != 'preload':
+    # Embedded files are never compressed.
+    return None, data
+  for codec in options.compress:
+    compressed = COMPRESSORS[codec](data)
+    if len(compressed) <= len(data) * options.compress_threshold and len(compressed) < len(best):
+      best_codec = codec
+      best = compressed
+  return best_codec, best
+
+
+def write_compressed_bundle(data_target, data_files, package_hash=None):
+  """Like `write_data_bundle`, but compresses each preloaded file with
+  `compress_file`.  Files are compressed in parallel (the compressors release
+  the GIL), a batch at a time to bound memory usage."""
+  start = 0
+  batch_size = shared.get_num_cores() * 4
+  with open(data_target, 'wb') as data, ThreadPoolExecutor() as executor:
+    for i in range(0, len(data_files), batch_size):
+      batch = data_files[i:i + batch_size]
+      for file_, (codec, contents) in zip(batch, executor.map(compress_file, batch)):
+        file_.codec = codec
+        if package_hash:
+          package_hash.update(contents)
+        data.write(contents)
+        file_.data_start = start
+        file_.data_end = start + len(contents)
+        start = file_.data_end
+  return start
+
+
+# See MCAsmStreamer::PrintQuotedString in llvm/lib/MC/MCAsmStreamer.cpp
+# And isPrint in llvm/include/llvm/ADT/StringExtras.h
+ASM_STRING_ESCAPES = {c: '\\%03o' % c for c in range(256) if c < 0x20 or c > 0x7E}
+ASM_STRING_ESCAPES.update({
+  ord('\b'): '\\b',
+  ord('\f'): '\\f',
+  ord('\n'): '\\n',
+  ord('\r'): '\\r',
+  ord('\t'): '\\t',
+  ord('"'): '\\"',
+  ord('\\'): '\\\\',
+})
+
+
 def to_asm_string(string):
   """Convert a python string to string suitable for including in an
   assembly file using the `.asciz` directive.
 
   The result will be an UTF-8 encoded string in the data section.
   """
-  # See MCAsmStreamer::PrintQuotedString in llvm/lib/MC/MCAsmStreamer.cpp
-  # And isPrint in llvm/include/llvm/ADT/StringExtras.h
-
-  def is_print(c):
-    return c >= 0x20 and c <= 0x7E
-
-  def escape(c):
-    if is_print(c):
-      return chr(c)
-    escape_chars = {
-      '\b': '\\b',
-      '\f': '\\f',
-      '\n': '\\n',
-      '\r': '\\r',
-      '\t': '\\t',
-    }
-    if c in escape_chars:
-      return escape_chars[c]
-    # Enscode all other chars are three octal digits(!)
-    return '\\%s%s%s' % (oct(c >> 6), oct(c >> 3), oct(c >> 0))
-
-  return ''.join(escape(c) for c in string.encode('utf-8'))
+  # Decoding as latin-1 maps each byte of the UTF-8 encoding to a single
+  # character, which lets us escape them all with a single `translate`.
+  return string.encode('utf-8').decode('latin-1').translate(ASM_STRING_ESCAPES)
 
 
 def to_c_symbol(filename, used):
   """Convert a filename (python string) to a legal C symbols, avoiding collisions."""
-  def escape(c):
-     if c.isalnum():
-       return c
-     else:
-       return '_'
-  c_symbol = ''.join(escape(c) for c in filename)
+  c_symbol = re.sub('[^A-Za-z0-9]', '_', filename)
   # Handle collisions
   if c_symbol in used:
     counter = 2
@@ -264,82 +640,85 @@ def generate_object_file(data_files):
   for f in embed_files:
     f.c_symbol_name = '__em_file_data_%s' % to_c_symbol(f.dstpath, used)
 
-  with open(asm_file, 'w') as out:
-    out.write('# Emscripten embedded file data, generated by tools/file_packager.py\n')
+  if options.wasm64:
+    align = 3
+    ptr_type = 'i64'
+    bits = 64
+  else:
+    align = 2
+    ptr_type = 'i32'
+    bits = 32
 
-    for f in embed_files:
-      if DEBUG:
-        err('embedding %s at %s' % (f.srcpath, f.dstpath))
-
-      size = os.path.getsize(f.srcpath)
-      dstpath = to_asm_string(f.dstpath)
-      srcpath = to_unix_path(f.srcpath)
-      out.write(dedent(f'''
-      .section .rodata.{f.c_symbol_name},"",@
-
-      # The name of file
-      {f.c_symbol_name}_name:
-      .asciz "{dstpath}"
-      .size {f.c_symbol_name}_name, {len(dstpath)+1}
-
-      # The size of the file followed by the content itself
-      {f.c_symbol_name}:
-      .incbin "{srcpath}"
-      .size {f.c_symbol_name}, {size}
-      '''))
-
-    if options.wasm64:
-      align = 3
-      ptr_type = 'i64'
-      bits = 64
-    else:
-      align = 2
-      ptr_type = 'i32'
-      bits = 32
-    out.write(dedent(f'''
-      .functype _emscripten_fs_load_embedded_files ({ptr_type}) -> ()
-      .section .text,"",@
-      init_file_data:
-        .functype init_file_data () -> ()
-        global.get __emscripten_embedded_file_data@GOT
-        call _emscripten_fs_load_embedded_files
-        end_function
-
-      # Run init_file_data on startup.
-      # See system/lib/README.md for ordering of system constructors.
-      .section .init_array.49,"",@
-      .p2align {align}
-      .int{bits} init_file_data
-
-      # A list of triples of:
-      # (file_name_ptr, file_data_size, file_data_ptr)
-      # The list in null terminate with a single 0
-      .globl __emscripten_embedded_file_data
-      .export_name __emscripten_embedded_file_data, __emscripten_embedded_file_data
-      .section .rodata.__emscripten_embedded_file_data,"",@
-      __emscripten_embedded_file_data:
-      .p2align {align}
-      '''))
-
-    for f in embed_files:
-      # The `.dc.a` directive gives us a pointer (address) sized entry.
-      # See https://sourceware.org/binutils/docs/as/Dc.html
-      out.write(dedent(f'''\
-        .p2align %s
-        .dc.a {f.c_symbol_name}_name
-        .p2align %s
-        .int32 {os.path.getsize(f.srcpath)}
-        .p2align %s
-        .dc.a {f.c_symbol_name}
-        ''' % (align, align, align)))
-
-    ptr_size = 4
-    elem_size = (2 * ptr_size) + 4
-    total_size = len(embed_files) * elem_size + 4
-    out.write(dedent(f'''\
-      .dc.a 0
-      .size __emscripten_embedded_file_data, {total_size}
-      '''))
+  # With many small files most of the time is spent generating the assembly,
+  # so build it up in a list (using the sizes from `stat_files`) and write it
+  # out in one go.
+  out = ['# Emscripten embedded file data, generated by tools/file_packager.py\n']
+
+  for f in embed_files:
+    if DEBUG:
+      err('embedding %s at %s' % (f.srcpath, f.dstpath))
+
+    dstpath = to_asm_string(f.dstpath)
+    srcpath = to_asm_string(to_unix_path(f.srcpath))
+    out.append(f'''
+.section .rodata.{f.c_symbol_name},"",@
+
+# The name of file
+{f.c_symbol_name}_name:
+.asciz "{dstpath}"
+.size {f.c_symbol_name}_name, {len(f.dstpath.encode('utf-8')) + 1}
+
+# The size of the file followed by the content itself
+{f.c_symbol_name}:
+.incbin "{srcpath}"
+.size {f.c_symbol_name}, {f.size}
+''')
+
+  out.append(dedent(f'''
+    .functype _emscripten_fs_load_embedded_files ({ptr_type}) -> ()
+    .section .text,"",@
+    init_file_data:
+      .functype init_file_data () -> ()
+      global.get __emscripten_embedded_file_data@GOT
+      call _emscripten_fs_load_embedded_files
+      end_function
+
+    # Run init_file_data on startup.
+    # See system/lib/README.md for ordering of system constructors.
+    .section .init_array.49,"",@
+    .p2align {align}
+    .int{bits} init_file_data
+
+    # A list of triples of:
+    # (file_name_ptr, file_data_size, file_data_ptr)
+    # The list in null terminate with a single 0
+    .globl __emscripten_embedded_file_data
+    .export_name __emscripten_embedded_file_data, __emscripten_embedded_file_data
+    .section .rodata.__emscripten_embedded_file_data,"",@
+    __emscripten_embedded_file_data:
+    .p2align {align}
+    '''))
+
+  for f in embed_files:
+    # The `.dc.a` directive gives us a pointer (address) sized entry.
+    # See https://sourceware.org/binutils/docs/as/Dc.html
+    out.append(f'''\
+.p2align {align}
+.dc.a {f.c_symbol_name}_name
+.p2align {align}
+.int32 {f.size}
+.p2align {align}
+.dc.a {f.c_symbol_name}
+''')
+
+  ptr_size = 4
+  elem_size = (2 * ptr_size) + 4
+  total_size = len(embed_files) * elem_size + 4
+  out.append(dedent(f'''\
+    .dc.a 0
+    .size __emscripten_embedded_file_data, {total_size}
+    '''))
+  utils.write_file(asm_file, ''.join(out))
   if options.wasm64:
     target = 'wasm64-unknown-emscripten'
   else:
@@ -353,7 +732,7 @@ def generate_object_file(data_files):
 
 def main():
   if len(sys.argv) == 1:
-    err('''Usage: file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--use-preload-plugins]
+    err('''Usage: file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--compress=CODECS] [--compress-threshold=R] [--lazy-load] [--lazy-load-chunk-size=N] [--prefetch P [Q..]] [--use-preload-plugins] [--no-node]
   See the source for more details.''')
     return 1
 
@@ -387,6 +766,20 @@ def main():
     elif arg == '--lz4':
       options.lz4 = True
       leading = ''
+    elif arg.startswith('--compress='):
+      options.compress = arg.split('=', 1)[1].split(',')
+      leading = ''
+    elif arg.startswith('--compress-threshold='):
+      options.compress_threshold = float(arg.split('=', 1)[1])
+      leading = ''
+    elif arg == '--lazy-load':
+      options.lazy_load = True
+      leading = ''
+    elif arg.startswith('--lazy-load-chunk-size='):
+      options.lazy_load_chunk_size = int(arg.split('=', 1)[1])
+      leading = ''
+    elif arg == '--prefetch':
+      leading = 'prefetch'
     elif arg == '--use-preload-plugins':
       options.use_preload_plugins = True
       leading = ''
@@ -436,6 +829,8 @@ def main():
         return 1
     elif leading == 'exclude':
       excluded_patterns.append(arg)
+    elif leading == 'prefetch':
+      options.prefetch_patterns.append(arg)
     else:
       err('Unknown parameter:', arg)
       return 1
@@ -449,6 +844,30 @@ def main():
           'and a specified --js-output')
       return 1
 
+  for codec in options.compress:
+    if codec not in COMPRESSORS:
+      err('unknown compression codec: %s (expected one of %s)' % (codec, ', '.join(COMPRESSORS)))
+      return 1
+    try:
+      COMPRESSORS[codec](b'')
+    except ImportError as e:
+      err('%s compression requires the %s python package' % (codec, e.name))
+      return 1
+  if options.compress and (options.lz4 or options.lazy_load):
+    err('--compress cannot be used with --lz4 or --lazy-load')
+    return 1
+
+  if options.lazy_load:
+    if options.lz4 or options.use_preload_cache or options.use_preload_plugins:
+      err('--lazy-load cannot be used with --lz4, --use-preload-cache or --use-preload-plugins')
+      return 1
+    if options.lazy_load_chunk_size <= 0:
+      err('--lazy-load-chunk-size must be positive')
+      return 1
+  elif options.prefetch_patterns:
+    err('--prefetch is only applicable with --lazy-load')
+    return 1
+
   if not options.from_emcc:
     err('Remember to build the main file with `-sFORCE_FILESYSTEM` '
         'so that it includes support for loading this file package')
@@ -463,8 +882,7 @@ def main():
         add(file_.mode, file_.srcpath, file_.dstpath)
       else:
         new_data_files.append(file_)
-  data_files = [file_ for file_ in new_data_files
-                if not os.path.isdir(file_.srcpath)]
+  data_files = stat_files(new_data_files)
   if len(data_files) == 0:
     err('Nothing to do!')
     sys.exit(1)
@@ -530,6 +948,14 @@ def main():
     for plugin in plugins:
       plugin(file_)
 
+  if options.lazy_load:
+    for file_ in data_files:
+      if file_.mode == 'preload':
+        file_.lazy = not any(fnmatch.fnmatch(file_.dstpath, p) for p in options.prefetch_patterns)
+    # Put the files that are needed at startup at the start of the bundle, so
+    # that they can be fetched with a single range request.
+    data_files.sort(key=lambda f: f.mode != 'preload' or f.lazy)
+
   metadata = {'files': []}
 
   if options.obj_output:
@@ -565,6 +991,42 @@ def main():
   return 0
 
 
+def decompress_code():
+  node_code = ''
+  if options.support_node:
+    node_code = '''
+        if (typeof process === 'object' && typeof process.versions === 'object' && typeof process.versions.node === 'string') {
+          var zlib = require('zlib');
+          var decompress = {
+            'gzip': zlib.gunzipSync,
+            'brotli': zlib.brotliDecompressSync,
+            'zstd': zlib.zstdDecompressSync
+          }[codec];
+          if (decompress) {
+            var result = decompress(data);
+            callback(new Uint8Array(result.buffer, result.byteOffset, result.length));
+            return;
+          }
+        }'''
+  return '''
+      // Decompress a file in the package that was compressed with the given
+      // codec (see --compress), and pass the result to callback.
+      function decompressFile(codec, data, callback) {
+        if (Module['decompressPackageFile']) {
+          Module['decompressPackageFile'](codec, data, callback);
+          return;
+        }%s
+        if (codec == 'gzip' && typeof DecompressionStream !== 'undefined') {
+          var stream = new Blob([data]).stream().pipeThrough(new DecompressionStream('gzip'));
+          new Response(stream).arrayBuffer().then(function(buffer) {
+            callback(new Uint8Array(buffer));
+          });
+          return;
+        }
+        throw new Error('no decoder for ' + codec + ' compressed package files; define Module.decompressPackageFile');
+      }\n''' % node_code
+
+
 def generate_js(data_target, data_files, metadata):
   # emcc will add this to the output itself, so it is only needed for
   # standalone calls
@@ -607,20 +1069,31 @@ def generate_js(data_target, data_files, metadata):
 
   if options.has_preloaded:
     # Bundle all datafiles into one archive. Avoids doing lots of simultaneous
-    # XHRs which has overhead.
-    start = 0
-    with open(data_target, 'wb') as data:
-      for file_ in data_files:
-        file_.data_start = start
-        with open(file_.srcpath, 'rb') as f:
-          curr = f.read()
-        file_.data_end = start + len(curr)
-        if AV_WORKAROUND:
-            curr += '\x00'
-        start += len(curr)
-        data.write(curr)
-
-    if start > 256 * 1024 * 1024:
+    # XHRs which has overhead.  When the package is cached in IndexedDB we
+    # need its hash, which (unless it is compressed afterwards) is computed
+    # along with the bundle.  Files with identical contents are only stored
+    # once, and share the same range of the bundle.
+    find_duplicates(data_files)
+    unique_files = [f for f in data_files if not f.duplicate_of]
+    if options.compress:
+      package_hash = hashlib.sha256() if options.use_preload_cache else None
+      start = write_compressed_bundle(data_target, unique_files, package_hash)
+      package_digest = package_hash.hexdigest() if package_hash else None
+    elif options.lz4 or AV_WORKAROUND:
+      start = write_data_bundle(data_target, unique_files)
+      package_digest = None
+    else:
+      start, package_digest = update_data_bundle(data_target, unique_files, options.use_preload_cache)
+    for file_ in data_files:
+      if file_.duplicate_of:
+        file_.data_start = file_.duplicate_of.data_start
+        file_.data_end = file_.duplicate_of.data_end
+        file_.codec = file_.duplicate_of.codec
+
+    if options.lazy_load:
+      metadata['chunk_size'] = options.lazy_load_chunk_size
+      metadata['prefetch_size'] = max([f.data_end for f in data_files if f.mode == 'preload' and not f.lazy], default=0)
+    elif start > 256 * 1024 * 1024:
       err('warning: file packager is creating an asset bundle of %d MB. '
           'this is very large, and browsers might have trouble loading it. '
           'see https://hacks.mozilla.org/2015/02/synchronous-execution-and-filesystem-access-in-emscripten/'
@@ -640,7 +1113,141 @@ def generate_js(data_target, data_files, metadata):
           Module['FS_createDataFile'](this.name, null, byteArray, true, true, true);
           Module['removeRunDependency']('fp ' + that.name);'''
 
+    if options.lazy_load:
+      code += '''
+      // Lazily loaded files are fetched from the package in chunks of
+      // CHUNK_SIZE bytes.  Chunks are kept until all the lazy files that
+      // overlap them have been loaded, so that small neighboring files can share
+      // a request.
+      var CHUNK_SIZE = metadata['chunk_size'];
+      var chunks = {};
+      var chunkUsers = {};
+
+      function forEachChunk(start, end, func) {
+        if (start >= end) return;
+        for (var i = Math.floor(start / CHUNK_SIZE); i * CHUNK_SIZE < end; i++) {
+          func(i);
+        }
+      }
+
+      // Keep any complete chunks from data that was fetched from the package
+      // (starting at offset) that are still needed.
+      function cachePackageData(data, offset) {
+        forEachChunk(offset, offset + data.length, function(i) {
+          var chunkStart = i * CHUNK_SIZE;
+          var chunkEnd = Math.min(chunkStart + CHUNK_SIZE, REMOTE_PACKAGE_SIZE);
+          if (chunkUsers[i] && !chunks[i] && chunkStart >= offset && chunkEnd <= offset + data.length) {
+            chunks[i] = data.subarray(chunkStart - offset, chunkEnd - offset);
+          }
+        });
+      }
+
+      function getPackageRange(start, end) {
+        var missing = [];
+        forEachChunk(start, end, function(i) {
+          if (!chunks[i]) missing.push(i);
+        });
+        if (missing.length) {
+          // Fetch all the missing chunks with a single request.
+          var from = missing[0] * CHUNK_SIZE;
+          var to = Math.min((missing[missing.length - 1] + 1) * CHUNK_SIZE, REMOTE_PACKAGE_SIZE);
+          var data = fetchPackageRange(from, to);
+          // A server that does not support range requests sends the whole package.
+          cachePackageData(data, data.length == REMOTE_PACKAGE_SIZE ? 0 : from);
+        }
+        var result = new Uint8Array(end - start);
+        forEachChunk(start, end, function(i) {
+          var chunkStart = i * CHUNK_SIZE;
+          var from = Math.max(start - chunkStart, 0);
+          var to = Math.min(end - chunkStart, CHUNK_SIZE);
+          result.set(chunks[i].subarray(from, to), chunkStart + from - start);
+        });
+        return result;
+      }
+
+      function overrideOp(ops, name, func) {
+        var result = {};
+        for (var key in ops) result[key] = ops[key];
+        result[name] = func;
+        return result;
+      }
+
+      // Create a file whose contents are fetched when it is first opened.
+      function createLazyFile(file) {
+        var start = file['start'];
+        var end = file['end'];
+        var node = Module['FS_createDataFile'](file['filename'], null, null, true, true, true);
+        assert(node.node_ops && node.stream_ops, 'lazy loading of file packages is not supported with WASMFS');
+        node.contents = null;
+        node.usedBytes = end - start;
+        forEachChunk(start, end, function(i) {
+          chunkUsers[i] = (chunkUsers[i] || 0) + 1;
+        });
+        var loaded = false;
+        function release() {
+          loaded = true;
+          forEachChunk(start, end, function(i) {
+            if (--chunkUsers[i] == 0) delete chunks[i];
+          });
+        }
+        function load() {
+          if (loaded) return;
+          node.contents = getPackageRange(start, end);
+          node.usedBytes = node.contents.length;
+          release();
+        }
+        node.stream_ops = overrideOp(node.stream_ops, 'open', function(stream) {
+          load();
+        });
+        var setattr = node.node_ops.setattr;
+        node.node_ops = overrideOp(node.node_ops, 'setattr', function(node, attr) {
+          if (attr.size === 0) {
+            // The old contents will never be needed.
+            if (!loaded) release();
+          } else if (attr.size !== undefined) {
+            load();
+          }
+          setattr(node, attr);
+        });
+      }\n'''
+
     if not options.lz4:
+      create_lazy = ''
+      if options.lazy_load:
+        create_lazy = '''
+        if (files[i]['lazy']) {
+          createLazyFile(files[i]);
+          continue;
+        }'''
+      load_data = '''
+          this.finish(byteArray);'''
+      request_fields = []
+      if options.compress:
+        code += decompress_code()
+        load_data = '''
+          if (this.codec) {
+            decompressFile(this.codec, byteArray, this.finish.bind(this));
+          } else {
+            this.finish(byteArray);
+          }'''
+        request_fields.append('codec')
+      if any(f.duplicate_of and f.mode == 'preload' and not f.lazy for f in data_files):
+        load_data = '''
+          // The file system takes ownership of the data, so a file that shares
+          // its contents with an earlier one needs its own copy.
+          if (this.duplicate) byteArray = byteArray.slice();''' + load_data
+        request_fields.append('duplicate')
+      if request_fields:
+        new_request = '''
+        var request = new DataRequest(files[i]['start'], files[i]['end'], files[i]['audio'] || 0);'''
+        for field in request_fields:
+          new_request += '''
+        request.%s = files[i]['%s'];''' % (field, field)
+        new_request += '''
+        request.open('GET', files[i]['filename']);'''
+      else:
+        new_request = '''
+        new DataRequest(files[i]['start'], files[i]['end'], files[i]['audio'] || 0).open('GET', files[i]['filename']);'''
       # Data requests - for getting a block of data out of the big archive - have
       # a similar API to XHRs
       code += '''
@@ -659,8 +1266,7 @@ def generate_js(data_target, data_files, metadata):
         },
         send: function() {},
         onload: function() {
-          var byteArray = this.byteArray.subarray(this.start, this.end);
-          this.finish(byteArray);
+          var byteArray = this.byteArray.subarray(this.start, this.end);%s
         },
         finish: function(byteArray) {
           var that = this;
@@ -670,24 +1276,31 @@ def generate_js(data_target, data_files, metadata):
       };
 
       var files = metadata['files'];
-      for (var i = 0; i < files.length; ++i) {
-        new DataRequest(files[i]['start'], files[i]['end'], files[i]['audio'] || 0).open('GET', files[i]['filename']);
-      }\n''' % (create_preloaded if options.use_preload_plugins else create_data)
+      for (var i = 0; i < files.length; ++i) {%s%s
+      }\n''' % (load_data, create_preloaded if options.use_preload_plugins else create_data, create_lazy, new_request)
 
   if options.has_embedded and not options.obj_output:
     err('--obj-output is recommended when using --embed.  This outputs an object file for linking directly into your application is more effecient than JS encoding')
 
-  for counter, file_ in enumerate(data_files):
+  # Embedded files are stored in a single base64 string, which is decoded once.
+  # Each file is then a view into the decoded data.
+  embed_code = ''
+  embedded_data = []
+  embedded_size = 0
+  for file_ in data_files:
     filename = file_.dstpath
     dirname = os.path.dirname(filename)
     basename = os.path.basename(filename)
     if file_.mode == 'embed':
-      # Embed
-      data = base64_encode(utils.read_binary(file_.srcpath))
-      code += "      var fileData%d = '%s';\n" % (counter, data)
+      if options.obj_output:
+        # Embedded in the object file instead.
+        continue
+      data = utils.read_binary(file_.srcpath)
       # canOwn this data in the filesystem (i.e. there is no need to create a copy in the FS layer).
-      code += ("      Module['FS_createDataFile']('%s', '%s', decodeBase64(fileData%d), true, true, true);\n"
-               % (dirname, basename, counter))
+      embed_code += ("      Module['FS_createDataFile'](%s, %s, embeddedData.subarray(%d, %d), true, true, true);\n"
+                     % (json.dumps(dirname), json.dumps(basename), embedded_size, embedded_size + len(data)))
+      embedded_data.append(data)
+      embedded_size += len(data)
     elif file_.mode == 'preload':
       # Preload
       metadata_el = {
@@ -697,20 +1310,39 @@ def generate_js(data_target, data_files, metadata):
       }
       if filename[-4:] in AUDIO_SUFFIXES:
         metadata_el['audio'] = 1
+      if file_.lazy:
+        metadata_el['lazy'] = 1
+      if file_.codec:
+        metadata_el['codec'] = file_.codec
+      if file_.duplicate_of:
+        metadata_el['duplicate'] = 1
 
       metadata['files'].append(metadata_el)
     else:
       assert 0
 
+  if embed_code:
+    code += "      var embeddedData = intArrayFromBase64('%s');\n" % base64_encode(b''.join(embedded_data))
+    code += embed_code
+
   if options.has_preloaded:
     if not options.lz4:
       # Get the big archive and split it up
+      skip_lazy = ''
+      if options.lazy_load:
+        skip_lazy = """
+            if (files[i]['lazy']) continue;"""
       use_data = '''// Reuse the bytearray from the XHR as the source for file reads.
           DataRequest.prototype.byteArray = byteArray;
           var files = metadata['files'];
-          for (var i = 0; i < files.length; ++i) {
+          for (var i = 0; i < files.length; ++i) {%s
             DataRequest.prototype.requests[files[i].filename].onload();
-          }'''
+          }''' % skip_lazy
+      if options.lazy_load:
+        use_data += '''
+          // Keep any chunks that are needed by lazy files, in case this is the
+          // whole package.
+          cachePackageData(byteArray, 0);\n'''
       use_data += ("          Module['removeRunDependency']('datafile_%s');\n"
                    % js_manipulation.escape_for_js_string(data_target))
 
@@ -752,9 +1384,13 @@ def generate_js(data_target, data_files, metadata):
     if options.use_preload_cache:
       # Set the id to a hash of the preloaded data, so that caches survive over multiple builds
       # if the data has not changed.
-      data = utils.read_binary(data_target)
-      package_uuid = 'sha256-' + hashlib.sha256(data).hexdigest()
+      if not package_digest:
+        package_digest = hash_file(data_target).hexdigest()
+      package_uuid = 'sha256-' + package_digest
       metadata['package_uuid'] = str(package_uuid)
+      # LZ4 compresses the bundle as a whole, so file boundaries are
+      # meaningless there.
+      metadata['cache_chunks'] = compute_cache_chunks(data_target, [] if options.lz4 else data_files)
 
       code += r'''
         var PACKAGE_UUID = metadata['package_uuid'];
@@ -770,7 +1406,9 @@ def generate_js(data_target, data_files, metadata):
         var IDB_RO = "readonly";
         var IDB_RW = "readwrite";
         var DB_NAME = "''' + options.indexeddb_name + '''";
-        var DB_VERSION = 1;
+        // Version 1 stored the package in fixed-size chunks, rather than keyed
+        // by their contents.
+        var DB_VERSION = 2;
         var METADATA_STORE_NAME = 'METADATA';
         var PACKAGE_STORE_NAME = 'PACKAGES';
         function openDatabase(callback, errback) {
@@ -801,122 +1439,168 @@ def generate_js(data_target, data_files, metadata):
           };
         };
 
-        // This is needed as chromium has a limit on per-entry files in IndexedDB
-        // https://cs.chromium.org/chromium/src/content/renderer/indexed_db/webidbdatabase_impl.cc?type=cs&sq=package:chromium&g=0&l=177
-        // https://cs.chromium.org/chromium/src/out/Debug/gen/third_party/blink/public/mojom/indexeddb/indexeddb.mojom.h?type=cs&sq=package:chromium&g=0&l=60
-        // We set the chunk size to 64MB to stay well-below the limit
-        var CHUNK_SIZE = 64 * 1024 * 1024;
-
-        function cacheRemotePackage(
-          db,
-          packageName,
-          packageData,
-          packageMeta,
-          callback,
-          errback
-        ) {
-          var transactionPackages = db.transaction([PACKAGE_STORE_NAME], IDB_RW);
-          var packages = transactionPackages.objectStore(PACKAGE_STORE_NAME);
-          var chunkSliceStart = 0;
-          var nextChunkSliceStart = 0;
-          var chunkCount = Math.ceil(packageData.byteLength / CHUNK_SIZE);
-          var finishedChunks = 0;
-          for (var chunkId = 0; chunkId < chunkCount; chunkId++) {
-            nextChunkSliceStart += CHUNK_SIZE;
-            var putPackageRequest = packages.put(
-              packageData.slice(chunkSliceStart, nextChunkSliceStart),
-              'package/' + packageName + '/' + chunkId
-            );
-            chunkSliceStart = nextChunkSliceStart;
-            putPackageRequest.onsuccess = function(event) {
-              finishedChunks++;
-              if (finishedChunks == chunkCount) {
-                var transaction_metadata = db.transaction(
-                  [METADATA_STORE_NAME],
-                  IDB_RW
-                );
-                var metadata = transaction_metadata.objectStore(METADATA_STORE_NAME);
-                var putMetadataRequest = metadata.put(
-                  {
-                    'uuid': packageMeta.uuid,
-                    'chunkCount': chunkCount
-                  },
-                  'metadata/' + packageName
-                );
-                putMetadataRequest.onsuccess = function(event) {
-                  callback(packageData);
-                };
-                putMetadataRequest.onerror = function(error) {
-                  errback(error);
-                };
-              }
-            };
-            putPackageRequest.onerror = function(error) {
-              errback(error);
-            };
-          }
+        // The package is stored in chunks (see compute_cache_chunks in
+        // file_packager.py), keyed by the hash of their contents, so that when
+        // the package is updated only the chunks that changed are downloaded.
+        var CACHE_CHUNKS = metadata['cache_chunks'];
+        // The maximum number of range requests used to download the missing
+        // chunks.  Runs of missing chunks that are close together are fetched
+        // with a single request.
+        var MAX_RANGE_REQUESTS = 8;
+
+        function chunkStart(i) {
+          return i ? CACHE_CHUNKS[i - 1][0] : 0;
         }
 
-        /* Check if there's a cached package, and if so whether it's the latest available */
-        function checkCachedPackage(db, packageName, callback, errback) {
-          var transaction = db.transaction([METADATA_STORE_NAME], IDB_RO);
-          var metadata = transaction.objectStore(METADATA_STORE_NAME);
-          var getRequest = metadata.get('metadata/' + packageName);
-          getRequest.onsuccess = function(event) {
-            var result = event.target.result;
-            if (!result) {
-              return callback(false, null);
-            } else {
-              return callback(PACKAGE_UUID === result['uuid'], result);
-            }
+        function chunkKey(packageName, i) {
+          return 'package/' + packageName + '/' + CACHE_CHUNKS[i][1];
+        }
+
+        /* Read the metadata of the cached package (if any), and whichever of its
+           current chunks are cached (with null for those that are not) */
+        function fetchCachedChunks(db, packageName, callback, errback) {
+          var transaction = db.transaction([METADATA_STORE_NAME, PACKAGE_STORE_NAME], IDB_RO);
+          var cached = null;
+          var chunks = new Array(CACHE_CHUNKS.length);
+          transaction.objectStore(METADATA_STORE_NAME).get('metadata/' + packageName).onsuccess = function(event) {
+            cached = event.target.result || null;
           };
-          getRequest.onerror = function(error) {
+          var packages = transaction.objectStore(PACKAGE_STORE_NAME);
+          CACHE_CHUNKS.forEach(function(chunk, i) {
+            packages.get(chunkKey(packageName, i)).onsuccess = function(event) {
+              chunks[i] = event.target.result || null;
+            };
+          });
+          transaction.oncomplete = function() {
+            callback(cached, chunks);
+          };
+          transaction.onerror = function(error) {
             errback(error);
           };
         }
 
-        function fetchCachedPackage(db, packageName, metadata, callback, errback) {
-          var transaction = db.transaction([PACKAGE_STORE_NAME], IDB_RO);
-          var packages = transaction.objectStore(PACKAGE_STORE_NAME);
+        // Copy the chunks [first, last) out of data, which holds the package
+        // starting at offset.
+        function setChunks(chunks, first, last, data, offset) {
+          for (var i = first; i < last; i++) {
+            chunks[i] = data.slice(chunkStart(i) - offset, CACHE_CHUNKS[i][0] - offset).buffer;
+          }
+        }
 
-          var chunksDone = 0;
-          var totalSize = 0;
-          var chunkCount = metadata['chunkCount'];
-          var chunks = new Array(chunkCount);
-
-          for (var chunkId = 0; chunkId < chunkCount; chunkId++) {
-            var getRequest = packages.get('package/' + packageName + '/' + chunkId);
-            getRequest.onsuccess = function(event) {
-              // If there's only 1 chunk, there's nothing to concatenate it with so we can just return it now
-              if (chunkCount == 1) {
-                callback(event.target.result);
+        function fetchMissingChunks(chunks, callback, errback) {
+          var ranges = [];
+          for (var i = 0; i < chunks.length; i++) {
+            if (chunks[i]) continue;
+            var last = ranges[ranges.length - 1];
+            if (last && last[1] == i) {
+              last[1] = i + 1;
+            } else {
+              ranges.push([i, i + 1]);
+            }
+          }
+          if (!ranges.length) {
+            return callback();
+          }
+          if (ranges.length > MAX_RANGE_REQUESTS) {
+            // Merge the ranges separated by the smallest gaps.
+            var gaps = [];
+            for (var i = 1; i < ranges.length; i++) {
+              gaps.push(chunkStart(ranges[i][0]) - chunkStart(ranges[i - 1][1]));
+            }
+            gaps.sort(function(a, b) { return a - b; });
+            var maxGap = gaps[ranges.length - MAX_RANGE_REQUESTS - 1];
+            var merged = [ranges[0]];
+            for (var i = 1; i < ranges.length; i++) {
+              var last = merged[merged.length - 1];
+              if (merged.length == MAX_RANGE_REQUESTS || chunkStart(ranges[i][0]) - chunkStart(last[1]) <= maxGap) {
+                last[1] = ranges[i][1];
               } else {
-                chunksDone++;
-                totalSize += event.target.result.byteLength;
-                chunks.push(event.target.result);
-                if (chunksDone == chunkCount) {
-                  if (chunksDone == 1) {
-                    callback(event.target.result);
-                  } else {
-                    var tempTyped = new Uint8Array(totalSize);
-                    var byteOffset = 0;
-                    for (var chunkId in chunks) {
-                      var buffer = chunks[chunkId];
-                      tempTyped.set(new Uint8Array(buffer), byteOffset);
-                      byteOffset += buffer.byteLength;
-                      buffer = undefined;
-                    }
-                    chunks = undefined;
-                    callback(tempTyped.buffer);
-                    tempTyped = undefined;
-                  }
-                }
+                merged.push(ranges[i]);
               }
+            }
+            ranges = merged;
+          }
+          var missingSize = 0;
+          ranges.forEach(function(range) {
+            missingSize += chunkStart(range[1]) - chunkStart(range[0]);
+          });
+          if (missingSize > REMOTE_PACKAGE_SIZE / 2 || typeof XMLHttpRequest === 'undefined') {
+            // Most of the package is needed anyhow, so just download all of it.
+            fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE, function(packageData) {
+              setChunks(chunks, 0, chunks.length, new Uint8Array(packageData), 0);
+              callback();
+            }, errback);
+            return;
+          }
+          var pending = ranges.length;
+          ranges.forEach(function(range) {
+            var start = chunkStart(range[0]);
+            var end = chunkStart(range[1]);
+            var xhr = new XMLHttpRequest();
+            xhr.open('GET', REMOTE_PACKAGE_NAME, true);
+            xhr.setRequestHeader('Range', 'bytes=' + start + '-' + (end - 1));
+            xhr.responseType = 'arraybuffer';
+            xhr.onerror = function(event) {
+              errback(new Error("NetworkError for: " + REMOTE_PACKAGE_NAME));
             };
-            getRequest.onerror = function(error) {
-              errback(error);
+            xhr.onload = function(event) {
+              var data = xhr.response && new Uint8Array(xhr.response);
+              if (xhr.status == 206 && data.length == end - start) {
+                setChunks(chunks, range[0], range[1], data, start);
+              } else if ((xhr.status == 200 || xhr.status == 0) && data && data.length == REMOTE_PACKAGE_SIZE) {
+                // The server does not support range requests, and sent the
+                // whole package.
+                setChunks(chunks, range[0], range[1], data, 0);
+              } else {
+                errback(new Error(xhr.statusText + " : " + xhr.responseURL));
+                return;
+              }
+              if (--pending == 0) {
+                callback();
+              }
             };
+            xhr.send(null);
+          });
+        }
+
+        /* Store the chunks that were downloaded, and remove those that are no
+           longer part of the package */
+        function cacheChunks(db, packageName, cached, chunks, downloaded, callback, errback) {
+          var transaction = db.transaction([METADATA_STORE_NAME, PACKAGE_STORE_NAME], IDB_RW);
+          var packages = transaction.objectStore(PACKAGE_STORE_NAME);
+          var hashes = CACHE_CHUNKS.map(function(chunk) {
+            return chunk[1];
+          });
+          if (cached && cached['chunks']) {
+            cached['chunks'].forEach(function(hash) {
+              if (hashes.indexOf(hash) < 0) {
+                packages.delete('package/' + packageName + '/' + hash);
+              }
+            });
           }
+          chunks.forEach(function(chunk, i) {
+            if (downloaded[i]) {
+              packages.put(chunk, chunkKey(packageName, i));
+            }
+          });
+          transaction.objectStore(METADATA_STORE_NAME).put({
+            'uuid': PACKAGE_UUID,
+            'chunks': hashes
+          }, 'metadata/' + packageName);
+          transaction.oncomplete = function() {
+            callback();
+          };
+          transaction.onerror = function(error) {
+            errback(error);
+          };
+        }
+
+        function joinChunks(chunks) {
+          var packageData = new Uint8Array(REMOTE_PACKAGE_SIZE);
+          chunks.forEach(function(chunk, i) {
+            packageData.set(new Uint8Array(chunk), chunkStart(i));
+          });
+          return packageData.buffer;
         }\n'''
 
     # add Node.js support code, if necessary
@@ -987,6 +1671,83 @@ def generate_js(data_target, data_files, metadata):
         console.error('package error:', error);
       };\n''' % {'node_support_code': node_support_code}
 
+    if options.lazy_load:
+      node_range_code = ''
+      if options.support_node:
+        node_range_code = '''
+        if (typeof process === 'object' && typeof process.versions === 'object' && typeof process.versions.node === 'string') {
+          var fs = require('fs');
+          var fd = fs.openSync(REMOTE_PACKAGE_NAME, 'r');
+          var data = new Uint8Array(end - start);
+          try {
+            fs.readSync(fd, data, 0, end - start, start);
+          } finally {
+            fs.closeSync(fd);
+          }
+          return data;
+        }'''
+      ret += '''
+      // Synchronously fetch the bytes [start, end) of the package.  A server
+      // that does not support range requests may instead return the whole
+      // package.
+      function fetchPackageRange(start, end) {
+        if (Module['fetchPackageRange']) {
+          return Module['fetchPackageRange'](REMOTE_PACKAGE_NAME, start, end);
+        }%s
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', REMOTE_PACKAGE_NAME, false);
+        xhr.setRequestHeader('Range', 'bytes=' + start + '-' + (end - 1));
+        // Synchronous requests for binary data are only allowed in workers, so
+        // on the main thread read the data as a string.
+        if (typeof window === 'object') {
+          xhr.overrideMimeType('text/plain; charset=x-user-defined');
+        } else {
+          xhr.responseType = 'arraybuffer';
+        }
+        xhr.send(null);
+        if (!(xhr.status == 200 || xhr.status == 206 || (xhr.status == 0 && xhr.response))) {
+          throw new Error(xhr.statusText + " : " + xhr.responseURL);
+        }
+        if (xhr.response instanceof ArrayBuffer) {
+          return new Uint8Array(xhr.response);
+        }
+        var text = xhr.responseText;
+        var data = new Uint8Array(text.length);
+        for (var i = 0; i < text.length; ++i) {
+          data[i] = text.charCodeAt(i) & 0xff;
+        }
+        return data;
+      }
+
+      // Fetch the files that are needed at startup, which are at the start of
+      // the package.
+      function fetchPrefetchedFiles(callback, errback) {
+        var size = metadata['prefetch_size'];
+        if (!size || Module['fetchPackageRange'] || typeof XMLHttpRequest === 'undefined') {
+          var data = size ? fetchPackageRange(0, size) : new Uint8Array(0);
+          if (data.byteOffset || data.byteLength != data.buffer.byteLength) {
+            data = data.slice();
+          }
+          callback(data.buffer);
+          return;
+        }
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', REMOTE_PACKAGE_NAME, true);
+        xhr.setRequestHeader('Range', 'bytes=0-' + (size - 1));
+        xhr.responseType = 'arraybuffer';
+        xhr.onerror = function(event) {
+          throw new Error("NetworkError for: " + REMOTE_PACKAGE_NAME);
+        }
+        xhr.onload = function(event) {
+          if (xhr.status == 200 || xhr.status == 206 || (xhr.status == 0 && xhr.response)) {
+            callback(xhr.response);
+          } else {
+            throw new Error(xhr.statusText + " : " + xhr.responseURL);
+          }
+        };
+        xhr.send(null);
+      }\n''' % node_range_code
+
     code += '''
       function processPackageData(arrayBuffer) {
         assert(arrayBuffer, 'Loading data file failed.');
@@ -1012,22 +1773,30 @@ def generate_js(data_target, data_files, metadata):
 
         openDatabase(
           function(db) {
-            checkCachedPackage(db, PACKAGE_PATH + PACKAGE_NAME,
-              function(useCached, metadata) {
+            fetchCachedChunks(db, PACKAGE_PATH + PACKAGE_NAME,
+              function(cached, chunks) {
+                var downloaded = chunks.map(function(chunk) {
+                  return !chunk;
+                });
+                var useCached = !!cached && downloaded.indexOf(true) < 0;
                 Module.preloadResults[PACKAGE_NAME] = {fromCache: useCached};
-                if (useCached) {
-                  fetchCachedPackage(db, PACKAGE_PATH + PACKAGE_NAME, metadata, processPackageData, preloadFallback);
-                } else {
-                  fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE,
-                    function(packageData) {
-                      cacheRemotePackage(db, PACKAGE_PATH + PACKAGE_NAME, packageData, {uuid:PACKAGE_UUID}, processPackageData,
-                        function(error) {
-                          console.error(error);
-                          processPackageData(packageData);
-                        });
+                fetchMissingChunks(chunks,
+                  function() {
+                    var packageData = joinChunks(chunks);
+                    if (useCached && cached['uuid'] === PACKAGE_UUID) {
+                      processPackageData(packageData);
+                      return;
                     }
-                  , preloadFallback);
-                }
+                    cacheChunks(db, PACKAGE_PATH + PACKAGE_NAME, cached, chunks, downloaded,
+                      function() {
+                        processPackageData(packageData);
+                      },
+                      function(error) {
+                        console.error(error);
+                        processPackageData(packageData);
+                      });
+                  }
+                , preloadFallback);
               }
             , preloadFallback);
           }
@@ -1039,18 +1808,22 @@ def generate_js(data_target, data_files, metadata):
       # potentially before JS parsing of the main codebase if it's after us.
       # Only tricky bit is the fetch is async, but also when runWithFS is called
       # is async, so we handle both orderings.
+      if options.lazy_load:
+        fetch_package = 'fetchPrefetchedFiles('
+      else:
+        fetch_package = 'fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE, '
       ret += '''
       var fetchedCallback = null;
       var fetched = Module['getPreloadedPackage'] ? Module['getPreloadedPackage'](REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE) : null;
 
-      if (!fetched) fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE, function(data) {
+      if (!fetched) %sfunction(data) {
         if (fetchedCallback) {
           fetchedCallback(data);
           fetchedCallback = null;
         } else {
           fetched = data;
         }
-      }, handleError);\n'''
+      }, handleError);\n''' % fetch_package
 
       code += '''
       Module.preloadResults[PACKAGE_NAME] = {fromCache: false};
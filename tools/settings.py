@@ -3,6 +3,7 @@
 # University of Illinois/NCSA Open Source License.  Both these licenses can be
 # found in the LICENSE file.
 
+import copy
 import difflib
 import os
 import re
@@ -85,6 +86,7 @@ COMPILE_TIME_SETTINGS = {
 
 class SettingsManager:
   attrs = {}
+  defaults = {}
   types = {}
   allowed_settings = set()
   legacy_settings = {}
@@ -140,6 +142,12 @@ class SettingsManager:
 
     self.internal_settings.update(internal_attrs.keys())
 
+    # Snapshot of the default values, used to compute which settings have been
+    # changed (see `changed_settings`).  This needs to be a deep copy since
+    # list settings are often modified in place.
+    self.defaults.clear()
+    self.defaults.update(copy.deepcopy(self.attrs))
+
   def infer_types(self):
     for key, value in self.attrs.items():
       self.types[key] = type(value)
@@ -150,6 +158,17 @@ class SettingsManager:
   def keys(self):
     return self.attrs.keys()
 
+  def changed_settings(self, defaults=None):
+    """Return the settings whose values differ from `defaults` (which, if not
+    specified, are the values from settings.js), along with the names of any
+    default settings that no longer exist (e.g. legacy settings in STRICT mode).
+    """
+    if defaults is None:
+      defaults = self.defaults
+    changed = {k: v for k, v in self.attrs.items() if k not in defaults or defaults[k] != v}
+    removed = [k for k in defaults if k not in self.attrs]
+    return changed, removed
+
   def limit_settings(self, allowed):
     self.allowed_settings.clear()
     if allowed:
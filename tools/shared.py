@@ -45,6 +45,10 @@ from .settings import settings
 
 
 DEBUG_SAVE = DEBUG or int(os.environ.get('EMCC_DEBUG_SAVE', '0'))
+# When set, emcc stores intermediate results of linking in the cache so that
+# they can be reused by subsequent links of the same inputs (see
+# system_libs.calculate).
+LINK_CACHE = int(os.environ.get('EMCC_LINK_CACHE', '0'))
 MINIMUM_NODE_VERSION = (4, 1, 1)
 EXPECTED_LLVM_VERSION = "15.0"
 
@@ -216,6 +220,40 @@ def run_multiple_processes(commands, env=os.environ.copy(), route_stdout_to_temp
   return [x[1] for x in std_outs]
 
 
+# Runs a graph of tasks, each of which is a (name, func, deps) tuple where
+# `deps` is a list of the names of the tasks that must complete before `func`
+# is called.  Tasks whose dependencies are complete are run concurrently on a
+# thread pool, which is useful when (as is typical) each task spends most of
+# its time waiting on a subprocess.  `tasks` must be listed in an order that
+# satisfies the dependencies, which is the order they are run in when
+# `parallel` is False or EMCC_CORES=1.
+def run_task_graph(tasks, parallel=True):
+  if not parallel or get_num_cores() == 1 or len(tasks) < 2:
+    for name, func, deps in tasks:
+      func()
+    return
+
+  from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+  pending = list(tasks)
+  running = {}
+  completed = set()
+  with ThreadPoolExecutor(max_workers=get_num_cores()) as executor:
+    while pending or running:
+      for task in list(pending):
+        name, func, deps = task
+        if all(d in completed for d in deps):
+          logger.debug(f'starting task: {name}')
+          running[executor.submit(func)] = name
+          pending.remove(task)
+      assert running, 'unsatisfiable task dependencies: %s' % [t[0] for t in pending]
+      finished, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in finished:
+        # Re-raises any exception (including SystemExit from exit_with_error)
+        # from the task on the main thread.
+        future.result()
+        completed.add(running.pop(future))
+
+
 def check_call(cmd, *args, **kw):
   """Like `run_process` above but treat failures as fatal and exit_with_error."""
   print_compiler_stage(cmd)
@@ -0,0 +1,182 @@
+# Copyright 2022 The Emscripten Authors.  All rights reserved.
+# Emscripten is available under two separate licenses, the MIT license and the
+# University of Illinois/NCSA Open Source License.  Both these licenses can be
+# found in the LICENSE file.
+
+"""Caching of the outputs of individual post-link stages.
+
+When EMCC_LINK_CACHE is set, the stages that are pure functions of their input
+files and command line (wasm-opt, wasm-metadce, the acorn JS optimizer, closure
+compiler, etc.) are keyed on:
+
+  - the command line, with the names of input and output files replaced by
+    placeholders (since these are often in a fresh temp directory),
+  - the size and mtime of any other existing files named on the command line,
+    either as a whole argument or as the value of a `--flag=file` argument
+    (e.g. the tool itself, or the externs files that ship with emscripten),
+  - the contents of the input files.
+
+If a previous link already ran a stage with the same key, the outputs are
+copied from the cache rather than running the stage again.  This means that,
+for example, changing only a `--pre-js` file does not cause wasm-opt to re-run.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from . import config, shared, utils
+
+logger = logging.getLogger('stage_cache')
+
+# The maximum number of stage results kept in the cache.  The least recently
+# used results are removed once this is exceeded.
+MAX_ENTRIES = 200
+
+# The stages run during this invocation, and whether they were found in the
+# cache.  Used to report which stages hit in debug mode.
+stage_results = []
+
+
+def enabled():
+  return shared.LINK_CACHE and not config.FROZEN_CACHE
+
+
+def hash_file(filename):
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def get_cache_dir():
+  return shared.Cache.get_path('stage_cache')
+
+
+def prune():
+  cache_dir = get_cache_dir()
+  entries = [e for e in os.scandir(cache_dir) if e.is_dir() and '.tmp' not in e.name]
+  if len(entries) <= MAX_ENTRIES:
+    return
+  entries.sort(key=lambda e: e.stat().st_mtime)
+  for entry in entries[:len(entries) - MAX_ENTRIES]:
+    logger.debug(f'removing stage cache entry: {entry.name}')
+    shared.try_delete(entry.path)
+
+
+class CachedStage:
+  """A single run of a post-link stage.
+
+  Typical usage:
+
+    stage = CachedStage('wasm-opt', cmd, inputs=[infile], outputs=[outfile])
+    if stage.restore():
+      result = stage.result
+    else:
+      result = run_process(cmd).stdout
+      stage.save(result)
+
+  Relative file names in `inputs`, `outputs` and `cmd` are resolved against
+  `cwd`.  When caching is disabled (or not possible, e.g. because an input
+  is missing) `restore` always returns False and `save` does nothing.
+  """
+
+  def __init__(self, name, cmd, inputs, outputs, cwd=None):
+    self.name = name
+    self.cwd = cwd
+    self.outputs = [self.resolve(f) for f in outputs]
+    self.result = None
+    self.key = None
+    if enabled():
+      self.key = self.compute_key(cmd, inputs, outputs)
+
+  def resolve(self, filename):
+    if self.cwd:
+      return os.path.join(self.cwd, filename)
+    return filename
+
+  def compute_key(self, cmd, inputs, outputs):
+    placeholders = {}
+    for i, f in enumerate(inputs):
+      placeholders[f] = f'<input{i}>'
+    for i, f in enumerate(outputs):
+      placeholders.setdefault(f, f'<output{i}>')
+    # Replace the longest names first so that e.g. `a.wasm.map` is not
+    # mistaken for `a.wasm`.
+    names = sorted(placeholders, key=len, reverse=True)
+    key_cmd = []
+    others = []
+    for arg in cmd:
+      # Files can be named either as a whole argument or as the value of a
+      # `--flag=file` argument.
+      for filename in (arg, arg.split('=', 1)[-1]):
+        if filename not in placeholders and os.path.isfile(self.resolve(filename)):
+          s = os.stat(self.resolve(filename))
+          others.append([filename, s.st_size, s.st_mtime_ns])
+          break
+      for name in names:
+        arg = arg.replace(name, placeholders[name])
+      key_cmd.append(arg)
+    try:
+      contents = [hash_file(self.resolve(f)) for f in inputs]
+    except OSError:
+      return None
+    key = json.dumps([self.name, key_cmd, others, contents])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+  def entry_dir(self):
+    return os.path.join(get_cache_dir(), self.key)
+
+  def restore(self):
+    """Copy the outputs of a previous run of this stage into place, if it is in
+    the cache.  Returns True on success, in which case `self.result` holds the
+    result passed to `save` by that previous run."""
+    if not self.key:
+      return False
+    entry = self.entry_dir()
+    try:
+      info = json.loads(utils.read_file(os.path.join(entry, 'stage.json')))
+    except (OSError, ValueError):
+      logger.debug(f'stage cache miss: {self.name}')
+      stage_results.append((self.name, False))
+      return False
+    for i, output in enumerate(self.outputs):
+      if info['outputs'][i]:
+        shutil.copyfile(os.path.join(entry, str(i)), output)
+      else:
+        shared.try_delete(output)
+    # Update the mtime so that recently used entries are pruned last.
+    os.utime(entry)
+    self.result = info['result']
+    logger.debug(f'stage cache hit: {self.name}')
+    stage_results.append((self.name, True))
+    return True
+
+  def save(self, result=None):
+    """Store the outputs of this stage (which must have just been run), along
+    with a JSON-serializable `result` (e.g. its stdout)."""
+    if not self.key:
+      return
+    entry = self.entry_dir()
+    if os.path.exists(entry):
+      return
+    # Populate a temporary directory first and then rename it into place so
+    # that concurrent links never see a partially written entry.
+    temp_dir = f'{entry}.tmp{os.getpid()}'
+    utils.safe_ensure_dirs(temp_dir)
+    exists = []
+    for i, output in enumerate(self.outputs):
+      exists.append(os.path.exists(output))
+      if exists[-1]:
+        shutil.copyfile(output, os.path.join(temp_dir, str(i)))
+    utils.write_file(os.path.join(temp_dir, 'stage.json'), json.dumps({'outputs': exists, 'result': result}))
+    try:
+      os.rename(temp_dir, entry)
+    except OSError:
+      # Another process stored the same stage concurrently.
+      shared.try_delete(temp_dir)
+      return
+    prune()
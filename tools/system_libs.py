@@ -5,7 +5,9 @@
 
 from .toolchain_profiler import ToolchainProfiler
 
+import hashlib
 import itertools
+import json
 import logging
 import os
 import shutil
@@ -13,7 +15,7 @@ import textwrap
 from enum import IntEnum, auto
 from glob import iglob
 
-from . import shared, building, utils
+from . import shared, building, config, utils
 from . import deps_info, tempfiles
 from . import diagnostics
 from tools.shared import demangle_c_symbol_name
@@ -1759,6 +1761,10 @@ def warn_on_unexported_main(symbolses):
 
 
 def handle_reverse_deps(input_files):
+  """Adds the reverse dependencies of the input files to REQUIRED_EXPORTS.
+
+  Returns the symbols of the input files, if they were scanned.
+  """
   if settings.REVERSE_DEPS == 'none':
     return
   elif settings.REVERSE_DEPS == 'all':
@@ -1804,6 +1810,81 @@ def handle_reverse_deps(input_files):
   for symbols in symbolses:
     add_reverse_deps(symbols)
 
+  return symbolses
+
+
+# The maximum number of link plans kept in the cache.  The least recently used
+# plans are removed once this is exceeded.
+MAX_LINK_PLANS = 200
+
+
+def get_link_plan_file(input_files, args, forced):
+  # Link plans are keyed on everything that can affect the outcome of
+  # `calculate` other than the contents of the input files themselves, which
+  # are checked when the plan is used.
+  key = json.dumps({
+    'version': shared.EMSCRIPTEN_VERSION,
+    'settings': settings.dict(),
+    'args': args,
+    'forced': forced,
+    'force_stdlibs': os.environ.get('EMCC_FORCE_STDLIBS'),
+    'inputs': [os.path.abspath(f) for f in input_files],
+  }, sort_keys=True)
+  digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+  return shared.Cache.get_path(os.path.join('link_plans', digest + '.json'))
+
+
+def get_input_stats(input_files):
+  stats = []
+  for f in input_files:
+    try:
+      s = os.stat(f)
+      stats.append([f, s.st_size, s.st_mtime_ns])
+    except OSError:
+      stats.append([f, None, None])
+  return stats
+
+
+def read_link_plan(plan_file):
+  """Reads a link plan written by `write_link_plan`, returning None if it
+  doesn't exist or if any of the libraries it refers to are no longer in the
+  cache (e.g. after `emcc --clear-cache`)."""
+  try:
+    plan = json.loads(utils.read_file(plan_file))
+  except (OSError, ValueError):
+    return None
+  if not all(os.path.exists(f) for f in plan['library_files']):
+    logger.debug(f'ignoring link plan with missing libraries: {plan_file}')
+    return None
+  return plan
+
+
+def write_link_plan(plan_file, plan):
+  utils.safe_ensure_dirs(os.path.dirname(plan_file))
+  # Write to a temporary file first so that concurrent links never see a
+  # partially written plan.
+  temp_file = f'{plan_file}.{os.getpid()}.tmp'
+  utils.write_file(temp_file, json.dumps(plan))
+  os.replace(temp_file, plan_file)
+  prune_link_plans(os.path.dirname(plan_file))
+
+
+def prune_link_plans(plans_dir):
+  entries = [e for e in os.scandir(plans_dir) if e.name.endswith('.json')]
+  if len(entries) <= MAX_LINK_PLANS:
+    return
+  entries.sort(key=lambda e: e.stat().st_mtime)
+  for entry in entries[:len(entries) - MAX_LINK_PLANS]:
+    logger.debug(f'removing link plan: {entry.name}')
+    shared.try_delete(entry.path)
+
+
+def get_library_file(link_flag):
+  # Inverse of Library.get_link_flag
+  if link_flag.startswith('-l'):
+    return str(shared.Cache.get_path(shared.Cache.get_lib_name('lib' + link_flag[2:] + '.a')))
+  return link_flag
+
 
 def get_libs_to_link(args, forced, only_forced):
   libs_to_link = []
@@ -1951,8 +2032,40 @@ def calculate(input_files, args, forced):
     diagnostics.warning('deprecated', 'EMCC_ONLY_FORCED_STDLIBS is deprecated.  Use `-nostdlib` and/or `-sREVERSE_DEPS=none` depending on the desired result')
     settings.REVERSE_DEPS = 'all'
 
-  handle_reverse_deps(input_files)
+  # With EMCC_LINK_CACHE we record the outcome of this function in a "link
+  # plan" that subsequent links can use as long as the inputs are unchanged,
+  # in which case we can skip running llvm-nm on them.
+  plan_file = None
+  if shared.LINK_CACHE and settings.REVERSE_DEPS == 'auto' and not config.FROZEN_CACHE:
+    plan_file = get_link_plan_file(input_files, args, forced)
+    plan = read_link_plan(plan_file)
+    input_stats = get_input_stats(input_files)
+    if plan and plan['inputs'] == input_stats:
+      logger.debug(f'using link plan (inputs unchanged): {plan_file}')
+      # Update the mtime so that recently used plans are pruned last.
+      os.utime(plan_file)
+      if plan['defines_main']:
+        warn_on_unexported_main([{'defs': {'main'}}])
+      settings.REQUIRED_EXPORTS += plan['required_exports']
+      return plan['link_args']
+
+  num_required_exports = len(settings.REQUIRED_EXPORTS)
+  symbolses = handle_reverse_deps(input_files)
+  ret = calculate_link_args(args, forced, only_forced)
+
+  if plan_file:
+    write_link_plan(plan_file, {
+      'inputs': input_stats,
+      'defines_main': any('main' in symbols['defs'] for symbols in symbolses),
+      'required_exports': settings.REQUIRED_EXPORTS[num_required_exports:],
+      'link_args': ret,
+      'library_files': [get_library_file(a) for a in ret if not a.startswith('--')],
+    })
+
+  return ret
+
 
+def calculate_link_args(args, forced, only_forced):
   libs_to_link = get_libs_to_link(args, forced, only_forced)
 
   # When LINKABLE is set the entire link command line is wrapped in --whole-archive by
@@ -4,20 +4,127 @@
 # found in the LICENSE file.
 
 import atexit
+import json
 import logging
 import os
 import sys
 import subprocess
 import tempfile
+import threading
 import time
 from contextlib import ContextDecorator
 
+try:
+  import resource
+except ImportError:
+  # Not available on Windows, where resource usage is not recorded.
+  resource = None
+
 logger = logging.getLogger('profiler')
 
 from . import response_file
 
 EMPROFILE = int(os.getenv('EMPROFILE', '0'))
 
+process_start_time = time.perf_counter()
+
+# The TimingReport of `emcc --timing-report`, if enabled.
+timing_report = None
+
+
+def resource_usage(rusage):
+  # Note: ru_maxrss is in kilobytes on linux, but bytes on macOS.
+  max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+  return {'cpuTime': round(rusage.ru_utime + rusage.ru_stime, 6), 'maxRss': max_rss}
+
+
+# Collects the wall time, CPU time, number of subprocesses and bytes read and
+# written during each profiling block, for `emcc --timing-report`.  These are
+# measured for the whole process, including the subprocesses it waited for,
+# while the block was running, so blocks that run at the same time on
+# different threads each include all of them.  I/O is only known on Linux.
+class TimingReport:
+  def __init__(self, filename):
+    self.filename = filename
+    self.blocks = {}
+    self.subprocesses = 0
+    # Blocks can be entered from several threads (see run_task_graph), so
+    # each has its own stack of active blocks.
+    self.local = threading.local()
+
+  def snapshot(self):
+    cpu_time = time.process_time()
+    if resource:
+      children = resource.getrusage(resource.RUSAGE_CHILDREN)
+      cpu_time += children.ru_utime + children.ru_stime
+    bytes_read = bytes_written = None
+    try:
+      with open('/proc/self/io') as f:
+        for line in f:
+          key, value = line.split(':')
+          if key == 'rchar':
+            bytes_read = int(value)
+          elif key == 'wchar':
+            bytes_written = int(value)
+    except OSError:
+      pass
+    return {'wallTime': time.perf_counter(), 'cpuTime': cpu_time, 'subprocesses': self.subprocesses, 'bytesRead': bytes_read, 'bytesWritten': bytes_written}
+
+  def stack(self):
+    if not hasattr(self.local, 'stack'):
+      self.local.stack = []
+    return self.local.stack
+
+  def enter_block(self, name):
+    self.stack().append((name, self.snapshot()))
+
+  def exit_block(self, name):
+    stack = self.stack()
+    for i in reversed(range(len(stack))):
+      if stack[i][0] == name:
+        start = stack.pop(i)[1]
+        break
+    else:
+      return
+    # Only count the outermost of recursive blocks, or their time would be
+    # counted twice.
+    if any(entry[0] == name for entry in stack):
+      return
+    end = self.snapshot()
+    block = self.blocks.setdefault(name, {'count': 0})
+    block['count'] += 1
+    for key, value in start.items():
+      if value is not None and end[key] is not None:
+        block[key] = block.get(key, 0) + end[key] - value
+
+  def write(self):
+    total = self.snapshot()
+    total['wallTime'] -= process_start_time
+    if resource:
+      total['maxRss'] = resource_usage(resource.getrusage(resource.RUSAGE_SELF))['maxRss']
+    total = {key: value for key, value in total.items() if value is not None}
+    for block in [total] + list(self.blocks.values()):
+      for key in ('wallTime', 'cpuTime'):
+        if key in block:
+          block[key] = round(block[key], 6)
+    with open(self.filename, 'w') as f:
+      json.dump({'command': sys.argv, 'total': total, 'blocks': self.blocks}, f, indent=2)
+
+
+def enable_timing_report(filename):
+  global timing_report
+  timing_report = TimingReport(os.path.abspath(filename))
+
+  # Count subprocesses as they are created.  All subprocess helpers go through
+  # Popen, see ProfiledPopen.
+  class CountedPopen(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+      super().__init__(*args, **kwargs)
+      timing_report.subprocesses += 1
+
+  subprocess.Popen = CountedPopen
+  atexit.register(timing_report.write)
+
 
 class Logger(ContextDecorator):
   depth = 0
@@ -35,9 +142,13 @@ class Logger(ContextDecorator):
       indentation = '  ' * Logger.depth
       logger.info('%sstart block "%s"', indentation, self.name)
       Logger.depth += 1
+    if timing_report:
+      timing_report.enter_block(self.name)
     self.start = time.time()
 
   def __exit__(self, exc_type, value, traceback):
+    if timing_report:
+      timing_report.exit_block(self.name)
     # When a block ends debug log the total duration.
     now = time.time()
     duration = now - self.start
@@ -55,9 +166,6 @@ class Logger(ContextDecorator):
 
 if EMPROFILE == 1:
   original_sys_exit = sys.exit
-  original_subprocess_call = subprocess.call
-  original_subprocess_check_call = subprocess.check_call
-  original_subprocess_check_output = subprocess.check_output
   original_Popen = subprocess.Popen
   process_returncode = None
 
@@ -67,62 +175,68 @@ if EMPROFILE == 1:
     process_returncode = returncode
     original_sys_exit(returncode)
 
-  def profiled_call(cmd, *args, **kw):
-    pid = ToolchainProfiler.imaginary_pid()
-    ToolchainProfiler.record_subprocess_spawn(pid, cmd)
-    try:
-      returncode = original_subprocess_call(cmd, *args, **kw)
-    except Exception:
-      ToolchainProfiler.record_subprocess_finish(pid, 1)
-      raise
-    ToolchainProfiler.record_subprocess_finish(pid, returncode)
-    return returncode
-
-  def profiled_check_call(cmd, *args, **kw):
-    pid = ToolchainProfiler.imaginary_pid()
-    ToolchainProfiler.record_subprocess_spawn(pid, cmd)
-    try:
-      ret = original_subprocess_check_call(cmd, *args, **kw)
-    except Exception as e:
-      ToolchainProfiler.record_subprocess_finish(pid, e.returncode)
-      raise
-    ToolchainProfiler.record_subprocess_finish(pid, 0)
-    return ret
-
-  def profiled_check_output(cmd, *args, **kw):
-    pid = ToolchainProfiler.imaginary_pid()
-    ToolchainProfiler.record_subprocess_spawn(pid, cmd)
-    try:
-      ret = original_subprocess_check_output(cmd, *args, **kw)
-    except Exception as e:
-      ToolchainProfiler.record_subprocess_finish(pid, e.returncode)
-      raise
-    ToolchainProfiler.record_subprocess_finish(pid, 0)
-    return ret
-
+  # All subprocess helpers (subprocess.run, call, check_output, ...) create
+  # their children through Popen, so hooking it is enough to see every spawned
+  # tool. A child is recorded as finished when it is first reaped, whether
+  # that happens through wait(), poll() or communicate().
   class ProfiledPopen(original_Popen):
     def __init__(self, args, *otherargs, **kwargs):
+      self.rusage = None
+      self.finish_recorded = False
       super().__init__(args, *otherargs, **kwargs)
       ToolchainProfiler.record_subprocess_spawn(self.pid, args)
 
-    def communicate(self, *args, **kwargs):
-      ToolchainProfiler.record_subprocess_wait(self.pid)
-      output = super().communicate(*args, **kwargs)
-      ToolchainProfiler.record_subprocess_finish(self.pid, self.returncode)
-      return output
+    def poll(self):
+      if self.returncode is None and not self.reap(os.WNOHANG):
+        super().poll()
+      if self.returncode is not None:
+        self.record_finish()
+      return self.returncode
+
+    def wait(self, timeout=None):
+      if self.returncode is None and timeout is None:
+        self.reap(0)
+      returncode = super().wait(timeout)
+      self.record_finish()
+      return returncode
+
+    def reap(self, wait_flags):
+      # Reap the child with wait4() before Popen gets to it, so that its CPU
+      # time and peak memory usage are known when it finishes. Returns False if
+      # that is not possible, in which case Popen reaps the child as usual and
+      # the usage is not known.
+      if not hasattr(os, 'wait4'):
+        return False
+      try:
+        (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+      except ChildProcessError:
+        return False
+      if pid == self.pid:
+        self.rusage = rusage
+        if os.WIFSIGNALED(sts):
+          self.returncode = -os.WTERMSIG(sts)
+        elif os.WIFEXITED(sts):
+          self.returncode = os.WEXITSTATUS(sts)
+      return True
+
+    def record_finish(self):
+      if not self.finish_recorded:
+        self.finish_recorded = True
+        ToolchainProfiler.record_subprocess_finish(self.pid, self.returncode, self.rusage)
 
   sys.exit = profiled_sys_exit
-  subprocess.call = profiled_call
-  subprocess.check_call = profiled_check_call
-  subprocess.check_output = profiled_check_output
   subprocess.Popen = ProfiledPopen
 
   class ToolchainProfiler:
-    # Provide a running counter towards negative numbers for PIDs for which we
-    # don't know what the actual process ID is
-    imaginary_pid_ = 0
     profiler_logs_path = None # Log file not opened yet
 
+    # Events are buffered here and written out in one go when the process
+    # exits, so profiling adds next to no I/O to the tools being profiled.
+    events = []
+
+    # Set in processes forked off by multiprocessing.Pool, see forked_child().
+    forked = False
+
     block_stack = []
 
     # Track if record_process_exit and record_process_start have been called
@@ -131,47 +245,49 @@ if EMPROFILE == 1:
     process_exit_recorded = False
 
     @staticmethod
-    def timestamp():
-      return '{0:.3f}'.format(time.time())
+    def record(op, **kwargs):
+      ToolchainProfiler.events.append(dict(pid=ToolchainProfiler.mypid, subprocessPid=os.getpid(), op=op, time=time.time(), **kwargs))
 
     @staticmethod
-    def log_access():
-      # Note: This function is called in two importantly different contexts: in
-      # "main" process and in python subprocesses invoked via
-      # subprocessing.Pool.map(). The subprocesses have their own PIDs, and
-      # hence record their own data JSON files, but since the process pool is
-      # maintained internally by python, the toolchain profiler does not track
-      # the parent->child process spawns for the subprocessing pools. Therefore
-      # any profiling events that the subprocess children generate are virtually
-      # treated as if they were performed by the parent PID.
-      return open(os.path.join(ToolchainProfiler.profiler_logs_path, 'toolchain_profiler.pid_' + str(os.getpid()) + '.json'), 'a')
+    def flush():
+      if not ToolchainProfiler.events:
+        return
+      # Each flush appends one line holding a JSON array of events. The file is
+      # appended to rather than overwritten since PIDs get reused during long
+      # builds.
+      log_file = os.path.join(ToolchainProfiler.profiler_logs_path, 'toolchain_profiler.pid_' + str(os.getpid()) + '.json')
+      with open(log_file, 'a') as f:
+        f.write(json.dumps(ToolchainProfiler.events, separators=(',', ':')) + '\n')
+      ToolchainProfiler.events = []
 
     @staticmethod
-    def escape_string(arg):
-      return arg.replace('\\', '\\\\').replace('"', '\\"')
-
-    @staticmethod
-    def escape_args(args):
-      return map(lambda arg: ToolchainProfiler.escape_string(arg), args)
+    def forked_child():
+      # Processes in a multiprocessing.Pool are forked from the "main" process
+      # and never run its atexit handlers, so they write out their events as
+      # each subprocess they run finishes. Since the process pool is maintained
+      # internally by python, the toolchain profiler does not track the
+      # parent->child process spawns for it, and any profiling events that the
+      # pool processes generate are virtually treated as if they were performed
+      # by the parent PID.
+      ToolchainProfiler.events = []
+      ToolchainProfiler.forked = True
 
     @staticmethod
     def record_process_start(write_log_entry=True):
       assert not ToolchainProfiler.process_start_recorded
       ToolchainProfiler.process_start_recorded = True
       atexit.register(ToolchainProfiler.record_process_exit)
+      if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=ToolchainProfiler.forked_child)
 
-      # For subprocessing.Pool.map() child processes, this points to the PID of
-      # the parent process that spawned the subprocesses. This makes the
-      # subprocesses look as if the parent had called the functions.
-      ToolchainProfiler.mypid_str = str(os.getpid())
+      ToolchainProfiler.mypid = os.getpid()
       ToolchainProfiler.profiler_logs_path = os.path.join(tempfile.gettempdir(), 'emscripten_toolchain_profiler_logs')
       os.makedirs(ToolchainProfiler.profiler_logs_path, exist_ok=True)
 
       ToolchainProfiler.block_stack = []
 
       if write_log_entry:
-        with ToolchainProfiler.log_access() as f:
-          f.write('[\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"start","time":' + ToolchainProfiler.timestamp() + ',"cmdLine":["' + '","'.join(ToolchainProfiler.escape_args(sys.argv)) + '"]}')
+        ToolchainProfiler.record('start', parentPid=os.getppid(), cmdLine=sys.argv)
 
     @staticmethod
     def record_process_exit():
@@ -180,34 +296,32 @@ if EMPROFILE == 1:
       ToolchainProfiler.process_exit_recorded = True
 
       ToolchainProfiler.exit_all_blocks()
-      with ToolchainProfiler.log_access() as f:
-        returncode = process_returncode
-        if returncode is None:
-          returncode = '"MISSING EXIT CODE"'
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"exit","time":' + ToolchainProfiler.timestamp() + ',"returncode":' + str(returncode) + '}\n]\n')
+      returncode = process_returncode
+      if returncode is None:
+        returncode = 'MISSING EXIT CODE'
+      usage = resource_usage(resource.getrusage(resource.RUSAGE_SELF)) if resource else {}
+      ToolchainProfiler.record('exit', returncode=returncode, **usage)
+      ToolchainProfiler.flush()
 
     @staticmethod
     def record_subprocess_spawn(process_pid, process_cmdline):
-      expanded_cmdline = response_file.substitute_response_files(process_cmdline)
-
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"spawn","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + ',"cmdLine":["' + '","'.join(ToolchainProfiler.escape_args(expanded_cmdline)) + '"]}')
-
-    @staticmethod
-    def record_subprocess_wait(process_pid):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"wait","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + '}')
+      if isinstance(process_cmdline, str):
+        process_cmdline = [process_cmdline]
+      expanded_cmdline = response_file.substitute_response_files([str(arg) for arg in process_cmdline])
+      ToolchainProfiler.record('spawn', targetPid=process_pid, cmdLine=expanded_cmdline)
 
     @staticmethod
-    def record_subprocess_finish(process_pid, returncode):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"finish","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + ',"returncode":' + str(returncode) + '}')
+    def record_subprocess_finish(process_pid, returncode, rusage=None):
+      usage = resource_usage(rusage) if rusage else {}
+      ToolchainProfiler.record('finish', targetPid=process_pid, returncode=returncode, **usage)
+      if ToolchainProfiler.forked:
+        ToolchainProfiler.flush()
 
     @staticmethod
     def enter_block(block_name):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"enterBlock","name":"' + block_name + '","time":' + ToolchainProfiler.timestamp() + '}')
-
+      if timing_report:
+        timing_report.enter_block(block_name)
+      ToolchainProfiler.record('enterBlock', name=block_name)
       ToolchainProfiler.block_stack.append(block_name)
 
     @staticmethod
@@ -220,9 +334,10 @@ if EMPROFILE == 1:
 
     @staticmethod
     def exit_block(block_name):
+      if timing_report:
+        timing_report.exit_block(block_name)
       if ToolchainProfiler.remove_last_occurrence_if_exists(ToolchainProfiler.block_stack, block_name):
-        with ToolchainProfiler.log_access() as f:
-          f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"exitBlock","name":"' + block_name + '","time":' + ToolchainProfiler.timestamp() + '}')
+        ToolchainProfiler.record('exitBlock', name=block_name)
 
     @staticmethod
     def exit_all_blocks():
@@ -242,27 +357,24 @@ if EMPROFILE == 1:
 
     @staticmethod
     def profile_block(block_name):
-      return ToolchainProfiler.ProfileBlock(ToolchainProfiler.escape_string(block_name))
+      return ToolchainProfiler.ProfileBlock(block_name)
 
     @staticmethod
     def profile():
       return ToolchainProfiler.ProfileBlock(None)
 
-    @staticmethod
-    def imaginary_pid():
-      ToolchainProfiler.imaginary_pid_ -= 1
-      return ToolchainProfiler.imaginary_pid_
-
   ToolchainProfiler.record_process_start()
 else:
   class ToolchainProfiler:
     @staticmethod
     def enter_block(block_name):
-      pass
+      if timing_report:
+        timing_report.enter_block(block_name)
 
     @staticmethod
     def exit_block(block_name):
-      pass
+      if timing_report:
+        timing_report.exit_block(block_name)
 
     @staticmethod
     def profile_block(block_name):
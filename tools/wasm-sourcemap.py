@@ -11,10 +11,11 @@ sections from a wasm file.
 """
 
 import argparse
-from collections import OrderedDict
+from itertools import chain, compress, islice, repeat, tee
 import json
 import logging
 from math import floor, log
+import operator
 import os
 import re
 from subprocess import Popen, PIPE
@@ -25,8 +26,13 @@ __scriptdir__ = os.path.dirname(os.path.abspath(__file__))
 __rootdir__ = os.path.dirname(__scriptdir__)
 sys.path.append(__rootdir__)
 
+from tools import dwarf
+
 logger = logging.getLogger('wasm-sourcemap')
 
+# Number of segments of the "mappings" field that are encoded at a time.
+MAPPINGS_CHUNK_SIZE = 65536
+
 
 def parse_args():
   parser = argparse.ArgumentParser(prog='wasm-sourcemap.py', description=__doc__)
@@ -155,47 +161,48 @@ def get_code_section_offset(wasm):
     pos = pos + section_size
 
 
-def remove_dead_entries(entries):
-  # Remove entries for dead functions. It is a heuristics to ignore data if the
-  # function starting address near to 0 (is equal to its size field length).
-  block_start = 0
-  cur_entry = 0
-  while cur_entry < len(entries):
-    if not entries[cur_entry]['eos']:
-      cur_entry += 1
+def remove_dead_entries(table):
+  """Returns a new LineTable without the rows of dead functions, with the
+  end of each sequence moved back to the last END operator of its function.
+
+  This is done in a single pass over the sequences: each one is appended to
+  the output as a whole, and truncated off again if it turns out to be dead.
+  """
+  entries = dwarf.LineTable()
+  entries.files = table.files
+  address = entries.address
+  start = 0
+  while start < len(table):
+    end = table.end_sequence.find(1, start)
+    if end < 0:
+      entries.extend(table, start, len(table))
+      break
+    block_start = len(entries)
+    entries.extend(table, start, end)
+    # move end of function to the last END operator
+    eos_address = table.address[end] - 1
+    if address and address[-1] == eos_address:
+      # last entry has the same address, reusing
+      entries.end_sequence[-1] = 1
+    else:
+      entries.add_row(eos_address, table.file[end], table.line[end], table.column[end], 1)
+    start = end + 1
+    if block_start == len(entries):
       continue
-    fn_start = entries[block_start]['address']
+    # Remove entries for dead functions. It is a heuristics to ignore data if
+    # the function starting address near to 0 (is equal to its size field
+    # length).
+    fn_start = address[block_start]
     # Calculate the LEB encoded function size (including size field)
-    fn_size_length = floor(log(entries[cur_entry]['address'] - fn_start + 1, 128)) + 1
+    fn_size_length = floor(log(eos_address - fn_start + 1, 128)) + 1
     min_live_offset = 1 + fn_size_length # 1 byte is for code section entries
     if fn_start < min_live_offset:
       # Remove dead code debug info block.
-      del entries[block_start:cur_entry + 1]
-      cur_entry = block_start
-      continue
-    cur_entry += 1
-    block_start = cur_entry
+      entries.truncate(block_start)
+  return entries
 
 
-def read_dwarf_entries(wasm, options):
-  if options.dwarfdump_output:
-    output = Path(options.dwarfdump_output).read_bytes()
-  elif options.dwarfdump:
-    logger.debug('Reading DWARF information from %s' % wasm)
-    if not os.path.exists(options.dwarfdump):
-      logger.error('llvm-dwarfdump not found: ' + options.dwarfdump)
-      sys.exit(1)
-    process = Popen([options.dwarfdump, '-debug-info', '-debug-line', '--recurse-depth=0', wasm], stdout=PIPE)
-    output, err = process.communicate()
-    exit_code = process.wait()
-    if exit_code != 0:
-      logger.error('Error during llvm-dwarfdump execution (%s)' % exit_code)
-      sys.exit(1)
-  else:
-    logger.error('Please specify either --dwarfdump or --dwarfdump-output')
-    sys.exit(1)
-
-  entries = []
+def read_dwarfdump_output(output, table):
   debug_line_chunks = re.split(r"debug_line\[(0x[0-9a-f]*)\]", output.decode('utf-8'))
   maybe_debug_info_content = debug_line_chunks[0]
   for i in range(1, len(debug_line_chunks), 2):
@@ -228,53 +235,68 @@ def read_dwarf_entries(wasm, options):
     files = {}
     for file in re.finditer(r"file_names\[\s*(\d+)\]:\s+name: \"([^\"]*)\"\s+dir_index: (\d+)", line_chunk):
       dir = include_directories[file.group(3)]
-      file_path = (dir + '/' if file.group(2)[0] != '/' else '') + file.group(2)
-      files[file.group(1)] = file_path
+      files[file.group(1)] = table.add_file(dwarf.join_path(dir, file.group(2)))
 
     for line in re.finditer(r"\n0x([0-9a-f]+)\s+(\d+)\s+(\d+)\s+(\d+)(.*?end_sequence)?", line_chunk):
-      entry = {'address': int(line.group(1), 16), 'line': int(line.group(2)), 'column': int(line.group(3)), 'file': files[line.group(4)], 'eos': line.group(5) is not None}
-      if not entry['eos']:
-        entries.append(entry)
-      else:
-        # move end of function to the last END operator
-        entry['address'] -= 1
-        if entries[-1]['address'] == entry['address']:
-          # last entry has the same address, reusing
-          entries[-1]['eos'] = True
-        else:
-          entries.append(entry)
+      table.add_row(int(line.group(1), 16), files[line.group(4)], int(line.group(2)), int(line.group(3)), line.group(5) is not None)
+
+
+def read_line_table(wasm, options):
+  table = dwarf.LineTable()
+  if options.dwarfdump_output:
+    read_dwarfdump_output(Path(options.dwarfdump_output).read_bytes(), table)
+    return table
+
+  # Read the line tables directly from the wasm file if we can, which is much
+  # faster than parsing the textual output of llvm-dwarfdump.
+  logger.debug('Reading DWARF information from %s' % wasm)
+  try:
+    return dwarf.read_line_table(wasm)
+  except dwarf.DwarfError as e:
+    logger.debug('Unable to read DWARF directly (%s), falling back to llvm-dwarfdump' % e)
+
+  if not options.dwarfdump:
+    logger.error('Please specify either --dwarfdump or --dwarfdump-output')
+    sys.exit(1)
+  if not os.path.exists(options.dwarfdump):
+    logger.error('llvm-dwarfdump not found: ' + options.dwarfdump)
+    sys.exit(1)
+  process = Popen([options.dwarfdump, '-debug-info', '-debug-line', '--recurse-depth=0', wasm], stdout=PIPE)
+  output, err = process.communicate()
+  exit_code = process.wait()
+  if exit_code != 0:
+    logger.error('Error during llvm-dwarfdump execution (%s)' % exit_code)
+    sys.exit(1)
+  read_dwarfdump_output(output, table)
+  return table
 
-  remove_dead_entries(entries)
+
+def read_dwarf_entries(wasm, options):
+  entries = remove_dead_entries(read_line_table(wasm, options))
 
   # return entries sorted by the address field
-  return sorted(entries, key=lambda entry: entry['address'])
+  address = entries.address
+  if any(map(operator.gt, address, islice(address, 1, None))):
+    entries = entries.select(sorted(range(len(address)), key=address.__getitem__))
+  return entries
 
 
 def normalize_path(path):
   return path.replace('\\', '/').replace('//', '/')
 
 
-def build_sourcemap(entries, code_section_offset, prefixes, collect_sources, base_path):
+def resolve_sources(entries, prefixes, base_path):
+  """Returns the list of source names and, for each file in the line table, the
+  index of its source and the path to load its contents from.  This is done
+  once per file rather than once per entry."""
   sources = []
-  sources_content = [] if collect_sources else None
-  mappings = []
   sources_map = {}
-  last_address = 0
-  last_source_id = 0
-  last_line = 1
-  last_column = 1
-  for entry in entries:
-    line = entry['line']
-    column = entry['column']
-    # ignore entries with line 0
-    if line == 0:
-      continue
-    # start at least at column 1
-    if column == 0:
-      column = 1
-    address = entry['address'] + code_section_offset
-    file_name = entry['file']
-    file_name = normalize_path(file_name)
+  load_names = []
+  file_sources = [None] * len(entries.files)
+  # Visit the files in the order they first appear in the mappings, so that
+  # sources are numbered in that order too.
+  for file in dict.fromkeys(compress(entries.file, entries.line)):
+    file_name = normalize_path(entries.files[file])
     # if prefixes were provided, we use that; otherwise, we emit a relative
     # path
     if prefixes.provided():
@@ -287,35 +309,73 @@ def build_sourcemap(entries, code_section_offset, prefixes, collect_sources, bas
       file_name = normalize_path(file_name)
       source_name = file_name
     if source_name not in sources_map:
-      source_id = len(sources)
-      sources_map[source_name] = source_id
+      sources_map[source_name] = len(sources)
       sources.append(source_name)
-      if collect_sources:
-        load_name = prefixes.load.resolve(file_name)
-        try:
-          with open(load_name, 'r') as infile:
-            source_content = infile.read()
-          sources_content.append(source_content)
-        except IOError:
-          print('Failed to read source: %s' % load_name)
-          sources_content.append(None)
-    else:
-      source_id = sources_map[source_name]
-
-    address_delta = address - last_address
-    source_id_delta = source_id - last_source_id
-    line_delta = line - last_line
-    column_delta = column - last_column
-    mappings.append(encode_vlq(address_delta) + encode_vlq(source_id_delta) + encode_vlq(line_delta) + encode_vlq(column_delta))
-    last_address = address
-    last_source_id = source_id
-    last_line = line
-    last_column = column
-  return OrderedDict([('version', 3),
-                      ('names', []),
-                      ('sources', sources),
-                      ('sourcesContent', sources_content),
-                      ('mappings', ','.join(mappings))])
+      load_names.append(file_name)
+    file_sources[file] = sources_map[source_name]
+  return sources, file_sources, load_names
+
+
+class VLQCache(dict):
+  """Maps numbers to their VLQ encoding.  The deltas in a source map are
+  mostly small numbers, so nearly all of them are found in the cache."""
+  def __missing__(self, n):
+    result = self[n] = encode_vlq(n)
+    return result
+
+
+def encode_mappings(entries, code_section_offset, file_sources):
+  """Generates the segments of the "mappings" field, one per entry."""
+  # ignore entries with line 0
+  live = entries.line
+  addresses = compress(entries.address, live)
+  source_ids = map(file_sources.__getitem__, compress(entries.file, live))
+  lines = compress(entries.line, live)
+  # start at least at column 1
+  columns = map(max, compress(entries.column, live), repeat(1))
+
+  def deltas(values, start):
+    values, previous = tee(values)
+    return map(operator.sub, values, chain([start], previous))
+
+  vlq = VLQCache().__getitem__
+  return map(''.join, zip(map(vlq, deltas(addresses, -code_section_offset)),
+                          map(vlq, deltas(source_ids, 0)),
+                          map(vlq, deltas(lines, 1)),
+                          map(vlq, deltas(columns, 1))))
+
+
+def write_sourcemap(outfile, entries, code_section_offset, prefixes, collect_sources, base_path):
+  """Writes the source map as JSON, without ever holding the whole of the
+  "mappings" field or of the source contents in memory."""
+  sources, file_sources, load_names = resolve_sources(entries, prefixes, base_path)
+  outfile.write('{"version":3,"names":[],"sources":')
+  json.dump(sources, outfile, separators=(',', ':'))
+  outfile.write(',"sourcesContent":')
+  if collect_sources:
+    for i, file_name in enumerate(load_names):
+      outfile.write(',' if i else '[')
+      load_name = prefixes.load.resolve(file_name)
+      try:
+        with open(load_name, 'r') as infile:
+          source_content = infile.read()
+      except IOError:
+        print('Failed to read source: %s' % load_name)
+        source_content = None
+      json.dump(source_content, outfile)
+    outfile.write(']' if load_names else '[]')
+  else:
+    outfile.write('null')
+  outfile.write(',"mappings":"')
+  segments = encode_mappings(entries, code_section_offset, file_sources)
+  separator = ''
+  while True:
+    chunk = ','.join(islice(segments, MAPPINGS_CHUNK_SIZE))
+    if not chunk:
+      break
+    outfile.write(separator + chunk)
+    separator = ','
+  outfile.write('"}')
 
 
 def main():
@@ -332,9 +392,8 @@ def main():
   prefixes = SourceMapPrefixes(sources=Prefixes(options.prefix), load=Prefixes(options.load_prefix))
 
   logger.debug('Saving to %s' % options.output)
-  map = build_sourcemap(entries, code_section_offset, prefixes, options.sources, options.basepath)
   with open(options.output, 'w') as outfile:
-    json.dump(map, outfile, separators=(',', ':'))
+    write_sourcemap(outfile, entries, code_section_offset, prefixes, options.sources, options.basepath)
 
   if options.strip:
     wasm = strip_debug_sections(wasm)